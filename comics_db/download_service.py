@@ -0,0 +1,275 @@
+"""
+Async download service: ASGI application streaming title and reading list zips.
+
+Django views build archive manifest (see IssueArchive.manifest), save it to bucket and redirect to the service with
+signed manifest key, so gunicorn worker is not held during transfer. The service builds the same StoredZip layout as
+IssueArchive, so responses are byte-identical and resumable, and streams issue files from S3 with non-blocking
+requests by presigned URLs through connection pool shared by all downloads. Next files are prefetched by
+ISSUE_ARCHIVE_PREFETCH tasks into bounded queues, and every chunk is sent only when ASGI server accepts it, so memory
+usage per download is constant.
+
+CRC-32 computed while streaming are saved to issues by executor threads, so next downloads of the same issues can
+start from any range.
+
+Run with any ASGI server, e.g. `uvicorn comicsdb.asgi:application`. S3 endpoint is taken from DO_ENDPOINT_URL, so the
+service can be run locally against MinIO or moto server.
+"""
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+
+import httpx
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+
+from comics_db.issue_archive import StoredZip, ArchiveMember, ArchiveError, MemberStream, ASYNC_DOWNLOAD_SALT, \
+    parse_range, slice_range
+from comics_db.models import Issue
+from comics_db.s3 import get_client
+
+logger = logging.getLogger(__name__)
+
+_http_client = None
+
+
+def _get_http_client():
+    """
+    HTTP client of the service process. Its connections to S3 are kept alive and reused by all downloads, concurrency
+    of one download is limited by ISSUE_ARCHIVE_PREFETCH
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=settings.S3_MAX_POOL_CONNECTIONS),
+            timeout=httpx.Timeout(settings.S3_READ_TIMEOUT, connect=settings.S3_CONNECT_TIMEOUT),
+            # Objects are read as stored, like boto3 get_object does, so their sizes match manifest
+            headers={'Accept-Encoding': 'identity'}
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """
+    Close connections of HTTP client, it is created again by next request
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _iter_object(key, start=0, end=None, size=None):
+    """
+    Stream S3 object (or its byte range) by presigned URL. Connection and server errors are retried up to
+    S3_MAX_ATTEMPTS times like in boto3 client, interrupted transfer is resumed from the first byte not received yet
+
+    :param start: first byte to read
+    :param end: byte after last one to read, object end if not specified
+    :param size: expected object size, checked against Content-Range of ranged responses
+    """
+    url = get_client().generate_presigned_url(
+        'get_object', Params={'Bucket': settings.DO_STORAGE_BUCKET_NAME, 'Key': key}, ExpiresIn=60 * 60
+    )
+    position = start
+    attempt = 1
+    while True:
+        headers = {}
+        if position or end is not None:
+            headers['Range'] = 'bytes={0}-{1}'.format(position, '' if end is None else end - 1)
+        try:
+            async with _get_http_client().stream('GET', url, headers=headers) as response:
+                if response.status_code < 500:
+                    if response.status_code != (206 if headers else 200):
+                        raise ArchiveError('Could not read {0}: HTTP {1}'.format(key, response.status_code))
+                    total = response.headers.get('content-range', '').rpartition('/')[2]
+                    if size is not None and headers and total != str(size):
+                        raise ArchiveError('Size of {0} does not match archive manifest'.format(key))
+                    async for chunk in response.aiter_raw(settings.ISSUE_ARCHIVE_CHUNK_SIZE):
+                        position += len(chunk)
+                        yield chunk
+                    return
+                error = 'HTTP {0}'.format(response.status_code)
+        except httpx.TransportError as err:
+            error = repr(err)
+            if end is not None and position >= end:
+                # Connection failed after the whole range was received
+                return
+        if attempt >= settings.S3_MAX_ATTEMPTS:
+            raise ArchiveError('Could not read {0}: {1}'.format(key, error))
+        await asyncio.sleep(0.1 * 2 ** attempt)
+        attempt += 1
+
+
+async def _read_manifest(key):
+    return json.loads(b''.join([chunk async for chunk in _iter_object(key)]).decode('utf-8'))
+
+
+def _save_crc(link, crc):
+    try:
+        Issue.objects.filter(link=link).update(file_crc32=crc)
+    finally:
+        # Executor threads are not managed by Django
+        connection.close()
+
+
+class AsyncArchive:
+    """
+    Async counterpart of IssueArchive built from archive manifest
+    """
+
+    def __init__(self, manifest):
+        self.filename = manifest['filename']
+        self.etag = manifest['etag']
+        self._links = [x[3] for x in manifest['members']]
+        self._crcs = [x[4] for x in manifest['members']]
+        self.zip = StoredZip([ArchiveMember(name, size, tuple(date_time))
+                              for name, size, date_time, _, _ in manifest['members']])
+
+    @property
+    def size(self):
+        return self.zip.size
+
+    @staticmethod
+    async def _download(key, file_range, size, chunks, semaphore):
+        async with semaphore:
+            try:
+                async for chunk in _iter_object(key, *file_range, size=size):
+                    await chunks.put(chunk)
+                await chunks.put(None)
+            except Exception as err:
+                await chunks.put(err)
+
+    @staticmethod
+    async def _stream_member(member, link, crc, chunks, file_range, data_start, start, end):
+        """
+        Yield part of member data inside archive range. CRC-32 of completely read file is returned as last item
+        """
+        stream = MemberStream(member, link, file_range, data_start)
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield stream.feed(chunk, start, end)
+        computed_crc = stream.finish()
+        if computed_crc is not None:
+            if computed_crc != crc:
+                await asyncio.get_event_loop().run_in_executor(None, _save_crc, link, computed_crc)
+                if crc is not None:
+                    raise ArchiveError('CRC-32 of %s does not match stored one' % link)
+            yield computed_crc
+
+    async def iter_range(self, start, end):
+        """
+        Yield bytes of archive range
+        """
+        plan = self.zip.plan(start, end, self._crcs)
+        semaphore = asyncio.Semaphore(settings.ISSUE_ARCHIVE_PREFETCH)
+        queues = [None if file_range is None else asyncio.Queue(maxsize=settings.ISSUE_ARCHIVE_BUFFER_CHUNKS)
+                  for file_range in plan]
+        # Semaphore wakes tasks in creation order, so file written to zip is always downloading or downloaded already
+        downloads = [asyncio.ensure_future(self._download(link, file_range, member.size, chunks, semaphore))
+                     for member, link, file_range, chunks in zip(self.zip.members, self._links, plan, queues)
+                     if chunks]
+        crcs = []
+        try:
+            for member, link, crc, offset, chunks, file_range in zip(self.zip.members, self._links, self._crcs,
+                                                                     self.zip.offsets, queues, plan):
+                header = self.zip.local_header(member)
+                yield slice_range(header, offset, start, end)
+                data_start = offset + len(header)
+                if chunks:
+                    async for chunk in self._stream_member(member, link, crc, chunks, file_range, data_start, start,
+                                                           end):
+                        if isinstance(chunk, int):
+                            crc = chunk
+                        else:
+                            yield chunk
+                crc = crc or 0
+                yield slice_range(self.zip.data_descriptor(member, crc), data_start + member.size, start, end)
+                crcs.append(crc)
+            yield slice_range(self.zip.central_directory(crcs), self.zip.central_directory_offset, start, end)
+        finally:
+            for download in downloads:
+                download.cancel()
+
+
+async def _send_status(send, status, headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_http_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if scope['method'] not in ('GET', 'HEAD'):
+        await _send_status(send, 405)
+        return
+    request_headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+    try:
+        token = parse_qs(scope['query_string'].decode('latin-1'))['token'][0]
+        manifest_key = signing.loads(token, salt=ASYNC_DOWNLOAD_SALT, max_age=settings.ASYNC_DOWNLOAD_TOKEN_MAX_AGE)
+    except (KeyError, signing.BadSignature):
+        await _send_status(send, 403)
+        return
+    try:
+        archive = AsyncArchive(await _read_manifest(manifest_key))
+    except ArchiveError:
+        # Manifest was deleted by delete_expired_download_manifests
+        await _send_status(send, 404)
+        return
+
+    byte_range = None
+    if request_headers.get('if-range', archive.etag) == archive.etag:
+        byte_range = parse_range(request_headers.get('range'), archive.size)
+    headers = [
+        (b'content-disposition', 'attachment; filename="{0}.zip"'.format(archive.filename).encode('utf-8')),
+        (b'accept-ranges', b'bytes'),
+        (b'etag', archive.etag.encode('latin-1'))
+    ]
+    if byte_range is False:
+        await _send_status(send, 416, headers + [(b'content-range', 'bytes */{0}'.format(archive.size).encode())])
+        return
+    if byte_range:
+        status = 206
+        start, end = byte_range
+        headers.append((b'content-range', 'bytes {0}-{1}/{2}'.format(start, end - 1, archive.size).encode()))
+    else:
+        status = 200
+        start, end = 0, archive.size
+    headers += [(b'content-type', b'application/zip'), (b'content-length', str(end - start).encode())]
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if scope['method'] == 'GET':
+        body = archive.iter_range(start, end)
+        try:
+            # Server awaits send until client accepts data, so download speed is limited by the slowest side
+            async for chunk in body:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        except ArchiveError:
+            # Response is not completed, so server closes connection and client can resume truncated download
+            logger.exception("Could not stream archive %s", manifest_key)
+            return
+        finally:
+            # Cancels prefetching when client disconnects
+            await body.aclose()
+    await send({'type': 'http.response.body', 'body': b''})
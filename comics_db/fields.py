@@ -1,12 +1,19 @@
 import os
 from io import BytesIO
+from urllib.parse import urlencode
 
 from PIL import Image
-from django.core import checks
+from django.apps import apps
+from django.conf import settings
+from django.core import checks, signing
 from django.core.files.base import ContentFile
 from django.db.models.fields.files import ImageField, ImageFieldFile
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.core.files.storage import default_storage
 
+from comics_db.s3 import copy_storage_file
+
 __author__ = 'nonameitem'
 
 
@@ -17,6 +24,81 @@ def _add_thumb(s):
     return '.'.join(parts)
 
 
+VARIANT_SIGNATURE_SALT = 'comics_db.fields.variant'
+
+# Variant formats: PIL format -> file extension
+VARIANT_FORMATS = {
+    'WEBP': 'webp',
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+
+
+def _add_variant(s, width, image_format):
+    parts = s.split('.')
+    parts.insert(-1, 'w{0}'.format(width))
+    parts[-1] = VARIANT_FORMATS[image_format]
+    return '.'.join(parts)
+
+
+def make_variant(storage, name, width, image_format):
+    """
+    Build resized copy of image and save it to storage. Image is never upscaled
+
+    :param storage: Django storage
+    :param name: source image name
+    :param width: variant width
+    :param image_format: PIL format name (one of VARIANT_FORMATS)
+    :return: saved variant name
+    """
+    with storage.open(name) as f:
+        img = Image.open(f)
+        img.load()
+
+    if img.width > width:
+        img = img.resize((width, int(width * img.height / img.width)), Image.ANTIALIAS)
+    if image_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    buffer = BytesIO()
+    img.save(buffer, image_format)
+    return storage.save(_add_variant(name, width, image_format), ContentFile(buffer.getvalue()))
+
+
+def get_thumbnail_fields():
+    """
+    :return: list of (model, ThumbnailImageField) tuples of all installed models
+    """
+    return [(model, field) for model in apps.get_models() for field in model._meta.get_fields()
+            if isinstance(field, ThumbnailImageField)]
+
+
+def variant_signature(name, width, image_format):
+    """
+    Signature of lazy variant URL. URLs are signed only for declared variants of images stored in ThumbnailImageField
+    fields, so variant generating view needs no lookup of source image and never generates other variants
+    """
+    return signing.Signer(salt=VARIANT_SIGNATURE_SALT).signature('{0}/{1}/{2}'.format(width, image_format, name))
+
+
+def check_variant_signature(name, width, image_format, signature):
+    return constant_time_compare(variant_signature(name, width, image_format), signature)
+
+
+def prefetch_variants(files):
+    """
+    Load variant manifests of several images with one query (e.g. for all images of list page)
+
+    :param files: iterable of ThumbnailImageFieldFile, empty files are skipped
+    """
+    from comics_db.models import ThumbnailVariant
+    files = [x for x in files if x]
+    manifests = ThumbnailVariant.get_manifests({x.name for x in files}) if files else {}
+    for f in files:
+        f._variants = manifests.get(f.name, {})
+        f._variants_source = f.name
+
+
 class ThumbnailImageFieldFile(ImageFieldFile):
     @property
     def thumb_name(self):
@@ -26,10 +108,73 @@ class ThumbnailImageFieldFile(ImageFieldFile):
     def thumb_url(self):
         return _add_thumb(self.url)
 
+    @property
+    def variants(self):
+        """
+        Manifest of generated variants: dict (width, format) -> variant name. Loaded by query on first access unless
+        prefetched with prefetch_variants
+        """
+        if getattr(self, '_variants_source', None) != self.name:
+            from comics_db.models import ThumbnailVariant
+            self._variants = ThumbnailVariant.get_manifest(self.name)
+            self._variants_source = self.name
+        return self._variants
+
+    def variant_url(self, width, image_format):
+        """
+        URL of image variant. Variants which are not generated yet are served by lazy generating view with signed URL,
+        undeclared variants are served by original image URL
+        """
+        name = self.variants.get((width, image_format))
+        if name:
+            return self.storage.url(name)
+        if (width, image_format) not in self.field.variants:
+            # Only declared variants are generated
+            return self.url
+        return '{0}?{1}'.format(reverse('thumbnail-variant', args=(width, image_format, self.name)),
+                                urlencode({'signature': variant_signature(self.name, width, image_format)}))
+
+    def srcset(self, image_format):
+        return ", ".join("{0} {1}w".format(self.variant_url(width, variant_format), width)
+                         for width, variant_format in self.field.variants if variant_format == image_format)
+
     def save(self, name, content, save=True):
+        # Thumbnail is built from content before saving, so saved file is not downloaded back from storage
+        content.seek(0)
+        thumb_file = self._make_thumb(content)
+        content.seek(0)
         super().save(name, content, save)
-        f = self.open()
-        img = Image.open(f)
+        self.storage.save(self.thumb_name, thumb_file)
+
+    def copy_from(self, source, save=True):
+        """
+        Reuse existing image (e.g. issue cover as title image). Image and its thumbnail are copied inside storage, on
+        S3 storages without transferring content. Thumbnail is rebuilt only if source field has other thumbnail size
+
+        :param source: ThumbnailImageFieldFile with saved file
+        :param save: save model instance
+        """
+        if source.storage is not self.storage:
+            with source.open() as content:
+                self.save(os.path.basename(source.name), content, save)
+            return
+
+        name = self.field.generate_filename(self.instance, os.path.basename(source.name))
+        self.name = copy_storage_file(self.storage, source.name, name)
+        setattr(self.instance, self.field.name, self.name)
+        self._committed = True
+
+        if (source.field.thumb_width, source.field.thumb_height) == (self.field.thumb_width, self.field.thumb_height):
+            copy_storage_file(self.storage, source.thumb_name, self.thumb_name)
+        else:
+            with source.open() as content:
+                self.storage.save(self.thumb_name, self._make_thumb(content))
+
+        if save:
+            self.instance.save()
+
+    def _make_thumb(self, content):
+        img = Image.open(content)
         image_format = img.format
 
         if self.field.thumb_width and self.field.thumb_height:
@@ -45,29 +190,60 @@ class ThumbnailImageFieldFile(ImageFieldFile):
 
         buffer = BytesIO()
         img.save(buffer, image_format)
-        thumb_file = ContentFile(buffer.getvalue())
-        self.storage.save(self.thumb_name, thumb_file)
+        return ContentFile(buffer.getvalue())
 
     def delete(self, save=True):
         if self.storage.exists(self.thumb_name):
             self.storage.delete(self.thumb_name)
+        if self.name:
+            from comics_db.models import ThumbnailVariant
+            ThumbnailVariant.delete_for(self.storage, self.name)
         super().delete(save)
 
 
 class ThumbnailImageField(ImageField):
     attr_class = ThumbnailImageFieldFile
 
-    def __init__(self, thumb_width=None, thumb_height=None, *args, **kwargs):
+    def __init__(self, thumb_width=None, thumb_height=None, variants=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.thumb_width = thumb_width
         self.thumb_height = thumb_height
+        self._variants = variants
+
+    @property
+    def variants(self):
+        """
+        Sizes and formats of lazily generated variants: tuple of (width, PIL format) tuples
+        """
+        return self._variants or settings.THUMBNAIL_VARIANTS
 
     def check(self, **kwargs):
         return [
             *super().check(**kwargs),
             *self._check_thumb_size_attributes(**kwargs),
+            *self._check_variants_attribute(**kwargs),
         ]
 
+    def _check_variants_attribute(self, **kwargs):
+        for width, image_format in self.variants:
+            if not isinstance(width, int) or isinstance(width, bool) or width <= 0:
+                return [
+                    checks.Error(
+                        "Variant width must be a positive integer.",
+                        obj=self,
+                        id='comics_db.E002',
+                    )
+                ]
+            if image_format not in VARIANT_FORMATS:
+                return [
+                    checks.Error(
+                        "Variant format must be one of {0}.".format(", ".join(VARIANT_FORMATS)),
+                        obj=self,
+                        id='comics_db.E003',
+                    )
+                ]
+        return []
+
     def _check_thumb_size_attributes(self, **kwargs):
         if self.thumb_width is None and self.thumb_height is None:
             return [
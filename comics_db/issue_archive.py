@@ -1,43 +1,687 @@
-import tempfile
-from zipfile import ZIP_DEFLATED
+import datetime
+import hashlib
+import io
+import json
+import math
+import os
+import queue
+import re
+import struct
+import threading
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
-import boto3
-import zipstream
 from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import F, Case, When, Value
+from django.utils import timezone
+
+from comics_db.models import Issue, ReadingListIssue, Title, ReadingList, ArchiveCacheEntry, CloudFilesManifestEntry
+from comics_db.s3 import get_client
 
 
 class S3FileWrapper:
     """
     Get S3 key and wraps it to iterator.
 
-    Class needed for downloading multiple issues and to postpone download of actual file until zip started
+    Class needed for downloading multiple issues and to postpone download of actual file until zip started. Object body
+    (or its byte range) is streamed by chunks, so file is never held in memory or on disk completely. If prefetch is
+    called, body is downloaded by executor thread into bounded chunk queue while previous files are written to zip
     """
 
-    def __init__(self, bucket, key):
-        self._bucket = bucket
+    def __init__(self, client, bucket_name, key, start=None, end=None):
+        """
+        :param start: first byte to read, whole object is read if not specified
+        :param end: byte after last one to read
+        """
+        self._client = client
+        self._bucket_name = bucket_name
         self.key = key
-        self.file = None
+        self._range = None if start is None else 'bytes={0}-{1}'.format(start, end - 1)
+        self._queue = queue.Queue(maxsize=settings.ISSUE_ARCHIVE_BUFFER_CHUNKS)
+        self._cancelled = threading.Event()
+        self._prefetched = False
+
+    def _iter_body(self):
+        params = {'Bucket': self._bucket_name, 'Key': self.key}
+        if self._range:
+            params['Range'] = self._range
+        body = self._client.get_object(**params)['Body']
+        try:
+            yield from body.iter_chunks(settings.ISSUE_ARCHIVE_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def _put(self, item):
+        """
+        Put item to queue, waiting for free space until download is cancelled
+
+        :return: False if download was cancelled
+        """
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _download(self):
+        if self._cancelled.is_set():
+            return
+        try:
+            for chunk in self._iter_body():
+                if not self._put(chunk):
+                    return
+            self._put(None)
+        except Exception as err:
+            self._put(err)
+
+    def prefetch(self, executor):
+        """
+        Start download in executor thread
+        """
+        self._prefetched = True
+        executor.submit(self._download)
+
+    def cancel(self):
+        self._cancelled.set()
 
     def get_file(self):
-        with tempfile.NamedTemporaryFile() as comics_file:
-            self.file = comics_file
-            self._bucket.download_fileobj(self.key, comics_file)
-            comics_file.seek(0)
-            yield comics_file.read()
+        if not self._prefetched:
+            yield from self._iter_body()
+            return
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            self.cancel()
+
+
+########################################################################################################################
+# Store-only zip layout
+########################################################################################################################
+_UTF8_FLAG = 0x800
+_DESCRIPTOR_FLAG = 0x08
+_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+_ZIP64_EXTRA_ID = 1
+_ZIP64_VERSION = 45
+_DEFAULT_VERSION = 20
+_MAX_UINT32 = 0xFFFFFFFF
+_MAX_UINT16 = 0xFFFF
+
+# Archive member: name in archive, file size and (year, month, day, hour, min, sec) tuple
+ArchiveMember = namedtuple('ArchiveMember', ['name', 'size', 'date_time'])
+# Issue file in bucket: size, S3 ETag and last modification datetime
+StoredObject = namedtuple('StoredObject', ['size', 'etag', 'last_modified'])
+
+
+class StoredZip:
+    """
+    Layout of zip archive with members stored without compression.
+
+    Member data is written as is and every member has data descriptor with CRC-32 after data, so layout (all offsets and
+    archive size) depends only on member names and sizes. The same member list always gives the same bytes, whether CRCs
+    were known before streaming or computed while streaming. Zip64 records are added only for members, offsets or
+    counts exceeding zip limits
+    """
+
+    def __init__(self, members):
+        """
+        :param members: list of ArchiveMember
+        """
+        self.members = members
+        self.offsets = []
+        offset = 0
+        for member in members:
+            self.offsets.append(offset)
+            offset += len(self.local_header(member)) + member.size + len(self.data_descriptor(member, 0))
+        self.central_directory_offset = offset
+        self.size = offset + len(self.central_directory([0] * len(members)))
+
+    @staticmethod
+    def _dos_date_time(date_time):
+        year, month, day, hour, minute, second = date_time
+        year = max(year, 1980)
+        return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+    @staticmethod
+    def _is_zip64(member):
+        return member.size >= zipfile.ZIP64_LIMIT
+
+    def local_header(self, member):
+        """
+        Local header. Sizes are known, so they are written to header too, CRC is written to data descriptor only
+        """
+        zip64 = self._is_zip64(member)
+        extra = struct.pack('<2H2Q', _ZIP64_EXTRA_ID, 16, member.size, member.size) if zip64 else b''
+        size = _MAX_UINT32 if zip64 else member.size
+        date, time = self._dos_date_time(member.date_time)
+        name = member.name.encode('utf-8')
+        return struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                           _ZIP64_VERSION if zip64 else _DEFAULT_VERSION, 0, _UTF8_FLAG | _DESCRIPTOR_FLAG,
+                           zipfile.ZIP_STORED, time, date, 0, size, size, len(name), len(extra)) + name + extra
+
+    def data_descriptor(self, member, crc):
+        if self._is_zip64(member):
+            return struct.pack('<4sL2Q', _DESCRIPTOR_SIGNATURE, crc, member.size, member.size)
+        return struct.pack('<4s3L', _DESCRIPTOR_SIGNATURE, crc, member.size, member.size)
+
+    def central_directory(self, crcs):
+        """
+        Central directory and end of central directory records
+
+        :param crcs: CRC-32 of all members
+        """
+        records = []
+        for member, offset, crc in zip(self.members, self.offsets, crcs):
+            zip64_values = []
+            if self._is_zip64(member):
+                zip64_values += [member.size, member.size]
+            if offset >= zipfile.ZIP64_LIMIT:
+                zip64_values.append(offset)
+            extra = b''
+            if zip64_values:
+                extra = struct.pack('<2H%dQ' % len(zip64_values), _ZIP64_EXTRA_ID, 8 * len(zip64_values),
+                                    *zip64_values)
+            version = _ZIP64_VERSION if zip64_values else _DEFAULT_VERSION
+            size = _MAX_UINT32 if self._is_zip64(member) else member.size
+            date, time = self._dos_date_time(member.date_time)
+            name = member.name.encode('utf-8')
+            records.append(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, version, 0, version, 0,
+                                       _UTF8_FLAG | _DESCRIPTOR_FLAG, zipfile.ZIP_STORED, time, date, crc, size, size,
+                                       len(name), len(extra), 0, 0, 0, 0, min(offset, _MAX_UINT32)) + name + extra)
+
+        central_directory = b''.join(records)
+        count = len(records)
+        size = len(central_directory)
+        offset = self.central_directory_offset
+        if count >= zipfile.ZIP_FILECOUNT_LIMIT or size >= zipfile.ZIP64_LIMIT or offset >= zipfile.ZIP64_LIMIT:
+            central_directory += struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64, 44,
+                                             _ZIP64_VERSION, _ZIP64_VERSION, 0, 0, count, count, size, offset)
+            central_directory += struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator, 0,
+                                             offset + size, 1)
+        return central_directory + struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0,
+                                               min(count, _MAX_UINT16), min(count, _MAX_UINT16),
+                                               min(size, _MAX_UINT32), min(offset, _MAX_UINT32), 0)
+
+    def plan(self, start, end, crcs):
+        """
+        Get byte range of every member file needed for archive range. Files with unknown CRC are read completely when
+        range includes their data descriptor or central directory
+
+        :param crcs: known CRC-32 of members, None if not known
+        :return: list of (file start, file end) tuples, None for files which are not read
+        """
+        plan = []
+        needs_central_directory = end > self.central_directory_offset
+        for member, offset, crc in zip(self.members, self.offsets, crcs):
+            data_start = offset + len(self.local_header(member))
+            data_end = data_start + member.size
+            needs_descriptor = needs_central_directory or (start < data_end + len(self.data_descriptor(member, 0))
+                                                           and end > data_end)
+            if not member.size:
+                plan.append(None)
+            elif crc is None and needs_descriptor:
+                plan.append((0, member.size))
+            elif start < data_end and end > data_start:
+                plan.append((max(start - data_start, 0), min(end - data_start, member.size)))
+            else:
+                plan.append(None)
+        return plan
+
+
+def slice_range(data, offset, start, end):
+    """
+    Part of data located at offset in archive, which is inside [start, end) archive range
+    """
+    return data[max(start - offset, 0):max(end - offset, 0)]
+
+
+ASYNC_DOWNLOAD_SALT = 'comics_db.download_service'
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Parse Range header with single byte range
+
+    :param header: Range header value
+    :param size: size of archive
+    :return: (start, end) tuple, None if header is missing or not supported (whole archive should be returned) or False
+    if range is not satisfiable
+    """
+    match = _RANGE_RE.match((header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        if not int(last):
+            return False
+        return max(size - int(last), 0), size
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        return False
+    return int(first), min(int(last) + 1, size) if last else size
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class MemberStream:
+    """
+    Checks member file read by chunks against its planned byte range and computes CRC-32 of completely read file. File
+    changed after archive was planned never writes past planned range, so archive layout is not broken
+    """
+
+    def __init__(self, member, link, file_range, data_start):
+        """
+        :param member: ArchiveMember
+        :param link: issue file key, for error messages
+        :param file_range: (file start, file end) tuple from StoredZip.plan
+        :param data_start: offset of member data in archive
+        """
+        self._link = link
+        self._file_start, self._file_end = file_range
+        self._whole_file = file_range == (0, member.size)
+        self._data_start = data_start
+        self.position = self._file_start
+        self._crc = 0
+
+    def _range_error(self):
+        return ArchiveError('Could not read bytes {0}-{1} of {2}'.format(self._file_start, self._file_end, self._link))
+
+    def feed(self, chunk, start, end):
+        """
+        :return: part of chunk inside [start, end) archive range
+        """
+        offset = self._data_start + self.position
+        self.position += len(chunk)
+        if self.position > self._file_end:
+            raise self._range_error()
+        if self._whole_file:
+            self._crc = zlib.crc32(chunk, self._crc)
+        return slice_range(chunk, offset, start, end)
+
+    def finish(self):
+        """
+        :return: CRC-32 of file, None if only part of file was read
+        """
+        if self.position != self._file_end:
+            raise self._range_error()
+        return self._crc if self._whole_file else None
+
+
+class IssueArchive:
+    """
+    Zip stream of issue files. Issue files are already compressed, so they are stored as is: archive size is known
+    before streaming (see StoredZip) and web worker spends no CPU on compression. Layout depends only on issue list, so
+    any byte range of archive can be built from byte ranges of issue files, and interrupted download can be resumed.
+
+    Files are downloaded with ISSUE_ARCHIVE_PREFETCH threads: while one file is written to zip, next ones are prefetched
+    into bounded buffers, so memory usage does not depend on file sizes or count. Downloads start when archive is
+    iterated and are cancelled when it is closed.
+
+    CRC-32 of completely streamed files are saved to issues. Files with unknown CRC are read completely when range
+    includes their data descriptor or central directory
+    """
+
+    def __init__(self, issues):
+        """
+        :param issues: list of (file name in zip, Issue) tuples in stable order
+        """
+        self.client = get_client()
+        self._issues = [issue for _, issue in issues]
+        self._objects = self._get_objects(self._issues)
+        self.zip = StoredZip([
+            ArchiveMember(name, self._objects[issue.link].size, self._objects[issue.link].last_modified.timetuple()[:6])
+            for name, issue in issues
+        ])
+        self._files = []
+        self._executor = None
+
+    @property
+    def size(self):
+        return self.zip.size
+
+    @property
+    def cache_key(self):
+        """
+        Key of archive in archive cache, the same as ETag without quotes
+        """
+        return self.etag.strip('"')
+
+    @property
+    def etag(self):
+        """
+        ETag of archive. Changes when any issue file is changed, so resumed download is never mixed from different
+        files. Issue metadata changes do not affect archive bytes, so they keep ETag
+        """
+        state = hashlib.md5()
+        for member, issue in zip(self.zip.members, self._issues):
+            state.update('{0}\0{1}\0{2}\0{3}\0'.format(member.name, member.size, issue.link,
+                                                       self._objects[issue.link].etag).encode('utf-8'))
+        return '"{0}"'.format(state.hexdigest())
+
+    def manifest(self, filename):
+        """
+        Manifest of archive for async download service (see download_service)
+
+        :param filename: downloaded file name without extension
+        """
+        return {
+            'filename': str(filename),
+            'etag': self.etag,
+            'members': [[member.name, member.size, member.date_time, issue.link, issue.file_crc32]
+                        for member, issue in zip(self.zip.members, self._issues)]
+        }
+
+    def _get_objects(self, issues):
+        """
+        State of issue files: ETag and modification time are taken from cloud files manifest, files missing from it
+        are requested from S3. File size requested from S3 is saved to issue
+
+        :return: dict of StoredObject by issue link
+        """
+        manifest = {
+            key: (etag, last_modified) for key, etag, last_modified in CloudFilesManifestEntry.objects.filter(
+                key__in=[x.link for x in issues]
+            ).exclude(etag='').values_list('key', 'etag', 'last_modified')
+        }
+        objects = {}
+        for issue in issues:
+            if issue.link in manifest and issue.file_size is not None:
+                objects[issue.link] = StoredObject(issue.file_size, *manifest[issue.link])
+                continue
+            head = self.client.head_object(Bucket=settings.DO_STORAGE_BUCKET_NAME, Key=issue.link)
+            objects[issue.link] = StoredObject(head['ContentLength'], head['ETag'], head['LastModified'])
+            if issue.file_size is None:
+                issue.file_size = head['ContentLength']
+                issue.save(update_fields=['file_size'])
+        return objects
+
+    def _stream_member(self, member, issue, f, file_range, data_start, start, end):
+        """
+        Yield part of member data inside archive range
+
+        :return: CRC-32 of file
+        """
+        stream = MemberStream(member, issue.link, file_range, data_start)
+        for chunk in f.get_file():
+            yield stream.feed(chunk, start, end)
+        crc = stream.finish()
+        if crc is None:
+            return issue.file_crc32
+        if crc != issue.file_crc32:
+            Issue.objects.filter(id=issue.id).update(file_crc32=crc)
+            if issue.file_crc32 is not None:
+                raise ArchiveError('CRC-32 of %s does not match stored one' % issue.link)
+        return crc
+
+    def iter_range(self, start=0, end=None):
+        """
+        Yield bytes of archive range
+
+        :param start: first byte
+        :param end: byte after last one, archive end if not specified
+        """
+        end = self.size if end is None else end
+        for chunk in self._iter_range(start, end):
+            if chunk:
+                yield chunk
+
+    def _iter_range(self, start, end):
+        plan = self.zip.plan(start, end, [issue.file_crc32 for issue in self._issues])
+        self._executor = ThreadPoolExecutor(max_workers=settings.ISSUE_ARCHIVE_PREFETCH)
+        self._files = [None if file_range is None else
+                       S3FileWrapper(self.client, settings.DO_STORAGE_BUCKET_NAME, issue.link, *file_range)
+                       for issue, file_range in zip(self._issues, plan)]
+        # Executor runs files in order, so file written to zip is always downloading or downloaded already
+        for f in self._files:
+            if f:
+                f.prefetch(self._executor)
+        crcs = []
+        try:
+            for member, issue, offset, f, file_range in zip(self.zip.members, self._issues, self.zip.offsets,
+                                                            self._files, plan):
+                header = self.zip.local_header(member)
+                yield slice_range(header, offset, start, end)
+                data_start = offset + len(header)
+                crc = issue.file_crc32
+                if f:
+                    crc = yield from self._stream_member(member, issue, f, file_range, data_start, start, end)
+                # CRC of empty file is 0. CRC of file which was not read is not known, but is not needed in range too
+                crc = crc or 0
+                yield slice_range(self.zip.data_descriptor(member, crc), data_start + member.size, start, end)
+                crcs.append(crc)
+            yield slice_range(self.zip.central_directory(crcs), self.zip.central_directory_offset, start, end)
+        finally:
+            self.close()
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def close(self):
+        for f in self._files:
+            if f:
+                f.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False)
 
 
 def construct_archive(issues):
-    session = boto3.session.Session()
-    s3 = session.resource('s3', region_name=settings.DO_REGION_NAME,
-                          endpoint_url=settings.DO_ENDPOINT_URL,
-                          aws_access_key_id=settings.DO_KEY_ID,
-                          aws_secret_access_key=settings.DO_SECRET_ACCESS_KEY)
-    bucket = s3.Bucket(settings.DO_STORAGE_BUCKET_NAME)
+    """
+    :param issues: list of (file name in zip, Issue) tuples in stable order
+    :return: IssueArchive
+    """
+    return IssueArchive(issues)
+
+
+def get_async_download_url(archive, filename):
+    """
+    Save archive manifest to bucket and get URL of archive in async download service. Manifest key is derived from
+    archive ETag, so the same archive always has the same manifest
+
+    :param archive: IssueArchive
+    :param filename: downloaded file name without extension
+    :return: URL with signed manifest key
+    """
+    manifest_key = '{0}{1}.json'.format(settings.ASYNC_DOWNLOAD_MANIFEST_PREFIX, archive.cache_key)
+    archive.client.put_object(Bucket=settings.DO_STORAGE_BUCKET_NAME, Key=manifest_key,
+                              Body=json.dumps(archive.manifest(filename)).encode('utf-8'),
+                              ContentType='application/json')
+    return '{0}?{1}'.format(settings.ASYNC_DOWNLOAD_URL,
+                            urlencode({'token': signing.dumps(manifest_key, salt=ASYNC_DOWNLOAD_SALT)}))
+
+
+def delete_expired_download_manifests():
+    """
+    Delete async download manifests which are older than download URL lifetime. Manifest is rewritten by every download
+    of its archive, so manifests of archives downloaded recently are kept
+
+    :return: number of deleted manifests
+    """
+    client = get_client()
+    expired = timezone.now() - datetime.timedelta(seconds=settings.ASYNC_DOWNLOAD_TOKEN_MAX_AGE)
+    deleted = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=settings.DO_STORAGE_BUCKET_NAME,
+                                   Prefix=settings.ASYNC_DOWNLOAD_MANIFEST_PREFIX):
+        keys = [{'Key': x['Key']} for x in page.get('Contents', []) if x['LastModified'] < expired]
+        if keys:
+            client.delete_objects(Bucket=settings.DO_STORAGE_BUCKET_NAME, Delete={'Objects': keys, 'Quiet': True})
+            deleted += len(keys)
+    return deleted
+
+
+def get_title_archive_issues(title):
+    """
+    :return: list of (file name in zip, Issue) tuples for title download
+    """
+    return [("{0}/[{0.name}] {1}.{2}".format(title, x.name, os.path.splitext(x.link)[1]), x)
+            for x in title.issues.order_by('number', 'id')]
 
-    z = zipstream.ZipFile(mode='w', compression=ZIP_DEFLATED, allowZip64=True)
 
-    for issue in issues:
-        f = S3FileWrapper(bucket, issue[1])
-        z.write_iter(issue[0], f.get_file())
+def get_reading_list_archive_issues(reading_list):
+    """
+    :return: list of (file name in zip, Issue) tuples for reading list download
+    """
+    queryset = ReadingListIssue.objects.filter(reading_list=reading_list).select_related('issue', 'issue__title')
+
+    if reading_list.sorting == 'MANUAL':
+        queryset = queryset.order_by('order', 'id')
+        num_length = math.ceil(math.log10(queryset.count()))
+
+        return [
+            (
+                "{list_name}/{num} - [{issue.title.name}]{issue.name}.{issue_ext}".format(
+                    list_name=reading_list,
+                    num=str(num).rjust(num_length, '0'),
+                    issue=rl_issue.issue,
+                    issue_ext=os.path.splitext(rl_issue.issue.link)[1]
+                ),
+                rl_issue.issue
+            )
+            for num, rl_issue in enumerate(queryset, 1)
+        ]
+
+    return [
+        (
+            "{list_name}/{title}/[{title.name}]{issue_name}.{issue_ext}".format(
+                list_name=reading_list,
+                title=rl_issue.issue.title,
+                issue_name=rl_issue.issue.name,
+                issue_ext=os.path.splitext(rl_issue.issue.link)[1]
+            ),
+            rl_issue.issue
+        )
+        for rl_issue in queryset.order_by('id')
+    ]
+
+
+########################################################################################################################
+# Pre-built archive cache
+########################################################################################################################
+class _IteratorReader(io.RawIOBase):
+    """
+    Readable raw stream over iterator of bytes, for uploading archive stream with boto3 upload_fileobj
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iter(iterator)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._iterator)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _cache_object_key(cache_key):
+    return '{0}{1}.zip'.format(settings.ARCHIVE_CACHE_PREFIX, cache_key)
+
+
+def get_cached_archive(kind, object_id, archive, filename):
+    """
+    Register download of title or reading list archive in archive cache
+
+    Downloads are counted per issue set: when cache key of archive changes (issue added, removed or changed), cached
+    archive is invalidated and counter is reset. Archive should be built when it is downloaded
+    ARCHIVE_CACHE_MIN_DOWNLOADS times
+
+    :param kind: ArchiveCacheEntry kind
+    :param object_id: title or reading list id
+    :param archive: IssueArchive
+    :param filename: downloaded file name without extension
+    :return: tuple (url, build). url is signed URL of cached archive or None if there is no actual one, build is True
+    if archive_cache_task should be started
+    """
+    if not settings.ARCHIVE_CACHE_BUCKET_NAME:
+        return None, False
+    cache_key = archive.cache_key
+    entry, _ = ArchiveCacheEntry.objects.get_or_create(kind=kind, object_id=object_id)
+    entries = ArchiveCacheEntry.objects.filter(id=entry.id)
+    if entry.cache_key != cache_key:
+        with transaction.atomic():
+            locked = entries.select_for_update().get()
+            old_object_key = ''
+            if locked.cache_key != cache_key:
+                old_object_key = locked.object_key
+                # Queued or running build will read actual issues anyway
+                entries.update(cache_key=cache_key, object_key='', downloads=0,
+                               status=Case(When(status='READY', then=Value('NEW')), default=F('status')))
+        if old_object_key:
+            # Archive of previous issue set is never served again
+            archive.client.delete_object(Bucket=settings.ARCHIVE_CACHE_BUCKET_NAME, Key=old_object_key)
+    entries.update(downloads=F('downloads') + 1, last_download=timezone.now())
+
+    if entry.status == 'READY' and entry.cache_key == cache_key:
+        url = archive.client.generate_presigned_url('get_object', Params={
+            'Bucket': settings.ARCHIVE_CACHE_BUCKET_NAME,
+            'Key': entry.object_key,
+            'ResponseContentDisposition': "attachment; filename=\"{0}.zip\"".format(filename)
+        }, ExpiresIn=settings.ARCHIVE_CACHE_URL_EXPIRES)
+        return url, False
+
+    # Only one download queues build
+    build = entries.filter(downloads__gte=settings.ARCHIVE_CACHE_MIN_DOWNLOADS,
+                           status__in=('NEW', 'ERROR')).update(status='QUEUE')
+    return None, bool(build)
+
+
+def build_cached_archive(kind, object_id):
+    """
+    Build archive of title or reading list and upload it to archive cache. Previous archive of the same title or
+    reading list is deleted.
+
+    Only build fields are updated, so download counter and issue set changed by concurrent downloads are kept. If issue
+    set was changed while archive was built, built archive is deleted and entry can be queued for build again
+    """
+    entries = ArchiveCacheEntry.objects.filter(kind=kind, object_id=object_id)
+    start_cache_key = entries.values_list('cache_key', flat=True).get()
+    entries.update(status='BUILDING', error='')
+    try:
+        if kind == 'TITLE':
+            issues = get_title_archive_issues(Title.objects.get(id=object_id))
+        else:
+            issues = get_reading_list_archive_issues(ReadingList.objects.get(id=object_id))
+        archive = IssueArchive(issues)
+        object_key = _cache_object_key(archive.cache_key)
+        archive.client.upload_fileobj(io.BufferedReader(_IteratorReader(archive),
+                                                        buffer_size=settings.ISSUE_ARCHIVE_CHUNK_SIZE),
+                                      settings.ARCHIVE_CACHE_BUCKET_NAME, object_key)
+    except Exception as err:
+        entries.update(status='ERROR', error=str(err))
+        raise
 
-    return z
+    with transaction.atomic():
+        entry = entries.select_for_update().get()
+        registered = entry.cache_key in (start_cache_key, archive.cache_key)
+        if registered:
+            entries.update(cache_key=archive.cache_key, object_key=object_key, status='READY', built=timezone.now())
+        else:
+            entries.filter(status='BUILDING').update(status='NEW')
+    # Replaced archive or archive of outdated issue set
+    stale_object_key = entry.object_key if registered else object_key
+    if stale_object_key and entry.object_key != object_key:
+        archive.client.delete_object(Bucket=settings.ARCHIVE_CACHE_BUCKET_NAME, Key=stale_object_key)
@@ -0,0 +1,176 @@
+"""
+Serving single issue pages from comics archives stored in cloud.
+
+Pages of CBZ issues with page index are read directly by local header offset with one ranged request. Other archives
+are opened and kept in per-process LRU cache, so reading next page of the same issue needs only ranged requests for page
+data (CBZ) or no requests at all (other formats, which are downloaded completely to temporary file on open). Cache is
+limited by memory kept by opened archives, e.g. decompressed files of 7z archives.
+"""
+import tempfile
+import threading
+
+from cachetools import LRUCache
+from django.db import transaction
+
+from comics_db.models import Issue
+from comics_db.reader import ComicsReader, file_type, image_size, read_indexed_page, CBZ
+from comics_db.s3 import S3RangeFile, get_client
+from comicsdb import settings
+
+
+class ArchiveClosedError(Exception):
+    pass
+
+
+class OpenedArchive:
+    """
+    Comics archive opened for reading pages. Pages of one archive are read under lock, because archive readers share
+    one file position
+    """
+
+    def __init__(self, client, bucket_name, key, size=None):
+        self._file = S3RangeFile(client, bucket_name, key, size)
+        if file_type(self._file) != CBZ:
+            # Only zip can be read with ranged requests
+            self._file.close()
+            self._file = tempfile.TemporaryFile()
+            client.download_fileobj(bucket_name, key, self._file)
+            self._file.seek(0)
+        self._reader = ComicsReader(self._file)
+        self._lock = threading.Lock()
+        self.closed = False
+        self.cached = False
+        if isinstance(self._file, S3RangeFile):
+            self.memory_size = S3RangeFile.CACHED_BLOCKS * S3RangeFile.DEFAULT_BLOCK_SIZE
+        else:
+            # Downloaded archive is kept in temporary file, but reader can keep decompressed files in memory (7z)
+            self.memory_size = self._reader.memory_size
+
+    @property
+    def pages(self):
+        return self._reader.get_file_list()
+
+    def read_page(self, page_number):
+        """
+        :return: (page file name, page content) tuple
+        :raises IndexError: if there is no page with such number
+        :raises ArchiveClosedError: if archive was evicted from cache and closed
+        """
+        with self._lock:
+            if self.closed:
+                raise ArchiveClosedError()
+            name = self._reader.get_file_list()[page_number]
+            with self._reader.get_page_file(page_number) as page:
+                return name, page.read()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._reader.close()
+            self._file.close()
+
+
+class ArchiveCache(LRUCache):
+    """
+    LRU cache of opened archives, which closes archives on eviction. Cache is limited by total memory size of archives
+    (maxsize) and by count of archives (maxcount), which are kept in temporary files or keep connections
+    """
+
+    def __init__(self, maxsize, maxcount):
+        super().__init__(maxsize, getsizeof=lambda archive: archive.memory_size)
+        self.maxcount = maxcount
+
+    def __setitem__(self, key, value):
+        while key not in self and len(self) >= self.maxcount:
+            self.popitem()
+        super().__setitem__(key, value)
+
+    def popitem(self):
+        key, archive = super().popitem()
+        archive.close()
+        return key, archive
+
+
+_lock = threading.Lock()
+_archives = ArchiveCache(maxsize=settings.ISSUE_PAGE_CACHE_MEMORY, maxcount=settings.ISSUE_PAGE_CACHE_SIZE)
+
+
+def get_archive(issue):
+    """
+    Get opened archive of issue from cache or open it. Archive is reopened when issue is modified. Archive which is
+    larger than whole cache is not cached and should be closed by caller
+
+    :param issue: Issue
+    :return: OpenedArchive
+    """
+    key = (issue.link, issue.modified_dt)
+    with _lock:
+        archive = _archives.get(key)
+    if archive is None:
+        archive = OpenedArchive(get_client(), settings.DO_STORAGE_BUCKET_NAME, issue.link, issue.file_size)
+        if archive.memory_size > _archives.maxsize:
+            return archive
+        with _lock:
+            if key in _archives:
+                # Opened by concurrent request
+                archive.close()
+                archive = _archives[key]
+            else:
+                _archives[key] = archive
+                archive.cached = True
+    return archive
+
+
+def _read_archive_page(issue, page_number):
+    archive = get_archive(issue)
+    try:
+        return archive.read_page(page_number)
+    finally:
+        if not archive.cached:
+            archive.close()
+
+
+def _save_page_size(issue, page_number, name, content):
+    """
+    Save image dimensions of page to page index. Index is re-read under row lock, so dimensions saved by concurrent
+    requests are kept and index rebuilt by parser is not overwritten
+    """
+    width, height = image_size(content)
+    if width is None:
+        return
+    with transaction.atomic():
+        page_index = Issue.objects.select_for_update().values_list('page_index', flat=True).get(id=issue.id)
+        if not page_index or page_number >= len(page_index) or page_index[page_number]['name'] != name:
+            return
+        page_index[page_number].update(width=width, height=height)
+        Issue.objects.filter(id=issue.id).update(page_index=page_index)
+    issue.page_index = page_index
+
+
+def _read_page(issue, page_number):
+    if issue.page_index:
+        entry = issue.page_index[page_number]
+        if entry.get('offset') is not None:
+            comics_file = S3RangeFile(get_client(), settings.DO_STORAGE_BUCKET_NAME, issue.link, issue.file_size)
+            return entry['name'], read_indexed_page(comics_file.read_range, entry)
+    try:
+        return _read_archive_page(issue, page_number)
+    except ArchiveClosedError:
+        return _read_archive_page(issue, page_number)
+
+
+def read_page(issue, page_number):
+    """
+    Read one page of issue. Image dimensions of page are saved to page index when page is read first time
+
+    :param issue: Issue
+    :param page_number: page number starting from 0
+    :return: (page file name, page content) tuple
+    :raises IndexError: if there is no page with such number
+    """
+    if page_number < 0:
+        raise IndexError(page_number)
+    name, content = _read_page(issue, page_number)
+    if issue.page_index and issue.page_index[page_number].get('width') is None:
+        _save_page_size(issue, page_number, name, content)
+    return name, content
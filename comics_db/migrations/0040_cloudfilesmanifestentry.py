@@ -0,0 +1,25 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0039_auto_20190813_1720'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloudFilesManifestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1000, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('etag', models.CharField(max_length=100)),
+                ('last_modified', models.DateTimeField()),
+                ('parser_run', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='manifest_entries', to='comics_db.ParserRun')),
+            ],
+        ),
+    ]
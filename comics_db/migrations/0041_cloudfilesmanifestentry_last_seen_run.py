@@ -0,0 +1,19 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0040_cloudfilesmanifestentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cloudfilesmanifestentry',
+            name='last_seen_run',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comics_db.ParserRun'),
+        ),
+    ]
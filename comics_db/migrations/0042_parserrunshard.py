@@ -0,0 +1,33 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0041_cloudfilesmanifestentry_last_seen_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParserRunShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.TextField()),
+                ('recursive', models.BooleanField(default=True)),
+                ('start', models.DateTimeField(null=True)),
+                ('end', models.DateTimeField(null=True)),
+                ('status', models.CharField(choices=[('COLLECTING', 'Collecting data'), ('RUNNING', 'Running'), ('SUCCESS', 'Successfully ended'), ('ENDED_WITH_ERRORS', 'Ended with errors'), ('API_THROTTLE', 'API rate limit has been surpassed.'), ('CRITICAL_ERROR', 'Critical Error'), ('INVALID_PARSER', 'Invalid parser implementation'), ('QUEUE', 'In queue')], default='QUEUE', max_length=30)),
+                ('items_count', models.IntegerField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('error_detail', models.TextField(blank=True)),
+                ('celery_task_id', models.CharField(max_length=100, null=True)),
+                ('parser_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='comics_db.ParserRun')),
+            ],
+            options={
+                'ordering': ['parser_run', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0042_parserrunshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('width', models.IntegerField()),
+                ('format', models.CharField(max_length=10)),
+                ('name', models.CharField(max_length=255)),
+            ],
+            options={
+                'unique_together': {('source', 'width', 'format')},
+            },
+        ),
+    ]
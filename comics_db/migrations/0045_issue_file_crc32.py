@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0044_issue_page_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issue',
+            name='file_crc32',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
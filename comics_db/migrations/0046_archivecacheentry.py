@@ -0,0 +1,31 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0045_issue_file_crc32'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('TITLE', 'Title'), ('READING_LIST', 'Reading list')], max_length=30)),
+                ('object_id', models.IntegerField()),
+                ('cache_key', models.CharField(blank=True, max_length=64)),
+                ('object_key', models.CharField(blank=True, max_length=200)),
+                ('status', models.CharField(choices=[('NEW', 'Not built'), ('QUEUE', 'Queued'), ('BUILDING', 'Building'), ('READY', 'Ready'), ('ERROR', 'Error')], default='NEW', max_length=30)),
+                ('downloads', models.IntegerField(default=0)),
+                ('last_download', models.DateTimeField(null=True)),
+                ('built', models.DateTimeField(null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+    ]
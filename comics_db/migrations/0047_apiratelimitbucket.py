@@ -0,0 +1,23 @@
+# Generated by Django 2.2.4 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0046_archivecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='APIRateLimitBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('tokens', models.FloatField(null=True)),
+                ('updated', models.FloatField(null=True)),
+                ('calls', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.4 on 2026-10-18 11:41
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comics_db', '0048_parserrun_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parserrun',
+            name='rate_limit',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -4,7 +4,8 @@ from time import sleep
 import botocore
 import django_s3_storage
 import requests
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.db import models, IntegrityError
 from django.db.models.aggregates import Sum
 from django.shortcuts import render
 from django.template.loader import render_to_string
@@ -16,7 +17,7 @@ from django.utils.text import slugify
 from knox.models import AuthToken
 
 from comicsdb import settings
-from comics_db.fields import ThumbnailImageField
+from comics_db.fields import ThumbnailImageField, get_thumbnail_fields, make_variant
 
 
 # Create your models here.
@@ -34,6 +35,40 @@ def unique_slugify(klass, value, pk, counter=0, allow_unicode=True):
         return slug
 
 
+def bulk_unique_slugify(klass, values, allow_unicode=True):
+    """
+    Batch version of unique_slugify for objects which are not saved yet.
+
+    Resolves collisions with existing records and between values themselves with one query per counter step
+    :param klass: model class
+    :param values: list of strings to make slugs from
+    :return: list of slugs in the same order as values
+    """
+    slugs = [None] * len(values)
+    taken = set()
+    pending = list(enumerate(values))
+    counter = 0
+    while pending:
+        candidates = {}
+        for i, value in pending:
+            if counter > 0:
+                candidates[i] = slugify("{0}-{1}".format(value, counter), allow_unicode)
+            else:
+                candidates[i] = slugify(value, allow_unicode)
+        taken.update(klass.objects.filter(slug__in=set(candidates.values())).values_list('slug', flat=True))
+
+        collisions = []
+        for i, value in pending:
+            if candidates[i] in taken:
+                collisions.append((i, value))
+            else:
+                slugs[i] = candidates[i]
+                taken.add(candidates[i])
+        pending = collisions
+        counter += 1
+    return slugs
+
+
 ########################################################################################################################
 # Parsers
 ########################################################################################################################
@@ -61,6 +96,10 @@ class ParserRun(models.Model):
         ("QUEUE", "In queue")
     )
 
+    # Parsers saving checkpoints, their failed runs are continued from the last checkpoint
+    RESUMABLE_PARSERS = ("MARVEL_API",)
+    FAILED_STATUSES = ("API_THROTTLE", "CRITICAL_ERROR", "INVALID_PARSER")
+
     parser = models.CharField(max_length=30, choices=PARSER_CHOICES, default=PARSER_CHOICES[0][0])
     start = models.DateTimeField(default=timezone.now)
     end = models.DateTimeField(null=True)
@@ -69,6 +108,8 @@ class ParserRun(models.Model):
     error = models.TextField(blank=True)
     error_detail = models.TextField(blank=True)
     celery_task_id = models.CharField(max_length=100, null=True)
+    checkpoints = JSONField(default=dict, blank=True)  # Progress of resumable parser stages, see MarvelAPIParser
+    rate_limit = JSONField(null=True, blank=True)  # API quota status (see RateScheduler.status), see MarvelAPIParser
 
     @property
     def parser_name(self):
@@ -78,6 +119,10 @@ class ParserRun(models.Model):
     def status_name(self):
         return self.get_status_display()
 
+    @property
+    def resumable(self):
+        return self.parser in self.RESUMABLE_PARSERS and self.status in self.FAILED_STATUSES
+
     @property
     def run_details_url(self):
         if self.parser == 'CLOUD_FILES':
@@ -171,6 +216,30 @@ class ParserRunParams(models.Model):
         ordering = ["id"]
 
 
+class ParserRunShard(models.Model):
+    """
+    Part of parser run processed by separate Celery task. Sharded runs store run details in parent run, shard keeps
+    only own state, which is aggregated to parent run when all shards end
+    """
+    parser_run = models.ForeignKey(ParserRun, on_delete=models.CASCADE, related_name="shards")
+    prefix = models.TextField()
+    recursive = models.BooleanField(default=True)
+    start = models.DateTimeField(null=True)
+    end = models.DateTimeField(null=True)
+    status = models.CharField(max_length=30, choices=ParserRun.STATUS_CHOICES, default="QUEUE")
+    items_count = models.IntegerField(null=True)
+    error = models.TextField(blank=True)
+    error_detail = models.TextField(blank=True)
+    celery_task_id = models.CharField(max_length=100, null=True)
+
+    @property
+    def status_name(self):
+        return self.get_status_display()
+
+    class Meta:
+        ordering = ["parser_run", "id"]
+
+
 class ParserRunDetail(models.Model):
     STATUS_CHOICES = (
         ("RUNNING", "Running"),
@@ -185,17 +254,19 @@ class ParserRunDetail(models.Model):
     error = models.TextField(blank=True)
     error_detail = models.TextField(blank=True)
 
-    def end_with_error(self, error, error_detail=""):
+    def end_with_error(self, error, error_detail="", save=True):
         self.status = "ERROR"
         self.end = timezone.now()
         self.error = error
         self.error_detail = error_detail
-        self.save()
+        if save:
+            self.save()
 
-    def end_with_success(self):
+    def end_with_success(self, save=True):
         self.status = "SUCCESS"
         self.end = timezone.now()
-        self.save()
+        if save:
+            self.save()
 
     @property
     def status_name(self):
@@ -220,6 +291,37 @@ class CloudFilesParserRunDetail(ParserRunDetail):
             return None
 
 
+class CloudFilesManifestEntry(models.Model):
+    """
+    Bucket object state at the moment it was successfully processed by cloud files parser.
+
+    Used by parser to process only added, changed and removed keys
+    """
+    key = models.CharField(max_length=1000, unique=True)
+    size = models.BigIntegerField()
+    etag = models.CharField(max_length=100)
+    last_modified = models.DateTimeField()
+    parser_run = models.ForeignKey(ParserRun, null=True, on_delete=models.SET_NULL, related_name="manifest_entries")
+    last_seen_run = models.ForeignKey(ParserRun, null=True, on_delete=models.SET_NULL, related_name="+")
+
+    def __str__(self):
+        return self.key
+
+
+class APIRateLimitBucket(models.Model):
+    """
+    Token bucket state of API rate scheduler (see marvel_api_wrapper.rate_limit) shared by all worker processes.
+    Empty tokens mean bucket was not used yet
+    """
+    name = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField(null=True)
+    updated = models.FloatField(null=True)
+    calls = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
 class MarvelAPIParserRunDetail(ParserRunDetail):
     ENTITY_TYPE_CHOICES = (
         ("COMICS", "Comics"),
@@ -343,6 +445,91 @@ MARVEL_API_STATUS_CHOICES = (
 )
 
 
+class ThumbnailVariant(models.Model):
+    """
+    Manifest of image variants generated for ThumbnailImageField files
+    """
+    source = models.CharField(max_length=255)
+    width = models.IntegerField()
+    format = models.CharField(max_length=10)
+    name = models.CharField(max_length=255)
+
+    @classmethod
+    def get_manifest(cls, source):
+        """
+        :return: dict (width, format) -> variant name
+        """
+        return {(x.width, x.format): x.name for x in cls.objects.filter(source=source)}
+
+    @classmethod
+    def get_manifests(cls, sources):
+        """
+        :return: dict source -> manifest of source, sources without variants are omitted
+        """
+        manifests = {}
+        for x in cls.objects.filter(source__in=sources):
+            manifests.setdefault(x.source, {})[(x.width, x.format)] = x.name
+        return manifests
+
+    @classmethod
+    def get_or_create_variant(cls, storage, source, width, image_format):
+        """
+        Get variant name from manifest. If variant does not exist, it is generated and saved to storage
+        :return: variant name
+        """
+        variant = cls.objects.filter(source=source, width=width, format=image_format).first()
+        if variant:
+            return variant.name
+        name = make_variant(storage, source, width, image_format)
+        try:
+            variant, _ = cls.objects.get_or_create(source=source, width=width, format=image_format,
+                                                   defaults={'name': name})
+        except IntegrityError:
+            variant = cls.objects.get(source=source, width=width, format=image_format)
+        if variant.name != name:
+            # Variant was generated by concurrent request
+            storage.delete(name)
+        return variant.name
+
+    @classmethod
+    def delete_for(cls, storage, source):
+        """
+        Delete all variants of source image from storage and manifest
+        """
+        variants = cls.objects.filter(source=source)
+        for variant in variants:
+            storage.delete(variant.name)
+        variants.delete()
+
+    @classmethod
+    def delete_unused(cls, storage, chunk_size=1000):
+        """
+        Delete variants which are never served: variants of images which are not stored in ThumbnailImageField
+        anymore (e.g. replaced covers) and variants which are not declared by field of image anymore
+
+        :return: number of deleted variants
+        """
+        sources = list(cls.objects.order_by('source').values_list('source', flat=True).distinct())
+        fields = get_thumbnail_fields()
+        deleted = 0
+        for i in range(0, len(sources), chunk_size):
+            chunk = sources[i:i + chunk_size]
+            declared = {}
+            for model, field in fields:
+                stored = model._default_manager.filter(**{field.name + '__in': chunk})
+                for source in stored.values_list(field.name, flat=True):
+                    declared.setdefault(source, set()).update(field.variants)
+            unused = [x for x in cls.objects.filter(source__in=chunk)
+                      if (x.width, x.format) not in declared.get(x.source, ())]
+            for variant in unused:
+                storage.delete(variant.name)
+            deleted += cls.objects.filter(id__in=[x.id for x in unused]).delete()[0]
+        return deleted
+
+    class Meta:
+        unique_together = (("source", "width", "format"),)
+
+
 def get_publisher_poster_name(instance, filename):
     return "publisher_poster/{0}_poster.{1}".format(instance.name, filename.split('.')[-1])
 
@@ -578,11 +765,13 @@ class Title(models.Model):
         super(Title, self).save(force_insert, force_update, using, update_fields)
 
     def get_slug(self):
+        return unique_slugify(self.__class__, self.get_slug_source(), self.pk)
+
+    def get_slug_source(self):
         if self.universe:
-            name = "[{0.publisher.name}, {0.universe.name}, {0.title_type.name}] {0.path_key}".format(self)
+            return "[{0.publisher.name}, {0.universe.name}, {0.title_type.name}] {0.path_key}".format(self)
         else:
-            name = "[{0.publisher.name}, {0.title_type.name}] {0.path_key}".format(self)
-        return unique_slugify(self.__class__, name, self.pk)
+            return "[{0.publisher.name}, {0.title_type.name}] {0.path_key}".format(self)
 
     def __str__(self):
         if self.universe:
@@ -707,7 +896,9 @@ class Issue(models.Model):
     main_cover = ThumbnailImageField(null=True, upload_to=get_issue_cover_name, thumb_width=380)
     link = models.URLField(max_length=1000, unique=True)
     page_count = models.IntegerField(null=True)
+    page_index = JSONField(null=True, blank=True)  # See ComicsReader.build_page_index
     file_size = models.IntegerField(null=True)
+    file_crc32 = models.BigIntegerField(null=True)  # Saved on first download, see IssueArchive
     api_image = models.BooleanField(default=False)
 
     title = models.ForeignKey(Title, on_delete=models.CASCADE, related_name="issues", db_index=True)
@@ -732,7 +923,10 @@ class Issue(models.Model):
         super(Issue, self).save(force_insert, force_update, using, update_fields)
 
     def get_slug(self):
-        return unique_slugify(self.__class__, self.link.replace('/', '_').replace('.', '_')[8:-4], self.pk)
+        return unique_slugify(self.__class__, self.get_slug_source(), self.pk)
+
+    def get_slug_source(self):
+        return self.link.replace('/', '_').replace('.', '_')[8:-4]
 
     def __str__(self):
         return "[{0.title.publisher.name}, {0.title.universe.name}, {0.publish_date.year}] {0.name}".format(self)
@@ -785,8 +979,8 @@ class Issue(models.Model):
         except MarvelAPISiteUrl.DoesNotExist:
             pass
 
-        # Page count
-        self.page_count = api_comic.page_count
+        # Page count. Count from page index of issue file is preferred
+        self.page_count = len(self.page_index) if self.page_index else api_comic.page_count
 
         # Creators
         issue_creators = []
@@ -1288,6 +1482,37 @@ class ReadingList(models.Model):
         unique_together = (('owner', 'name'),)
 
 
+class ArchiveCacheEntry(models.Model):
+    """
+    Pre-built zip of title or reading list issues in ARCHIVE_CACHE_BUCKET_NAME. Downloads are counted for current issue
+    set (cache_key), archive is built by background task when issue set is downloaded often enough
+    """
+    KIND_CHOICES = (
+        ("TITLE", "Title"),
+        ("READING_LIST", "Reading list")
+    )
+    STATUS_CHOICES = (
+        ("NEW", "Not built"),
+        ("QUEUE", "Queued"),
+        ("BUILDING", "Building"),
+        ("READY", "Ready"),
+        ("ERROR", "Error")
+    )
+
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    cache_key = models.CharField(max_length=64, blank=True)
+    object_key = models.CharField(max_length=200, blank=True)
+    status = models.CharField(max_length=30, choices=STATUS_CHOICES, default="NEW")
+    downloads = models.IntegerField(default=0)
+    last_download = models.DateTimeField(null=True)
+    built = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = (("kind", "object_id"),)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, related_name="profile", on_delete=models.CASCADE)
     unlimited_api = models.BooleanField(default=False)
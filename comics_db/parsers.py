@@ -4,32 +4,40 @@ Different parsers for getting comics info
 import datetime
 import inspect
 import json
+import os
 import re
 import tempfile
+import threading
+import time
 import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import NoReturn
 from urllib.parse import urlparse
 
-import boto3
 import botocore
 import botocore.exceptions
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, MultipleObjectsReturned
 from django.core.mail import EmailMultiAlternatives
-from django.db import Error
-from django.db.models import Count, Max
+from django.db import Error, connection, transaction
+from django.db.models import Count, Max, Q, OuterRef, Subquery, Case, When, Value, BooleanField
 from django.template.loader import render_to_string
 from django.utils import timezone
 from requests import RequestException
 
 from comics_db import models as comics_models
-from comics_db.reader import ComicsReader
+from comics_db.reader import ComicsReader, file_type, is_page_index_current, CBZ
+from comics_db.s3 import S3RangeFile, get_client
 from comicsdb import settings
 from marvel_api_wrapper import entities
 from marvel_api_wrapper.endpoint_fabric import EndpointFabric
 from marvel_api_wrapper.endpoints import CreatorsListEndpoint, ComicsListEndpoint, CharactersListEndpoint, \
     EventsListEndpoint, SeriesListEndpoint, APIRateLimitError, APIError
 from marvel_api_wrapper.entities import MarvelAPIJSONEncoder
+from marvel_api_wrapper.cache import ResponseCache
+from marvel_api_wrapper.rate_limit import RateScheduler
 
 
 class ParserError(Exception):
@@ -71,6 +79,13 @@ class BaseParser:
         if not self._parser_run:
             self.initialize_run(queue)
 
+    @classmethod
+    def from_run(cls, parser_run):
+        """
+        Create parser continuing existing run. Parsers with parameters should restore them from run parameters
+        """
+        return cls(parser_run=parser_run)
+
     @property
     def _items_count(self) -> int:
         """
@@ -220,6 +235,7 @@ class BaseParser:
 
         Handles creating record in parser run log, checks correctness of specific implementation and handles
         unrecoverable errors.
+        If _process returns None, processing is continued by other tasks, which should call finish when done
         :return: Run result boolean (True - success, False - error)
         """
         try:
@@ -236,36 +252,182 @@ class BaseParser:
 
             # Starting processing
             process_result = self._process()
+            if process_result is None:
+                return True
 
-            # Setting result status and ending work
-            if process_result:
-                self._parser_run.status = "SUCCESS"
-            else:
-                self._parser_run.status = "ENDED_WITH_ERRORS"
-
-            self._postprocessing()
+            self._finish(process_result)
+            return True
+        except Exception as err:
+            self._end_with_error(err)
+            return False
 
-            self._parser_run.end = timezone.now()
-            self._parser_run.save()
-            self._notify_staff_success()
+    def finish(self, process_result: bool) -> bool:
+        """
+        End run which processing was continued by other tasks: run postprocessing and set result status
+        :param process_result: processing result
+        :return: Run result boolean (True - success, False - error)
+        """
+        try:
+            self._finish(process_result)
             return True
+        except Exception as err:
+            self._end_with_error(err)
+            return False
 
-        except ParserError as err:
+    def _finish(self, process_result):
+        # Setting result status and ending work
+        if process_result:
+            self._parser_run.status = "SUCCESS"
+        else:
+            self._parser_run.status = "ENDED_WITH_ERRORS"
+
+        self._postprocessing()
+
+        self._parser_run.end = timezone.now()
+        self._parser_run.save()
+        self._notify_staff_success()
+
+    def _end_with_error(self, err):
+        if isinstance(err, ParserError):
             self._parser_run.status = err.STATUS_CODE
             self._parser_run.error = err.message
             self._parser_run.error_detail = err.detail
-            self._parser_run.end = timezone.now()
-            self._parser_run.save()
-            self._notify_staff_error()
-            return False
-        except Exception as err:
+        else:
             self._parser_run.status = "INVALID_PARSER"
             self._parser_run.error = "{0} Unhandled error in method run".format(self.__class__.__name__)
             self._parser_run.error_detail = traceback.format_exc()
-            self._parser_run.end = timezone.now()
-            self._parser_run.save()
-            self._notify_staff_error()
-            return False
+        self._parser_run.end = timezone.now()
+        self._parser_run.save()
+        self._notify_staff_error()
+
+
+def _page_index_missing(prefix=''):
+    """
+    Q object for issues without page index or with index built before page ordering (see is_page_index_current)
+
+    :param prefix: lookup prefix of issue relation, e.g. "issue__"
+    """
+    return Q(**{prefix + 'page_index__isnull': True}) | \
+        (Q(**{prefix + 'page_index__0__kind__isnull': True}) & ~Q(**{prefix + 'page_index': []}))
+
+
+CachedIssue = namedtuple('CachedIssue', ['id', 'file_size', 'number', 'has_cover', 'has_page_index'])
+
+
+class CloudFilesEntityCache:
+    """
+    In-memory entity resolution cache for CloudFilesParser.
+
+    All publishers, universes, title types and titles are preloaded with one query per model, issues are preloaded as
+    link -> CachedIssue map. Parsed keys are resolved against these maps, so DB is touched only to insert entities
+    which are not in the cache yet. Inserted entities are added to the cache.
+    """
+
+    def __init__(self):
+        self.publishers = {}  # name -> Publisher
+        self.universes = {}  # (name, publisher name) -> Universe
+        self.title_types = {}  # name -> TitleType
+        self.titles = {}  # (path_key, publisher name, universe name) -> Title id
+        self.issues = {}  # link -> CachedIssue
+
+    def preload(self, link_prefix=''):
+        """
+        Load existing entities
+
+        :param link_prefix: only issues with link starting with prefix are loaded
+        """
+        self.publishers = {x.name: x for x in comics_models.Publisher.objects.all()}
+        self.universes = {(x.name, x.publisher.name): x
+                          for x in comics_models.Universe.objects.select_related('publisher')}
+        self.title_types = {x.name: x for x in comics_models.TitleType.objects.all()}
+        self.titles = {
+            (path_key, publisher, universe): title_id
+            for title_id, path_key, publisher, universe in comics_models.Title.objects.values_list(
+                'id', 'path_key', 'publisher__name', 'universe__name')
+        }
+        self.issues = {
+            link: CachedIssue(issue_id, file_size, number, bool(main_cover), has_page_index)
+            for link, issue_id, file_size, number, main_cover, has_page_index in comics_models.Issue.objects.filter(
+                link__startswith=link_prefix).annotate(
+                has_page_index=Case(When(_page_index_missing(), then=Value(False)), default=Value(True),
+                                    output_field=BooleanField())
+            ).values_list('link', 'id', 'file_size', 'number', 'main_cover', 'has_page_index')
+        }
+
+    @staticmethod
+    def _get_or_create(model, cache, keys, factory, slug_source=None, unique_name=False):
+        """
+        Resolve keys against cache dict and create missing instances with bulk_create
+
+        :param model: model class
+        :param cache: dict key -> model instance
+        :param keys: set of keys to resolve
+        :param factory: function returning new unsaved model instance for key
+        :param slug_source: function returning slug source for unsaved instance. If specified, unique slugs are
+        generated with comics_models.bulk_unique_slugify
+        :param unique_name: keys are values of unique name field. Instances created by concurrent runs (e.g. other
+        shards) are ignored on insert and loaded from DB
+        :return: cache dict
+        """
+        missing = {key: factory(key) for key in keys if key not in cache}
+        if missing:
+            if slug_source:
+                slugs = comics_models.bulk_unique_slugify(model, [slug_source(x) for x in missing.values()])
+                for obj, slug in zip(missing.values(), slugs):
+                    obj.slug = slug
+            if unique_name:
+                model.objects.bulk_create(missing.values(), ignore_conflicts=True)
+                cache.update({x.name: x for x in model.objects.filter(name__in=missing.keys())})
+            else:
+                model.objects.bulk_create(missing.values())
+                cache.update(missing)
+        return cache
+
+    def get_or_create_publishers(self, names):
+        def new_publisher(name):
+            publisher = comics_models.Publisher(name=name)
+            publisher.slug = publisher.get_slug()
+            return publisher
+
+        return self._get_or_create(comics_models.Publisher, self.publishers, names, new_publisher, unique_name=True)
+
+    def get_or_create_universes(self, keys):
+        """
+        :param keys: set of (universe name, publisher name) tuples. Publishers should be resolved already
+        """
+        return self._get_or_create(comics_models.Universe, self.universes, keys,
+                                   lambda key: comics_models.Universe(name=key[0], publisher=self.publishers[key[1]]),
+                                   str)
+
+    def get_or_create_title_types(self, names):
+        return self._get_or_create(comics_models.TitleType, self.title_types, names,
+                                   lambda name: comics_models.TitleType(name=name), unique_name=True)
+
+    def add_titles(self, titles):
+        """
+        Insert new titles
+
+        :param titles: dict (path_key, publisher name, universe name) -> unsaved Title
+        """
+        if titles:
+            slugs = comics_models.bulk_unique_slugify(comics_models.Title,
+                                                      [x.get_slug_source() for x in titles.values()])
+            for title, slug in zip(titles.values(), slugs):
+                title.slug = slug
+            comics_models.Title.objects.bulk_create(titles.values())
+            self.titles.update({key: title.id for key, title in titles.items()})
+
+    def set_issue(self, issue, has_cover=None):
+        """
+        Put created or updated issue to cache. Page index of created or updated issue is always missing
+
+        :param issue: saved Issue
+        :param has_cover: cover flag. If not specified, cached value is kept
+        """
+        cached = self.issues.get(issue.link)
+        if has_cover is None:
+            has_cover = cached.has_cover if cached else False
+        self.issues[issue.link] = CachedIssue(issue.id, issue.file_size, issue.number, has_cover, False)
 
 
 class CloudFilesParser(BaseParser):
@@ -278,203 +440,560 @@ class CloudFilesParser(BaseParser):
                         r"(?P<year>\d+?)/"
                         r"(?P<title_type>.+?)/"
                         r"(?:(?P<title>.+?)\/)?"
-                        r"(?P<issue_name>[^#]+?(?:#(?P<number>-?[0-9.]+))?[^#]*)\.(?:cbr|cbt|cbz)$",
+                        r"(?P<issue_name>[^#]+?(?:#(?P<number>-?[0-9.]+))?[^#]*)\.(?:cbr|cbt|cbz|cb7)$",
                         re.IGNORECASE)
-    _FILE_REGEX = re.compile(r"\.cb(r|z|t)", re.IGNORECASE)
+    _FILE_REGEX = re.compile(r"\.cb(r|z|t|7)", re.IGNORECASE)
+    _CHUNK_SIZE = 500  # Issues created/updated with one bulk query
+    _SHARD_MAX_DEPTH = 3  # Slashes in shard prefix: shards are publisher or universe directories at most
 
-    def __init__(self, path_prefix, full=False, load_covers=False, marvel_api_merge=False,
-                 queue=False, parser_run=None):
+    def __init__(self, path_prefix, full=False, load_covers=False, marvel_api_merge=False, sharded=False,
+                 download_archives=False, queue=False, parser_run=None):
         params = {'path_prefix': path_prefix, 'full': full, 'load_covers': load_covers,
-                  'marvel_api_merge': marvel_api_merge}
+                  'marvel_api_merge': marvel_api_merge, 'sharded': sharded, 'download_archives': download_archives}
         super().__init__(queue=queue, parser_run=parser_run, params=params)
-        self._publishers = set()
-        self._universes = set()
-        self._titles = set()
-        self._issues = set()
-
-        # Initialize bucket connection
-        session = boto3.session.Session()
-        s3 = session.resource('s3', region_name=settings.DO_REGION_NAME,
-                              endpoint_url=settings.DO_ENDPOINT_URL,
-                              aws_access_key_id=settings.DO_KEY_ID,
-                              aws_secret_access_key=settings.DO_SECRET_ACCESS_KEY)
-        self._bucket = s3.Bucket(settings.DO_STORAGE_BUCKET_NAME)
+        self._estimated_count = 0
+        self._processed_count = 0
+        self._listing_complete = False
+        self._cache = CloudFilesEntityCache()
+        self._shard = None  # Shard processed by this instance
+        self._shards = []  # Shards of sharded run, created in _prepare
+
+        self._client = get_client()
+        self._bucket_name = settings.DO_STORAGE_BUCKET_NAME
 
     def _prepare(self):
+        """
+        Set up lazy enumeration of bucket objects and preload entity cache. Listing is paged and processed chunk by
+        chunk in _process, so items count is estimated by manifest size.
+        For sharded run shards are created instead, they are processed by cloud_files_shard_task
+        """
+        if self._params['sharded']:
+            self._shards = [comics_models.ParserRunShard.objects.create(parser_run=self._parser_run, prefix=prefix,
+                                                                        recursive=recursive)
+                            for prefix, recursive in self._list_shards()]
+        else:
+            self._cache.preload(self._params['path_prefix'])
+            self._data = self._iter_objects(self._params['path_prefix'])
+        self._estimated_count = comics_models.CloudFilesManifestEntry.objects.filter(
+            key__startswith=self._params['path_prefix']).count()
+
+    def _list_shards(self):
+        """
+        Split path prefix by directories of next level (e.g. publishers for "content/"). Files placed directly under
+        prefix form separate non-recursive shard. If prefix has no directories, it is processed as one shard.
+
+        Prefix is split only down to universe directories: universes and titles have no unique natural key, so
+        concurrent shards should never create the same ones. Prefix inside universe is processed as one shard
+
+        :return: list of (prefix, recursive) tuples
+        """
+        if self._params['path_prefix'].count('/') >= self._SHARD_MAX_DEPTH:
+            return [(self._params['path_prefix'], True)]
+        paginator = self._client.get_paginator('list_objects_v2')
+        prefixes = []
+        has_files = False
         try:
-            bucket_comics = self._bucket.objects.filter(Prefix=self._params['path_prefix'])
-            self._data = [(x.key, x.size) for x in bucket_comics if self._FILE_REGEX.search(x.key)]
+            for page in paginator.paginate(Bucket=self._bucket_name, Prefix=self._params['path_prefix'],
+                                           Delimiter='/'):
+                prefixes.extend(x['Prefix'] for x in page.get('CommonPrefixes', []))
+                has_files = has_files or any(self._FILE_REGEX.search(x['Key']) for x in page.get('Contents', []))
         except botocore.exceptions.ConnectionError:
             raise RuntimeParserError("Could not establish connection to DO cloud")
         except botocore.exceptions.ClientError as err:
-            raise RuntimeParserError("boto3 client error while preparing data", err.msg)
-        except Exception as err:
-            raise RuntimeParserError("Error while preparing data", err.args[0])
+            raise RuntimeParserError("boto3 client error while listing bucket", str(err))
+
+        if not prefixes:
+            return [(self._params['path_prefix'], True)]
+        shards = [(x, True) for x in prefixes]
+        if has_files:
+            shards.append((self._params['path_prefix'], False))
+        return shards
+
+    def _iter_objects(self, prefix, recursive=True):
+        """
+        Page through list_objects_v2 and yield objects which should be processed
+
+        :param prefix: key prefix
+        :param recursive: if False, only objects placed directly under prefix are listed
+        :return: generator of (key, size, etag, last modified) tuples
+        """
+        paginator = self._client.get_paginator('list_objects_v2')
+        list_params = {'Bucket': self._bucket_name, 'Prefix': prefix}
+        if not recursive:
+            list_params['Delimiter'] = '/'
+        try:
+            for page in paginator.paginate(**list_params):
+                objects = [(x['Key'], x['Size'], x['ETag'], x['LastModified']) for x in page.get('Contents', [])
+                           if self._FILE_REGEX.search(x['Key'])]
+                yield from self._diff_page(objects)
+        except botocore.exceptions.ConnectionError:
+            raise RuntimeParserError("Could not establish connection to DO cloud")
+        except botocore.exceptions.ClientError as err:
+            raise RuntimeParserError("boto3 client error while listing bucket", str(err))
+        self._listing_complete = True
+
+    def _diff_page(self, objects):
+        """
+        Compare page of bucket listing with manifest and mark page keys as seen by current run.
+
+        Only added and changed objects and objects of issues without page index are returned (archives which are not
+        read with ranged requests only with download_archives). With load_covers objects of issues without cover are
+        returned too. With full parameter all objects are returned.
+        Keys of existing issues which are not in manifest get placeholder entries, so they are deleted when removed
+        from bucket and processed until placeholder is replaced by real state
+        :param objects: list of (key, size, etag, last modified) tuples
+        :return: list of (key, size, etag, last modified) tuples to process
+        """
+        keys = [x[0] for x in objects]
+        manifest = {
+            x[0]: x[1:] for x in comics_models.CloudFilesManifestEntry.objects.filter(key__in=keys)
+                                                                              .values_list('key', 'size', 'etag',
+                                                                                           'last_modified')
+        }
+        issues = {key: self._cache.issues[key] for key in keys if key in self._cache.issues}
+
+        comics_models.CloudFilesManifestEntry.objects.bulk_create([
+            comics_models.CloudFilesManifestEntry(key=key, size=0, etag='', last_modified=timezone.now(),
+                                                  last_seen_run=self._parser_run)
+            for key in issues.keys() if key not in manifest
+        ])
+        comics_models.CloudFilesManifestEntry.objects.filter(key__in=keys).update(last_seen_run=self._parser_run)
+
+        if self._params['full']:
+            return objects
+        return [x for x in objects if manifest.get(x[0]) != x[1:] or
+                (x[0] in issues and not issues[x[0]].has_page_index and self._can_read_archive(x[0])) or
+                (self._params['load_covers'] and x[0] in issues and not issues[x[0]].has_cover)]
+
+    def _update_manifest(self, objects):
+        """
+        Save bucket objects state to manifest
+
+        :param objects: list of (key, size, etag, last modified) tuples
+        """
+        existing = {x.key: x for x in comics_models.CloudFilesManifestEntry.objects.filter(
+            key__in=[x[0] for x in objects])}
+        new_entries = []
+        for key, size, etag, last_modified in objects:
+            entry = existing.get(key)
+            if not entry:
+                entry = comics_models.CloudFilesManifestEntry(key=key)
+                new_entries.append(entry)
+            entry.size = size
+            entry.etag = etag
+            entry.last_modified = last_modified
+            entry.parser_run = self._parser_run
+            entry.last_seen_run = self._parser_run
+        comics_models.CloudFilesManifestEntry.objects.bulk_create(new_entries)
+        comics_models.CloudFilesManifestEntry.objects.bulk_update(existing.values(),
+                                                                  ['size', 'etag', 'last_modified', 'parser_run',
+                                                                   'last_seen_run'])
 
     @property
     def _items_count(self):
-        if self._data:
-            return len(self._data)
-        else:
-            return 0
+        return self._estimated_count
+
+    def _can_read_archive(self, key):
+        """
+        CBZ archives are read with ranged requests, other formats are downloaded completely, so they are read only with
+        download_archives parameter
+        """
+        return self._params['download_archives'] or key.lower().endswith('.cbz')
+
+    def _resolve_parents(self, parsed):
+        """
+        Get or create publishers, universes, title types and titles for all parsed keys using entity cache
+
+        :param parsed: list of (file_key, file_size, regex groups) tuples
+        :return: dict (path_key, publisher name, universe name) -> Title id
+        """
+        cache = self._cache
+        publishers = cache.get_or_create_publishers({info['publisher'] for _, _, info in parsed})
+        universes = cache.get_or_create_universes({(info['universe'], info['publisher']) for _, _, info in parsed})
+        title_types = cache.get_or_create_title_types({info['title_type'] for _, _, info in parsed})
+
+        # Title type is used only for new titles, existing ones are matched by path key, publisher and universe
+        new_titles = {}
+        for _, _, info in parsed:
+            key = (info['title'] or info['issue_name'], info['publisher'], info['universe'])
+            if key not in cache.titles and key not in new_titles:
+                new_titles[key] = comics_models.Title(path_key=key[0], name=key[0],
+                                                      publisher=publishers[key[1]],
+                                                      universe=universes[(key[2], key[1])],
+                                                      title_type=title_types[info['title_type']])
+        cache.add_titles(new_titles)
+        return cache.titles
+
+    def _new_run_detail(self, file_key, info=None):
+        return self.RUN_DETAIL_MODEL(parser_run=self._parser_run,
+                                     file_key=file_key,
+                                     regex=self._REGEX.pattern,
+                                     groups=json.dumps(info, indent=2) if info else '')
+
+    def _process_chunk(self, chunk, titles, changed_keys=frozenset()):
+        """
+        Create and update issues for chunk of parsed keys with bulk queries. Existing issues are matched against
+        entity cache, unchanged ones are not touched at all.
+        Page index, checksum and cover of issues with changed file are cleared, so they are rebuilt from new file (cover
+        is loaded by runs with load_covers)
+
+        :param chunk: list of (file_key, file_size, regex groups) tuples
+        :param titles: dict returned by _resolve_parents
+        :param changed_keys: keys of objects which ETag differs from manifest
+        :return: list of (run detail, issue) tuples. Issue is None if file was not processed
+        """
+        results = []
+        new_issues = []
+        changed_issues = []
+        stale_covers = []
+        for file_key, file_size, info in chunk:
+            run_detail = self._new_run_detail(file_key, info)
+            issue = None
+            try:
+                title_id = titles[((info['title'] or info['issue_name']), info['publisher'], info['universe'])]
+
+                # Getting publish date
+                publish_date = datetime.date(int(info['year']), 1, 1)
+
+                # Getting number
+                try:
+                    number = float(info['number'])
+                except ValueError:
+                    number = 0
+                except TypeError:
+                    number = None
+
+                cached = self._cache.issues.get(file_key)
+                if not cached:
+                    issue = comics_models.Issue(link=file_key, name=info['issue_name'], title_id=title_id,
+                                                publish_date=publish_date, file_size=file_size, number=number)
+                    new_issues.append(issue)
+                    run_detail.created = True
+                elif file_key in changed_keys or cached.file_size != file_size or cached.number != number:
+                    issue = comics_models.Issue(id=cached.id, link=file_key, file_size=file_size, number=number,
+                                                page_index=None, page_count=None, file_crc32=None, main_cover='',
+                                                modified_dt=timezone.now())
+                    changed_issues.append(issue)
+                    if cached.has_cover:
+                        stale_covers.append(cached.id)
+                else:
+                    issue = comics_models.Issue(id=cached.id, link=file_key)
+                run_detail.end_with_success(save=False)
+            except KeyError as err:
+                run_detail.end_with_error("Match object has no group named \"{0}\"".format(err), save=False)
+                issue = None
+            except (ValidationError, ValueError) as err:
+                run_detail.end_with_error("Invalid data", err.args[0], save=False)
+                issue = None
+            results.append((run_detail, issue))
+
+        try:
+            stale_covers = list(comics_models.Issue.objects.filter(id__in=stale_covers).only('id', 'main_cover'))
+            with transaction.atomic():
+                slugs = comics_models.bulk_unique_slugify(comics_models.Issue,
+                                                          [x.get_slug_source() for x in new_issues])
+                for issue, slug in zip(new_issues, slugs):
+                    issue.slug = slug
+                comics_models.Issue.objects.bulk_create(new_issues)
+                comics_models.Issue.objects.bulk_update(changed_issues, ['file_size', 'number', 'page_index',
+                                                                         'page_count', 'file_crc32', 'main_cover',
+                                                                         'modified_dt'])
+        except Error as err:
+            for run_detail, issue in results:
+                if issue:
+                    run_detail.end_with_error("Database error while processing file", err, save=False)
+            return [(run_detail, None) for run_detail, _ in results]
+
+        for issue in stale_covers:
+            try:
+                issue.main_cover.delete(save=False)
+            except Exception:
+                # Orphaned cover file does not break issue, it is not worth failing the chunk
+                pass
+        for issue in new_issues:
+            self._cache.set_issue(issue)
+        for issue in changed_issues:
+            self._cache.set_issue(issue, has_cover=False)
+        for run_detail, issue in results:
+            if issue:
+                run_detail.issue_id = issue.id
+        return results
+
+    def _read_archive_file(self, issue, comics_file):
+        with ComicsReader(comics_file) as reader:
+            if self._params['load_covers'] and not issue.main_cover:
+                # Page file objects of tar and 7z archives have no name
+                with reader.get_page_file(0) as cover:
+                    issue.main_cover.save(os.path.basename(reader.get_file_list()[0]), cover, save=False)
+            if not is_page_index_current(issue.page_index):
+                issue.page_index = reader.build_page_index()
+                issue.page_count = len(issue.page_index)
+
+    def _read_archive(self, issue):
+        """
+        Build page index of issue archive and upload first page as issue cover (if load_covers is set). Runs in
+        archive worker thread and does not touch DB
+
+        CBZ archives are read with ranged requests (only central directory and cover are downloaded), other
+        formats are downloaded completely
+        :return: None on success or last exception if all retries failed
+        """
+        client = self._client
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with S3RangeFile(client, self._bucket_name, issue.link, issue.file_size) as comics_file:
+                    if file_type(comics_file) == CBZ:
+                        self._read_archive_file(issue, comics_file)
+                    else:
+                        with tempfile.NamedTemporaryFile() as temp_file:
+                            client.download_fileobj(self._bucket_name, issue.link, temp_file)
+                            temp_file.flush()
+                            # Opened by path, as archive libraries read from start and py7zr rejects file wrappers
+                            self._read_archive_file(issue, temp_file.name)
+                return None
+            except Exception as err:
+                if attempt > settings.CLOUD_FILES_PARSER_COVER_RETRIES:
+                    return err
+                time.sleep(attempt)
+
+    def _read_archives(self):
+        """
+        Archive stage: page indexes and covers. Runs after metadata ingestion with CLOUD_FILES_PARSER_COVER_WORKERS
+        threads.
+
+        Issues without page index (or without cover, if load_covers is set) are selected from successful run details
+        of current run by chunks. Page indexes of archives which are not read with ranged requests are built only with
+        download_archives. Archives are read by workers, issues and run details of failed items are updated in bulk.
+        Archives which could not be read get empty page index, so they are not read again until file is changed or
+        by full run
+        """
+        missing = _page_index_missing('issue__')
+        if self._params['full']:
+            missing |= Q(issue__page_index=[])
+        if not self._params['download_archives']:
+            missing &= Q(issue__link__iendswith='.cbz')
+        if self._params['load_covers']:
+            missing |= Q(issue__main_cover='') | Q(issue__main_cover__isnull=True)
+        details = self.RUN_DETAIL_MODEL.objects.filter(missing, parser_run=self._parser_run, status='SUCCESS') \
+            .select_related('issue').order_by('id')
+        if self._shard:
+            details = details.filter(file_key__startswith=self._shard.prefix)
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=settings.CLOUD_FILES_PARSER_COVER_WORKERS) as executor:
+            while True:
+                chunk = list(details.filter(id__gt=last_id)[:self._CHUNK_SIZE])
+                if not chunk:
+                    break
+                last_id = chunk[-1].id
+                if self._shard and not self._shard.recursive:
+                    chunk = [x for x in chunk if '/' not in x.file_key[len(self._shard.prefix):]]
+
+                loaded = []
+                failed = []
+                for run_detail, err in zip(chunk, executor.map(self._read_archive, [x.issue for x in chunk])):
+                    if err is not None:
+                        run_detail.end_with_error("Could not read issue archive", str(err), save=False)
+                        failed.append(run_detail)
+                        if not is_page_index_current(run_detail.issue.page_index):
+                            run_detail.issue.page_index = []
+                    loaded.append(run_detail.issue)
+                comics_models.Issue.objects.bulk_update(loaded, ['main_cover', 'page_index', 'page_count'])
+                self.RUN_DETAIL_MODEL.objects.bulk_update(failed, ['status', 'end', 'error', 'error_detail'])
+
+    def _process_objects(self, objects):
+        """
+        Process chunk of bucket objects: parse keys, resolve parent entities, create and update issues, save run
+        details and manifest
+
+        :param objects: list of (key, size, etag, last modified) tuples
+        :return: True if all objects processed without errors
+        """
+        has_errors = False
+        run_details = []
+        parsed = []
+        for file_key, file_size, _, _ in objects:
+            match = self._REGEX.search(file_key)
+            if match:
+                parsed.append((file_key, file_size, match.groupdict()))
+            else:
+                run_detail = self._new_run_detail(file_key)
+                run_detail.end_with_error("File key does not match regular expression", save=False)
+                run_details.append(run_detail)
+                has_errors = True
+
+        try:
+            manifest = dict(comics_models.CloudFilesManifestEntry.objects.filter(key__in=[x[0] for x in parsed])
+                            .values_list('key', 'etag'))
+            # Placeholder entries (empty ETag) have unknown state, their issues are not invalidated
+            changed_keys = {key for key, _, etag, _ in objects if manifest.get(key) not in (None, '', etag)}
+            titles = self._resolve_parents(parsed)
+            results = self._process_chunk(parsed, titles, changed_keys)
+        except Exception as err:
+            for file_key, _, info in parsed:
+                run_detail = self._new_run_detail(file_key, info)
+                run_detail.end_with_error('Critical Error', err, save=False)
+                run_details.append(run_detail)
+            self.RUN_DETAIL_MODEL.objects.bulk_create(run_details)
+            raise
+
+        processed = set()
+        for run_detail, issue in results:
+            run_details.append(run_detail)
+            if issue:
+                processed.add(run_detail.file_key)
+            else:
+                has_errors = True
+        self.RUN_DETAIL_MODEL.objects.bulk_create(run_details)
+        self._update_manifest([x for x in objects if x[0] in processed])
+        return not has_errors
 
     def _process(self):
-        run_detail = None
+        if self._params['sharded'] and not self._shard:
+            from comics_db import tasks
+            tasks.run_cloud_files_shards(self._parser_run.id, [x.id for x in self._shards], self._params)
+            return None
 
-        # Dicts for already parsed parent entities
-        publishers = {}
-        universes = {}
-        title_types = {}
-        titles = {}
+        has_errors = False
+        processed_count = 0
         try:
-            has_errors = False
+            chunk = []
             for obj in self._data:
-                file_key = obj[0]
-                file_size = obj[1]
-                # Creating run detail log entry
-                run_detail = self.RUN_DETAIL_MODEL(parser_run=self._parser_run,
-                                                   file_key=file_key,
-                                                   regex=self._REGEX.pattern, )
-                run_detail.save()
-
-                # Parsing file key
-                match = self._REGEX.search(file_key)
-                if not match:
-                    # Not matched. Saving error to log and closing log entry
-                    run_detail.end_with_error("File key does not match regular expression")
-                    has_errors = True
-                else:
-                    # Matched. Saving regex match groups and starting filling issue info in DB
-                    info = match.groupdict()
-                    run_detail.groups = json.dumps(info, indent=2)
-                    try:
-                        # Getting or creating Publisher
-                        publisher = publishers.get(info['publisher'], None)  # Trying to get already parsed version
-                        if not publisher:  # Not parsed, looking in DB
-                            publisher, created = comics_models.Publisher.objects.get_or_create(name=info['publisher'])
-                            if created:  # Not found in DB, creating
-                                publisher.save()
-                            publishers[info['publisher']] = publisher  # Saving in parsed dict
-                        if self._params['full']:  # Saving in set for not deleting
-                            self._publishers.add(publisher.id)
-
-                        # Getting or creating Universe
-                        universe = universes.get((info['universe'], publisher.id),
-                                                 None)  # Trying to get already parsed version
-                        if not universe:  # Not parsed, looking in DB
-                            universe, created = comics_models.Universe.objects.get_or_create(name=info['universe'],
-                                                                                             publisher=publisher)
-                            if created:  # Not found in DB, creating
-                                universe.save()
-                            universes[(info['universe'], publisher.id)] = universe  # Saving in parsed dict
-                        if self._params['full']:  # Saving in set for not deleting
-                            self._universes.add(universe.id)
-
-                        # Getting or creating Title type
-                        title_type = title_types.get(info['title_type'])  # Trying to get already parsed version
-                        if not title_type:  # Not parsed, looking in DB
-                            title_type, created = comics_models.TitleType.objects.get_or_create(name=info['title_type'])
-                            if created:  # Not found in DB, creating
-                                title_type.save()
-                            title_types[info['title_type']] = title_type  # Saving in parsed dict
-
-                        # Getting or creating Title
-                        title = titles.get(((info['title'] or info['issue_name']),
-                                            publisher.id,
-                                            universe.id,
-                                            title_type.id), None)  # Trying to get already parsed version
-                        if not title:  # Not parsed, looking in DB
-                            title, created = comics_models.Title.objects.get_or_create(path_key=(info['title']
-                                                                                                 or info['issue_name']),
-                                                                                       publisher=publisher,
-                                                                                       universe=universe,
-                                                                                       defaults={
-                                                                                           'name': (info['title']
-                                                                                                    or info[
-                                                                                                        'issue_name']),
-                                                                                           'title_type': title_type
-                                                                                       })
-                            if created:  # Not found in DB, creating
-                                title.save()
-
-                            titles[((info['title'] or info['issue_name']),  # Saving in parsed dict
-                                    publisher.id,
-                                    universe.id,
-                                    title_type.id)] = title
-                        if self._params['full']:  # Saving in set for not deleting
-                            self._titles.add(title.id)
-
-                        # Getting publish date
-                        publish_date = datetime.date(int(info['year']), 1, 1)
-
-                        # Getting number
-                        try:
-                            number = float(info['number'])
-                        except ValueError:
-                            number = 0
-                        except TypeError:
-                            number = None
-
-                        # Getting or creating issue
-                        issue, created = comics_models.Issue.objects.get_or_create(link=file_key,
-                                                                                   defaults={
-                                                                                       'name': info['issue_name'],
-                                                                                       'title': title,
-                                                                                       'publish_date': publish_date
-                                                                                   })
-
-                        issue.file_size = file_size
-                        issue.number = number
-                        issue.save()
-
-                        if self._params['full']:  # Saving in set for not deleting
-                            self._issues.add(issue.id)
-
-                        run_detail.issue = issue
-                        run_detail.created = created
-                        if self._params['load_covers'] and not issue.main_cover:
-                            try:
-                                with tempfile.NamedTemporaryFile() as comics_file:
-                                    self._bucket.download_fileobj(file_key, comics_file)
-                                    with ComicsReader(comics_file) as reader:
-                                        with reader.get_page_file(0) as cover:
-                                            issue.main_cover.save(cover.name, cover)
-                                            issue.save()
-                                run_detail.end_with_success()
-                            except Exception as err:
-                                run_detail.end_with_error("Could not get issue cover", err.args[0])
-                        else:
-                            run_detail.end_with_success()
-
-                    except KeyError as err:
-                        run_detail.end_with_error("Match object has no group named \"{0}\"".format(err))
-                        has_errors = True
-                    except MultipleObjectsReturned as err:
-                        run_detail.end_with_error("Multiple objects returned by get_or_create", err.args[0])
-                        has_errors = True
-                    except (ValidationError, ValueError) as err:
-                        run_detail.end_with_error("Invalid data", err.args[0])
-                        has_errors = True
-                    except Error as err:
-                        run_detail.end_with_error("Database error while processing file", err)
-                        has_errors = True
+                chunk.append(obj)
+                if len(chunk) == self._CHUNK_SIZE:
+                    has_errors = not self._process_objects(chunk) or has_errors
+                    processed_count += len(chunk)
+                    chunk = []
+            if chunk:
+                has_errors = not self._process_objects(chunk) or has_errors
+                processed_count += len(chunk)
+            self._processed_count = processed_count
+            if not self._shard:
+                self._parser_run.items_count = processed_count
+                self._parser_run.save()
+
+            self._read_archives()
             return not has_errors
+        except RuntimeParserError:
+            raise
         except Exception as err:
-            if run_detail:
-                run_detail.end_with_error('Critical Error', err)
             raise RuntimeParserError("Error while processing data", err.args[0])
 
+    def run_shard(self, shard, celery_task_id=None):
+        """
+        Process one shard of sharded run. Errors are saved to shard and never raised, so finalizing task runs anyway
+
+        :param shard: ParserRunShard of this parser run
+        :param celery_task_id: id of Celery task
+        """
+        self._shard = shard
+        shard.status = 'RUNNING'
+        shard.start = timezone.now()
+        shard.celery_task_id = celery_task_id
+        shard.save()
+        try:
+            self._cache.preload(shard.prefix)
+            self._data = self._iter_objects(shard.prefix, shard.recursive)
+            shard.status = "SUCCESS" if self._process() else "ENDED_WITH_ERRORS"
+            shard.items_count = self._processed_count
+        except ParserError as err:
+            shard.status = err.STATUS_CODE
+            shard.error = err.message
+            shard.error_detail = err.detail
+        except Exception:
+            shard.status = "INVALID_PARSER"
+            shard.error = "{0} Unhandled error in method run_shard".format(self.__class__.__name__)
+            shard.error_detail = traceback.format_exc()
+        shard.end = timezone.now()
+        shard.save()
+
+    def finish_shards(self):
+        """
+        Aggregate shards state to parser run and finish it. Issues removed from bucket are deleted only if all shards
+        listed their prefixes completely
+        :return: Run result boolean (True - success, False - error)
+        """
+        shards = list(self._parser_run.shards.all())
+        failed = [x for x in shards if x.status not in ("SUCCESS", "ENDED_WITH_ERRORS")]
+        self._listing_complete = not failed
+        self._parser_run.items_count = sum(x.items_count or 0 for x in shards)
+        if failed:
+            self._parser_run.error = "{0} of {1} shards ended with critical error".format(len(failed), len(shards))
+            self._parser_run.error_detail = "\n".join("{0.prefix}: {0.error}".format(x) for x in failed)
+        return self.finish(all(x.status == "SUCCESS" for x in shards))
+
+    @staticmethod
+    def _copy_title_image(title, issue):
+        """
+        Copy issue cover to title image. Runs in worker thread and does not touch DB
+        :return: True if image was copied
+        """
+        try:
+            title.image.copy_from(issue.main_cover, save=False)
+            return True
+        except Exception:
+            return False
+
+    def _backfill_title_images(self):
+        """
+        Set first issue cover (by number) as image of titles without image.
+
+        Titles and their first issues are selected with one query per chunk, files are copied inside storage by
+        CLOUD_FILES_PARSER_COVER_WORKERS threads, titles are updated in bulk
+        """
+        first_issue = comics_models.Issue.objects.filter(title=OuterRef('pk')).exclude(main_cover='') \
+            .exclude(main_cover__isnull=True).order_by('number').values('id')[:1]
+        titles = comics_models.Title.objects.filter(Q(image='') | Q(image__isnull=True)) \
+            .annotate(first_issue_id=Subquery(first_issue)).filter(first_issue_id__isnull=False) \
+            .only('id', 'name', 'image').order_by('id')
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=settings.CLOUD_FILES_PARSER_COVER_WORKERS) as executor:
+            while True:
+                chunk = list(titles.filter(id__gt=last_id)[:self._CHUNK_SIZE])
+                if not chunk:
+                    break
+                last_id = chunk[-1].id
+                issues = comics_models.Issue.objects.only('id', 'main_cover') \
+                    .in_bulk([x.first_issue_id for x in chunk])
+                copied = [x for x, ok in zip(chunk, executor.map(self._copy_title_image, chunk,
+                                                                 [issues[x.first_issue_id] for x in chunk])) if ok]
+                for title in copied:
+                    title.modified_dt = timezone.now()
+                comics_models.Title.objects.bulk_update(copied, ['image', 'modified_dt'])
+
     def _postprocessing(self):
         """
         Postprocessing task:
+            * Delete issues removed from bucket (with full parameter also issues not found in bucket, which are not in
+              manifest)
             * Delete empty titles, universes and publishers
-            * Clean up at full reload
             * Set title covers as first issue cover
         :return:
         """
         try:
-            if self._params['full']:
-                comics_models.Issue.objects.exclude(id__in=self._issues).delete()
+            if self._listing_complete:
+                removed = comics_models.CloudFilesManifestEntry.objects \
+                    .filter(key__startswith=self._params['path_prefix']) \
+                    .exclude(last_seen_run=self._parser_run)
+                while True:
+                    chunk = list(removed.values_list('key', flat=True)[:self._CHUNK_SIZE])
+                    if not chunk:
+                        break
+                    comics_models.Issue.objects.filter(link__in=chunk).delete()
+                    comics_models.CloudFilesManifestEntry.objects.filter(key__in=chunk).delete()
+
+                if self._params['full']:
+                    # Issues not found in bucket are deleted even if they are not in manifest
+                    seen = comics_models.CloudFilesManifestEntry.objects.filter(
+                        key__startswith=self._params['path_prefix'], last_seen_run=self._parser_run).values('key')
+                    unseen = comics_models.Issue.objects.filter(link__startswith=self._params['path_prefix']) \
+                        .exclude(link__in=Subquery(seen))
+                    while True:
+                        chunk = list(unseen.values_list('id', flat=True)[:self._CHUNK_SIZE])
+                        if not chunk:
+                            break
+                        comics_models.Issue.objects.filter(id__in=chunk).delete()
 
             comics_models.Title.objects.annotate(issue_count=Count('issues', distinct=True)) \
                 .filter(issue_count=0).delete()
@@ -484,15 +1003,7 @@ class CloudFilesParser(BaseParser):
                 .annotate(universe_count=Count('universes', distinct=True)).filter(title_count=0, universe_count=0) \
                 .delete()
             if self._params['load_covers']:
-                for t in comics_models.Title.objects.all():
-                    if t.image == '' or t.image is None:
-                        i = t.issues.exclude(main_cover='').order_by('number').first()
-                        if i:
-                            try:
-                                t.image.save(i.main_cover.name, i.main_cover.file)
-                                t.save()
-                            except Exception:
-                                pass
+                self._backfill_title_images()
             if self._params.get('marvel_api_merge'):
                 from comics_db import tasks
                 tasks.full_marvel_api_merge_task.delay()
@@ -500,6 +1011,24 @@ class CloudFilesParser(BaseParser):
             raise RuntimeParserError("Error while performing postprocessing", err.args[0])
 
 
+class DatabaseRateLimitStore:
+    """
+    Rate scheduler bucket store in database, so Marvel API quota is shared by all Celery workers
+    """
+
+    def update(self, name, func):
+        comics_models.APIRateLimitBucket.objects.get_or_create(name=name)
+        with transaction.atomic():
+            bucket = comics_models.APIRateLimitBucket.objects.select_for_update().get(name=name)
+            state = func(None if bucket.tokens is None else
+                         {'tokens': bucket.tokens, 'updated': bucket.updated, 'calls': bucket.calls})
+            bucket.tokens = state['tokens']
+            bucket.updated = state['updated']
+            bucket.calls = state['calls']
+            bucket.save()
+        return state
+
+
 class MarvelAPIParser(BaseParser):
     PARSER_CODE = "MARVEL_API"
     PARSER_NAME = "Marvel API parser"
@@ -515,86 +1044,132 @@ class MarvelAPIParser(BaseParser):
 
     def __init__(self, incremental=False, queue=False, parser_run=None):
         super().__init__(queue=queue, parser_run=parser_run, params={'incremental': incremental})
-        f = EndpointFabric.get_instance(public_key=settings.MARVEL_PUBLIC_KEY, private_key=settings.MARVEL_PRIVATE_KEY)
+        self._thread_id = threading.get_ident()
+        self._scheduler = RateScheduler(daily_quota=settings.MARVEL_API_DAILY_QUOTA, store=DatabaseRateLimitStore(),
+                                        max_retries=settings.MARVEL_API_MAX_RETRIES,
+                                        rate_limit_retries=settings.MARVEL_API_RATE_LIMIT_RETRIES,
+                                        backoff_max=settings.MARVEL_API_BACKOFF_MAX)
+        self._cache = None
+        if settings.MARVEL_API_CACHE_DIR:
+            self._cache = ResponseCache(settings.MARVEL_API_CACHE_DIR, ttl=settings.MARVEL_API_CACHE_TTL,
+                                        resume_since=self._resume_since())
+        # Endpoints are configured per run, so scheduler with database bucket and cache of this run are always used
+        f = EndpointFabric(public_key=settings.MARVEL_PUBLIC_KEY, private_key=settings.MARVEL_PRIVATE_KEY,
+                           concurrency=settings.MARVEL_API_CONCURRENCY, scheduler=self._scheduler,
+                           timeout=(settings.MARVEL_API_CONNECT_TIMEOUT, settings.MARVEL_API_READ_TIMEOUT),
+                           cache=self._cache)
         self._creators_endpoint = f.get_endpoint(CreatorsListEndpoint)
         self._comics_endpoint = f.get_endpoint(ComicsListEndpoint)
         self._characters_endpoint = f.get_endpoint(CharactersListEndpoint)
         self._events_endpoint = f.get_endpoint(EventsListEndpoint)
         self._series_endpoint = f.get_endpoint(SeriesListEndpoint)
 
-        self._creators = list()
-        self._comics = list()
-        self._characters = list()
-        self._events = list()
-        self._series = list()
-        self._data = list()
-
         self._creators_dict = {}
         self._comics_dict = {}
         self._characters_dict = {}
         self._events_dict = {}
         self._series_dict = {}
 
-    def _dump_api(self, entity_type, endpoint, target, **filters):
-        if self._params['incremental']:
-            max_modified = comics_models.ParserRun.objects.filter(
-                parser="MARVEL_API", status="SUCCESS"
-            ).aggregate(
-                max_modified=Max('start')
-            )['max_modified']
-            if max_modified:
-                filters['modifiedSince'] = max_modified.date().isoformat()
-        offset = 0
-        # count = 0
-        total = None
-        detail = None
-
-        while total is None or offset < total:
-            try:
-                filters['offset'] = offset
-                filters['limit'] = 100
+    def _resume_since(self):
+        """
+        Start of failed attempts, so responses cached by them are reused without requests: start of this run if it is
+        continued from its checkpoints, start of previous run if it did not succeed
+        """
+        since = self._parser_run.start if self._parser_run.checkpoints else None
+        previous = comics_models.ParserRun.objects.filter(parser=self.PARSER_CODE, start__lt=self._parser_run.start) \
+            .exclude(id=self._parser_run.id).order_by('-start').first()
+        if previous and previous.status in comics_models.ParserRun.FAILED_STATUSES:
+            since = previous.start
+        return since and since.timestamp()
+
+    def _dump_api(self, entity_type, endpoint, **filters) -> bool:
+        """
+        Request entities of one type page by page and process every page as it arrives. Progress is saved to run
+        checkpoint after each page, so resumed run continues from the first unprocessed page with the same filters
+
+        :return: True if all entities processed without errors
+        """
+        checkpoint = self._parser_run.checkpoints.get(entity_type)
+        if checkpoint is None:
+            if self._params['incremental']:
+                max_modified = comics_models.ParserRun.objects.filter(
+                    parser="MARVEL_API", status="SUCCESS"
+                ).aggregate(
+                    max_modified=Max('start')
+                )['max_modified']
+                if max_modified:
+                    filters['modifiedSince'] = max_modified.date().isoformat()
+            checkpoint = {'offset': 0, 'total': None, 'filters': filters, 'complete': False, 'has_errors': False}
+        if checkpoint['complete']:
+            return not checkpoint['has_errors']
+
+        filters = checkpoint['filters']
+        pages = endpoint.iter_pages(get_page=partial(self._get_page, endpoint), start=checkpoint['offset'], **filters)
+        try:
+            for data in pages:
                 detail = self.RUN_DETAIL_MODEL(action='GET', entity_type=entity_type, parser_run=self._parser_run,
-                                               data=json.dumps(filters, indent=2))
-                detail.save()
-                data = endpoint.get(**filters)
+                                               data=json.dumps(dict(filters, offset=data['offset'],
+                                                                    limit=data['limit']), indent=2))
                 detail.end_with_success()
-                if data['count'] == 0:
-                    break
-                target += data['results']
-                # count += data['count']
-                total = data['total']
-                offset += data['count']
-                # print(entity_type, total, count)
-            except APIRateLimitError:
-                if detail:
-                    detail.end_with_error('API rate limit exceeded')
-                raise RuntimeParserError('API rate limit exceeded')
-            except APIError as err:
-                if detail:
-                    detail.end_with_error('API error', err.args[0])
-                # raise RuntimeParserError(err.args[0])
-            except RequestException as err:
-                if detail:
-                    detail.end_with_error('API error', err.args[0])
-                # raise RuntimeParserError(err.args[0])
+                for item in data['results']:
+                    if not self._process_item(entity_type, item):
+                        checkpoint['has_errors'] = True
+                checkpoint['offset'] = data['offset'] + data['count']
+                checkpoint['total'] = data['total']
+                self._save_checkpoint(entity_type, checkpoint)
+        except RuntimeParserError as err:
+            detail = self.RUN_DETAIL_MODEL(action='GET', entity_type=entity_type, parser_run=self._parser_run,
+                                           data=json.dumps(dict(filters, offset=checkpoint['offset']), indent=2))
+            detail.end_with_error(err.message, err.detail)
+            self._save_checkpoint(entity_type, checkpoint)
+            raise
+        finally:
+            pages.close()
+        checkpoint['complete'] = True
+        self._save_checkpoint(entity_type, checkpoint)
+        return not checkpoint['has_errors']
+
+    def _save_checkpoint(self, entity_type, checkpoint):
+        self._parser_run.checkpoints[entity_type] = checkpoint
+        self._parser_run.items_count = self._items_count
+        self._parser_run.rate_limit = self._scheduler.status()
+        self._parser_run.save(update_fields=['checkpoints', 'items_count', 'rate_limit'])
+
+    def _get_page(self, endpoint, offset, **filters):
+        """
+        Request page of API results. Connection errors, server errors and quota exceeded responses are already retried
+        with backoff by endpoint, so any error left is raised as critical: run is resumed from checkpoint later.
+        Called by endpoint page fetching threads too. Rate scheduler takes tokens from database bucket there, so
+        database connection of fetching thread is closed after every page (Django does not close connections of threads
+        it does not manage)
+        """
+        try:
+            return endpoint.get_page(offset, **filters)
+        except APIRateLimitError:
+            raise RuntimeParserError('API rate limit exceeded', 'offset %s' % offset)
+        except (APIError, RequestException) as err:
+            raise RuntimeParserError('API error', 'offset {0}: {1}'.format(offset, err))
+        finally:
+            if threading.get_ident() != self._thread_id:
+                connection.close()
+
+    @classmethod
+    def from_run(cls, parser_run):
+        params = dict(parser_run.parameters.values_list('name', 'val'))
+        return cls(incremental=params.get('incremental') not in (None, '', 'False'), parser_run=parser_run)
 
     def _prepare(self) -> NoReturn:
-        self._dump_api('COMICS', self._comics_endpoint, self._comics, formatType='comic', noVariants='true',
-                       orderBy='modified,title')
-        self._dump_api('CHARACTER', self._characters_endpoint, self._characters, orderBy='modified,name')
-        self._dump_api('CREATOR', self._creators_endpoint, self._creators, orderBy='modified,firstName,lastName')
-        self._dump_api('EVENT', self._events_endpoint, self._events, orderBy='modified,name')
-        self._dump_api('SERIES', self._series_endpoint, self._series, orderBy='modified,title')
-
-        self._data = [('CREATOR', x) for x in self._creators]
-        self._data += [('CHARACTER', x) for x in self._characters]
-        self._data += [('EVENT', x) for x in self._events]
-        self._data += [('SERIES', x) for x in self._series]
-        self._data += [('COMICS', x) for x in self._comics]
+        """
+        Entities are requested and processed page by page in _process, so only error of interrupted attempt is reset
+        when run is resumed
+        """
+        self._parser_run.end = None
+        self._parser_run.error = ''
+        self._parser_run.error_detail = ''
 
     @property
     def _items_count(self) -> int:
-        return len(self._data)
+        return sum(x['total'] or 0 for x in self._parser_run.checkpoints.values())
 
     def _process_comics(self, data: entities.Comic):
         # Series
@@ -812,63 +1387,80 @@ class MarvelAPIParser(BaseParser):
         self._series_dict[data.id] = series
 
     def _process(self) -> bool:
-        run_detail = None
+        # Referenced entities are processed before comics
+        dumps = (
+            ('CREATOR', self._creators_endpoint, {'orderBy': 'modified,firstName,lastName'}),
+            ('CHARACTER', self._characters_endpoint, {'orderBy': 'modified,name'}),
+            ('EVENT', self._events_endpoint, {'orderBy': 'modified,name'}),
+            ('SERIES', self._series_endpoint, {'orderBy': 'modified,title'}),
+            ('COMICS', self._comics_endpoint, {'formatType': 'comic', 'noVariants': 'true',
+                                               'orderBy': 'modified,title'})
+        )
         has_errors = False
-        for i in self._data:
-            try:
-                run_detail = self.RUN_DETAIL_MODEL(action='PROCESS', entity_type=i[0], entity_id=i[1].id,
-                                                   data=json.dumps(i[1], indent=2, cls=MarvelAPIJSONEncoder),
-                                                   parser_run=self._parser_run)
-                run_detail.save()
-                if i[0] == 'COMICS':
-                    self._process_comics(i[1])
-                elif i[0] == 'CHARACTER':
-                    self._process_character(i[1])
-                elif i[0] == 'CREATOR':
-                    self._process_creator(i[1])
-                elif i[0] == 'EVENT':
-                    self._process_event(i[1])
-                elif i[0] == 'SERIES':
-                    self._process_series(i[1])
-                run_detail.end_with_success()
-            except comics_models.MarvelAPISeries.DoesNotExist as err:
-                if run_detail:
-                    run_detail.end_with_error("Series does not exists", err.args[0])
-                has_errors = True
-            except comics_models.MarvelAPIComics.DoesNotExist as err:
-                if run_detail:
-                    run_detail.end_with_error("Comics does not exists", err.args[0])
-                has_errors = True
-            except comics_models.MarvelAPICharacter.DoesNotExist as err:
-                if run_detail:
-                    run_detail.end_with_error("Character does not exists", err.args[0])
-                has_errors = True
-            except comics_models.MarvelAPIEvent.DoesNotExist as err:
-                if run_detail:
-                    run_detail.end_with_error("Event does not exists", err.args[0])
-                has_errors = True
-            except comics_models.MarvelAPICreator.DoesNotExist as err:
-                if run_detail:
-                    run_detail.end_with_error("Creator does not exists", err.args[0])
-                has_errors = True
-            except MultipleObjectsReturned as err:
-                if run_detail:
-                    run_detail.end_with_error("Multiple objects returned by get_or_create", err.args[0])
-                has_errors = True
-            except (ValidationError, ValueError) as err:
-                if run_detail:
-                    run_detail.end_with_error("Invalid data", err.args[0])
-                has_errors = True
-            except APIRateLimitError:
-                if run_detail:
-                    run_detail.end_with_error("API Rate limit")
-                raise RuntimeParserError("API Rate Limit exceeded")
-            except Error as err:
-                if run_detail:
-                    run_detail.end_with_error("Database error while processing {0}".format(i[0].lower()), err)
+        for entity_type, endpoint, filters in dumps:
+            if not self._dump_api(entity_type, endpoint, **filters):
                 has_errors = True
         return not has_errors
 
+    def _process_item(self, entity_type, item) -> bool:
+        """
+        :return: True if item processed without errors
+        """
+        run_detail = None
+        try:
+            run_detail = self.RUN_DETAIL_MODEL(action='PROCESS', entity_type=entity_type, entity_id=item.id,
+                                               data=json.dumps(item, indent=2, cls=MarvelAPIJSONEncoder),
+                                               parser_run=self._parser_run)
+            run_detail.save()
+            if entity_type == 'COMICS':
+                self._process_comics(item)
+            elif entity_type == 'CHARACTER':
+                self._process_character(item)
+            elif entity_type == 'CREATOR':
+                self._process_creator(item)
+            elif entity_type == 'EVENT':
+                self._process_event(item)
+            elif entity_type == 'SERIES':
+                self._process_series(item)
+            run_detail.end_with_success()
+        except comics_models.MarvelAPISeries.DoesNotExist as err:
+            if run_detail:
+                run_detail.end_with_error("Series does not exists", err.args[0])
+            return False
+        except comics_models.MarvelAPIComics.DoesNotExist as err:
+            if run_detail:
+                run_detail.end_with_error("Comics does not exists", err.args[0])
+            return False
+        except comics_models.MarvelAPICharacter.DoesNotExist as err:
+            if run_detail:
+                run_detail.end_with_error("Character does not exists", err.args[0])
+            return False
+        except comics_models.MarvelAPIEvent.DoesNotExist as err:
+            if run_detail:
+                run_detail.end_with_error("Event does not exists", err.args[0])
+            return False
+        except comics_models.MarvelAPICreator.DoesNotExist as err:
+            if run_detail:
+                run_detail.end_with_error("Creator does not exists", err.args[0])
+            return False
+        except MultipleObjectsReturned as err:
+            if run_detail:
+                run_detail.end_with_error("Multiple objects returned by get_or_create", err.args[0])
+            return False
+        except (ValidationError, ValueError) as err:
+            if run_detail:
+                run_detail.end_with_error("Invalid data", err.args[0])
+            return False
+        except APIRateLimitError:
+            if run_detail:
+                run_detail.end_with_error("API Rate limit")
+            raise RuntimeParserError("API Rate Limit exceeded")
+        except Error as err:
+            if run_detail:
+                run_detail.end_with_error("Database error while processing {0}".format(entity_type.lower()), err)
+            return False
+        return True
+
     def _series_link(self) -> NoReturn:
         for series in comics_models.MarvelAPISeries.objects.all():
             comics = series.comics.all()
@@ -914,6 +1506,9 @@ class MarvelAPIParser(BaseParser):
             ).update(
                 marvel_api_ignore=False
             )
+        # Pruned only after completed run, responses of failed run are reused by resumed one
+        if self._cache:
+            self._cache.prune(max_age=settings.MARVEL_API_CACHE_MAX_AGE, max_size=settings.MARVEL_API_CACHE_MAX_SIZE)
         tasks.full_marvel_api_merge_task.delay()
 
 
@@ -1,33 +1,360 @@
+import io
 import re
+import struct
 import zipfile
 import tarfile
+import zlib
+
+import py7zr
 import rarfile
+from PIL import Image
 
 
-CBR, CBT, CBZ = range(3)
+CBR, CBT, CBZ, CB7 = range(4)
 
 
 class WrongFileTypeError(Exception):
     pass
 
 
+# Archive signatures: (archive type, offset, magic bytes)
+_SIGNATURES = (
+    (CBZ, 0, b'PK\x03\x04'),
+    (CBZ, 0, b'PK\x05\x06'),  # Empty zip archive
+    (CBR, 0, b'Rar!\x1a\x07'),
+    (CB7, 0, b'7z\xbc\xaf\x27\x1c'),
+    (CBT, 257, b'ustar'),
+)
+MAGIC_PREFIX_SIZE = 262  # Bytes of file start enough to detect any known archive type
+
+
+def detect_type(prefix):
+    """
+    Detect archive type by magic bytes. Needs only file start, so works with non-seekable sources
+
+    :param prefix: first MAGIC_PREFIX_SIZE bytes of file (or whole file if it is shorter)
+    :return: archive type
+    :raises WrongFileTypeError: if archive type is unknown
+    """
+    for archive_type, offset, magic in _SIGNATURES:
+        if prefix[offset:offset + len(magic)] == magic:
+            return archive_type
+    raise WrongFileTypeError('Unknown archive format')
+
+
 def file_type(name):
+    """
+    Detect archive type of file
+
+    :param name: file path or seekable file-like object. File start is read whatever current position is, position is
+    restored after reading
+    :return: archive type
+    :raises WrongFileTypeError: if archive type is unknown or file can't be read
+    """
     try:
-        if zipfile.is_zipfile(name):
-            return CBZ
-        elif rarfile.is_rarfile(name):
-            return CBR
+        if isinstance(name, str):
+            with open(name, 'rb') as f:
+                prefix = f.read(MAGIC_PREFIX_SIZE)
         else:
-            raise WrongFileTypeError('Unknown archive format')
+            position = name.tell()
+            name.seek(0)
+            prefix = name.read(MAGIC_PREFIX_SIZE)
+            name.seek(position)
+        return detect_type(prefix)
     except WrongFileTypeError:
         raise
     except Exception as err:
         raise WrongFileTypeError('Wrong file %0s' % name)
 
 
+# Zip local file header fields
+_ZIP_HEADER_SIGNATURE = 0
+_ZIP_HEADER_NAME_LENGTH = 10
+_ZIP_HEADER_EXTRA_LENGTH = 11
+_ZIP_HEADER_READ_AHEAD = 256  # Bytes read after header to get file name and extra field in the same request
+
+
+def read_indexed_page(read_range, entry):
+    """
+    Read page of zip archive by page index entry without parsing archive central directory
+
+    :param read_range: function (start, length) -> bytes, reading archive file
+    :param entry: page index entry (see ComicsReader.build_page_index)
+    :return: page content
+    """
+    if entry.get('offset') is None:
+        raise WrongFileTypeError('Page index entry has no local header offset')
+
+    data = read_range(entry['offset'], zipfile.sizeFileHeader + _ZIP_HEADER_READ_AHEAD + entry['compressed_size'])
+    header = struct.unpack(zipfile.structFileHeader, data[:zipfile.sizeFileHeader])
+    if header[_ZIP_HEADER_SIGNATURE] != zipfile.stringFileHeader:
+        raise WrongFileTypeError('Bad zip local header for %s' % entry['name'])
+    start = zipfile.sizeFileHeader + header[_ZIP_HEADER_NAME_LENGTH] + header[_ZIP_HEADER_EXTRA_LENGTH]
+    if start + entry['compressed_size'] > len(data):
+        data += read_range(entry['offset'] + len(data), start + entry['compressed_size'] - len(data))
+    content = data[start:start + entry['compressed_size']]
+
+    if entry['method'] == zipfile.ZIP_STORED:
+        return content
+    elif entry['method'] == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(content, -zlib.MAX_WBITS)
+    raise WrongFileTypeError('Unsupported compression method %s' % entry['method'])
+
+
+def image_size(content):
+    """
+    Image dimensions read from image header, image is not decoded
+
+    :return: (width, height) tuple, (None, None) if image can't be read
+    """
+    try:
+        return Image.open(io.BytesIO(content)).size
+    except Exception:
+        return None, None
+
+
+########################################################################################################################
+# Archive backends
+########################################################################################################################
+_backends = {}
+
+
+def register_backend(archive_type):
+    """
+    Class decorator registering archive backend for archive type
+    """
+    def decorator(cls):
+        _backends[archive_type] = cls
+        return cls
+    return decorator
+
+
+def get_backend(archive_type):
+    try:
+        return _backends[archive_type]
+    except KeyError:
+        raise WrongFileTypeError('No backend for archive type %s' % archive_type)
+
+
+class ArchiveBackend:
+    """
+    Base class of archive backends. Backend lists regular files of archive and opens them as file-like objects
+    """
+
+    def __init__(self, file):
+        """
+        :param file: file path or file-like object with archive
+        """
+        self._file = file
+
+    def members(self):
+        """
+        :return: list of (file name, archive specific info) tuples
+        """
+        raise NotImplementedError()
+
+    def open(self, name):
+        """
+        :return: file-like object with content of archive file
+        """
+        raise NotImplementedError()
+
+    def index_entry(self, info):
+        """
+        :return: dict with size, compressed_size, offset and method keys of page index entry
+        """
+        raise NotImplementedError()
+
+    @property
+    def memory_size(self):
+        """
+        Bytes of archive files kept in memory while archive is opened
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+@register_backend(CBZ)
+class ZipBackend(ArchiveBackend):
+    def __init__(self, file):
+        super().__init__(file)
+        self._archive = zipfile.ZipFile(file)
+
+    def members(self):
+        return [(x.filename, x) for x in self._archive.infolist() if not x.is_dir()]
+
+    def open(self, name):
+        return self._archive.open(name)
+
+    def index_entry(self, info):
+        return {'size': info.file_size, 'compressed_size': info.compress_size, 'offset': info.header_offset,
+                'method': info.compress_type}
+
+    def close(self):
+        self._archive.close()
+
+
+@register_backend(CBR)
+class RarBackend(ArchiveBackend):
+    def __init__(self, file):
+        super().__init__(file)
+        self._archive = rarfile.RarFile(file)
+
+    def members(self):
+        return [(x.filename, x) for x in self._archive.infolist() if not x.isdir()]
+
+    def open(self, name):
+        return self._archive.open(name)
+
+    def index_entry(self, info):
+        return {'size': info.file_size, 'compressed_size': info.compress_size, 'offset': None, 'method': None}
+
+    def close(self):
+        self._archive.close()
+
+
+@register_backend(CBT)
+class TarBackend(ArchiveBackend):
+    def __init__(self, file):
+        super().__init__(file)
+        if isinstance(file, str):
+            self._archive = tarfile.open(file)
+        else:
+            self._archive = tarfile.open(fileobj=file)
+
+    def members(self):
+        return [(x.name, x) for x in self._archive.getmembers() if x.isfile()]
+
+    def open(self, name):
+        return self._archive.extractfile(name)
+
+    def index_entry(self, info):
+        return {'size': info.size, 'compressed_size': info.size, 'offset': None, 'method': None}
+
+    def close(self):
+        self._archive.close()
+
+
+@register_backend(CB7)
+class SevenZipBackend(ArchiveBackend):
+    """
+    7z has no random access to files of solid blocks, so all files are decompressed in one pass on first open and kept
+    in memory while archive is opened
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        self._archive = py7zr.SevenZipFile(file, 'r')
+        self._contents = None
+
+    def members(self):
+        return [(x.filename, x) for x in self._archive.list() if not x.is_directory]
+
+    def open(self, name):
+        if self._contents is None:
+            self._contents = {x: f.read() for x, f in self._archive.readall().items()}
+        return io.BytesIO(self._contents[name])
+
+    def index_entry(self, info):
+        return {'size': info.uncompressed, 'compressed_size': info.compressed, 'offset': None, 'method': None}
+
+    @property
+    def memory_size(self):
+        return sum(info.uncompressed for _, info in self.members())
+
+    def close(self):
+        self._archive.close()
+
+
+########################################################################################################################
+# Page ordering
+########################################################################################################################
+# Page kinds stored in page index
+COVER, PAGE = 'COVER', 'PAGE'
+# Kinds of skipped images, which are not reading pages
+CREDITS, VARIANT = 'CREDITS', 'VARIANT'
+
+_VARIANT_SIZE_RATIO = 1.5  # Minimal size ratio of directories with the same files to treat smaller one as variant
+_DIGITS_RE = re.compile(r'(\d+)')
+_COVER_RE = re.compile(r'(?:^|[^a-z])(?:cover|fc)(?:[^a-z]|$)', re.I)
+_CREDITS_RE = re.compile(r'(?:^z{2,}|(?:^|[^a-z])(?:credits?|scan(?:ner|ned|s)?|tag|release|banner|recruit(?:ing)?)'
+                         r'(?:[^a-z]|$))', re.I)
+
+
+def natural_key(name):
+    """
+    Sort key comparing digit runs as numbers, so page2.jpg goes before page10.jpg
+    """
+    # re.split with group returns text parts at even positions and digit runs at odd ones
+    return [int(x) if i % 2 else x.casefold() for i, x in enumerate(_DIGITS_RE.split(name))], name
+
+
+def _split_name(name):
+    directory, _, base = name.replace('\\', '/').rpartition('/')
+    return directory, base.rsplit('.', 1)[0]
+
+
+def order_pages(files):
+    """
+    Order archive images for reading and classify them.
+
+    Images are grouped by directory, directories and files inside them are sorted naturally, root directory first.
+    Directories with the same set of files (e.g. "HD" and "SD" versions of the same pages) are variants: only the one
+    with the largest total size is read, directories with the same files of similar size (e.g. chapters of omnibus)
+    are all read. Images named as scanner credits or release tags are not pages, unless such are most of the images.
+    Image named as cover is moved to the start, otherwise the first page is cover
+
+    :param files: dict file name -> file size (None if unknown)
+    :return: tuple (pages, skipped). pages is list of (file name, kind) tuples in reading order, kind is COVER or PAGE;
+    skipped is dict file name -> kind (CREDITS or VARIANT)
+    """
+    skipped = {}
+
+    groups = {}
+    for name in files:
+        groups.setdefault(_split_name(name)[0], []).append(name)
+    variants = {}
+    for directory, names in groups.items():
+        stems = frozenset(_split_name(x)[1].casefold() for x in names)
+        variants.setdefault(stems, []).append((directory, sum(files[x] or 0 for x in names)))
+    directories = []
+    for same_files in variants.values():
+        largest_size = max(size for _, size in same_files)
+        for directory, size in same_files:
+            if largest_size and size * _VARIANT_SIZE_RATIO <= largest_size:
+                skipped.update((x, VARIANT) for x in groups[directory])
+            else:
+                directories.append(directory)
+
+    ordered = []
+    for directory in sorted(directories, key=natural_key):
+        ordered.extend(sorted(groups[directory], key=lambda x: natural_key(_split_name(x)[1])))
+
+    credits = [x for x in ordered if _CREDITS_RE.search(_split_name(x)[1])]
+    if len(credits) * 2 < len(ordered):
+        skipped.update((x, CREDITS) for x in credits)
+        ordered = [x for x in ordered if x not in skipped]
+
+    covers = [x for x in ordered if _COVER_RE.search(_split_name(x)[1])]
+    if covers and len(covers) * 2 < len(ordered):
+        ordered.remove(covers[0])
+        ordered.insert(0, covers[0])
+
+    return [(x, COVER if i == 0 else PAGE) for i, x in enumerate(ordered)], skipped
+
+
+def is_page_index_current(page_index):
+    """
+    Check if page index was built with page ordering. Indexes built before have no page kinds and lexicographic order
+    """
+    return page_index is not None and all('kind' in x for x in page_index)
+
+
 class ComicsReader:
     """
-    Class for working with comics cbr/cbz/cbt files
+    Class for working with comics cbr/cbz/cbt/cb7 files
     """
     def __init__(self, filename):
         """
@@ -36,46 +363,57 @@ class ComicsReader:
         :param filename: Python file-like object with comic archive
         """
         self._type = file_type(filename)
-        self._files = []
         self._image_re = re.compile(r'\.(jpg|jpeg|png|gif|tif|tiff|bmp)\s*$', re.I)
-
-        if self._type == CBZ:
-            self._zip_file = zipfile.ZipFile(filename)
-            self._files = [x.filename for x in self._zip_file.infolist() if not x.is_dir()
-                           and self._image_re.search(x.filename)]
-        elif self._type == CBT:
-            self._tar_file = tarfile.TarFile.open(filename)
-            self._files = [x.filename for x in self._tar_file.getmembers() if x.isfile()
-                           and self._image_re.search(x.filename)]
-        elif self._type == CBR:
-            self._rar_file = rarfile.RarFile(filename)
-            self._files = [x.filename for x in self._rar_file.infolist() if not x.isdir()
-                           and self._image_re.search(x.filename)]
-        self._files.sort()
+        self._backend = get_backend(self._type)(filename)
+        self._infos = {name: info for name, info in self._backend.members() if self._image_re.search(name)}
+        pages, self._skipped = order_pages({name: self._backend.index_entry(info)['size']
+                                            for name, info in self._infos.items()})
+        self._files = [name for name, _ in pages]
+        self._kinds = [kind for _, kind in pages]
 
     def get_file_list(self):
+        """
+        :return: page file names in reading order
+        """
         return self._files
 
+    def get_skipped_files(self):
+        """
+        :return: dict file name -> kind (CREDITS or VARIANT) of images which are not reading pages
+        """
+        return self._skipped
+
+    def build_page_index(self):
+        """
+        Build page index to be stored with issue, so pages can be listed and read without parsing archive again. Only
+        archive directory is read: for CBZ read with ranged requests, pages are not downloaded
+
+        :return: list of dicts in reading order with keys name, kind (COVER or PAGE), size, compressed_size, offset (zip
+        local header offset, None for other formats), method (zip compression method, None for other formats), width
+        and height (None until page is read first time, see issue_pages.read_page)
+        """
+        index = []
+        for name, kind in zip(self._files, self._kinds):
+            entry = {'name': name, 'kind': kind, 'width': None, 'height': None}
+            entry.update(self._backend.index_entry(self._infos[name]))
+            index.append(entry)
+        return index
+
     def get_page_file(self, page_number=0):
-        if self._type == CBZ:
-            return self._zip_file.open(self._files[page_number])
-        elif self._type == CBT:
-            return self._tar_file.extractfile(self._files[page_number])
-        elif self._type == CBR:
-            return self._rar_file.open(self._files[page_number])
-        return None
+        return self._backend.open(self._files[page_number])
+
+    @property
+    def memory_size(self):
+        """
+        Bytes of archive files kept in memory while reader is opened
+        """
+        return self._backend.memory_size
 
     def close(self):
-        if self._type == CBZ:
-            self._zip_file.close()
-        elif self._type == CBT:
-            return self._tar_file.close()
-        elif self._type == CBR:
-            return self._rar_file.close()
+        self._backend.close()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
-
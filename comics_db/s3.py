@@ -0,0 +1,167 @@
+"""
+Helpers for working with comics files stored in S3-compatible cloud (DO Spaces)
+"""
+import io
+import threading
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def get_client():
+    """
+    Process-wide S3 client for DO storage bucket.
+
+    Client is created once with tuned connection pool, timeouts and retries and shared by all threads (boto3 clients
+    are thread-safe, sessions are not), so connections are kept alive and reused by downloads, page reads and parser
+    runs instead of setting up new session and pool per request
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                                connect_timeout=settings.S3_CONNECT_TIMEOUT,
+                                read_timeout=settings.S3_READ_TIMEOUT,
+                                retries={'max_attempts': settings.S3_MAX_ATTEMPTS})
+                _client = boto3.session.Session().client('s3', region_name=settings.DO_REGION_NAME,
+                                                         endpoint_url=settings.DO_ENDPOINT_URL,
+                                                         aws_access_key_id=settings.DO_KEY_ID,
+                                                         aws_secret_access_key=settings.DO_SECRET_ACCESS_KEY,
+                                                         config=config)
+    return _client
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Read-only seekable file-like object over S3 object.
+
+    Data is fetched on demand with HTTP Range requests, so readers which need only small part of the file (e.g. zip
+    central directory and first archive member) do not download whole object. Reads are aligned to blocks of
+    block_size bytes; first and last block of every request are kept to serve small header reads without new requests.
+
+    Works with any boto3 S3 client, including clients pointed to local stand-ins like moto or MinIO.
+    """
+    DEFAULT_BLOCK_SIZE = 64 * 1024
+    CACHED_BLOCKS = 16
+
+    def __init__(self, client, bucket_name, key, size=None, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Constructor
+
+        :param client: boto3 S3 client
+        :param bucket_name: bucket name
+        :param key: object key
+        :param size: object size. If not specified, HEAD request is made to get it
+        :param block_size: minimal size of ranged request
+        """
+        super().__init__()
+        self._client = client
+        self._bucket_name = bucket_name
+        self.key = key
+        self.name = key
+        if size is None:
+            size = client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+        self._size = size
+        self._block_size = block_size
+        self._position = 0
+        self._blocks = {}
+
+        # Transfer statistics
+        self.requests_count = 0
+        self.bytes_fetched = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError("Invalid whence ({0}, should be 0, 1 or 2)".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {0}".format(position))
+        self._position = position
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        data = self.read_range(self._position, length)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def read_range(self, start, length):
+        """
+        Read length bytes starting from start without changing current position
+        """
+        first_block = start // self._block_size
+        last_block = (start + length - 1) // self._block_size
+        blocks = range(first_block, last_block + 1)
+
+        if all(x in self._blocks for x in blocks):
+            data = b''.join(self._blocks[x] for x in blocks)
+        else:
+            data = self._fetch(first_block * self._block_size,
+                               min((last_block + 1) * self._block_size, self._size) - 1)
+            self._cache_block(first_block, data[:self._block_size])
+            self._cache_block(last_block, data[(last_block - first_block) * self._block_size:])
+
+        offset = start - first_block * self._block_size
+        return data[offset:offset + length]
+
+    def _cache_block(self, index, data):
+        if index not in self._blocks and len(self._blocks) >= self.CACHED_BLOCKS:
+            del self._blocks[next(iter(self._blocks))]
+        self._blocks[index] = data
+
+    def _fetch(self, start, end):
+        response = self._client.get_object(Bucket=self._bucket_name, Key=self.key,
+                                           Range="bytes={0}-{1}".format(start, end))
+        data = response['Body'].read()
+        self.requests_count += 1
+        self.bytes_fetched += len(data)
+        return data
+
+
+def copy_storage_file(storage, source_name, target_name):
+    """
+    Copy file inside storage. S3 storages copy object server-side, so file content is not transferred through
+    application; other storages save content of the source file under new name
+
+    :param storage: Django storage
+    :param source_name: name of existing file
+    :param target_name: desired name of the copy
+    :return: actual name of the copy
+    """
+    target_name = storage.get_available_name(target_name)
+    if hasattr(storage, 's3_connection'):
+        params = storage._object_params(target_name)
+        params['ACL'] = storage._object_put_params(target_name)['ACL']
+        storage.s3_connection.copy_object(CopySource=storage._object_params(source_name), MetadataDirective='COPY',
+                                          **params)
+    else:
+        with storage.open(source_name) as source:
+            target_name = storage.save(target_name, source)
+    return target_name
@@ -150,11 +150,15 @@ class IssueDetailSerializer(serializers.HyperlinkedModelSerializer):
         view_name="universe-detail",
         help_text="Link to universe",
         read_only=True)
+    pages = serializers.HyperlinkedIdentityField(
+        view_name='issue-pages',
+        help_text="Link to issue pages"
+    )
 
     class Meta:
         model = models.Issue
         fields = ("id", "publisher_name", "universe_name", "title_name", "title_type", "name", "number", "desc",
-                  "publish_date", "download_link", "publisher", "universe", "title")
+                  "publish_date", "download_link", "publisher", "universe", "title", "page_count", "pages")
         read_only_fields = fields
         extra_kwargs = {
             'id': {'help_text': "Unique identifier"},
@@ -164,9 +168,18 @@ class IssueDetailSerializer(serializers.HyperlinkedModelSerializer):
             'publish_date': {'help_text': "Issue publish date"},
             'download_link': {'help_text': "Download link"},
             'title': {'help_text': "Link to title"},
+            'page_count': {'help_text': "Count of pages"},
         }
 
 
+class IssuePageSerializer(serializers.Serializer):
+    number = serializers.IntegerField(help_text="Page number starting from 1")
+    name = serializers.CharField(help_text="Page file name in archive")
+    kind = serializers.CharField(help_text="Page kind: COVER or PAGE", required=False)
+    width = serializers.IntegerField(help_text="Page image width", allow_null=True)
+    height = serializers.IntegerField(help_text="Page image height", allow_null=True)
+
+
 # Marvel API Titles
 
 
@@ -236,7 +249,8 @@ class ParserRunDetailSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.ParserRun
         fields = ("id", "parser", "parser_name", "status",
-                  "status_name", "start", "end", "items_count", "processed", "error", "error_detail", "run_details_url")
+                  "status_name", "start", "end", "items_count", "processed", "error", "error_detail", "rate_limit",
+                  "run_details_url")
         read_only_fields = fields
         extra_kwargs = {
             'id': {'help_text': "Unique identifier"},
@@ -247,7 +261,9 @@ class ParserRunDetailSerializer(serializers.HyperlinkedModelSerializer):
             'items_count': {'help_text': "Count of items to be processed"},
             'processed': {'help_text': "Count of processed items"},
             'error': {'help_text': "Error message"},
-            'error_detail': {'help_text': "Error detail"}
+            'error_detail': {'help_text': "Error detail"},
+            'rate_limit': {'help_text': "API quota status: daily quota, remaining calls, calls made and seconds until "
+                                        "next call is available"}
         }
 
 
@@ -1,6 +1,10 @@
-from celery import shared_task, group
+from celery import shared_task, group, chord
+from django.core.files.storage import default_storage
 
+from comics_db.issue_archive import build_cached_archive, delete_expired_download_manifests
+from comics_db.models import ThumbnailVariant
 from comics_db.parsers import *
+from comicsdb import settings
 from comicsdb.celery import logger
 
 parsers = {
@@ -22,13 +26,66 @@ def parser_run_task(self, parser_name, init_args):
     else:
         p = parsers[parser_name](*init_args)
         p.run(self.request.id)
+        resume_failed_run(p.parser_run)
 
 
 @shared_task(bind=True)
-def parser_continue_task(self, run_id):
+def parser_continue_task(self, run_id, attempt=0):
     run = comics_models.ParserRun.objects.get(id=run_id)
-    parser = parsers[run.parser](parser_run=run)
+    parser = parsers[run.parser].from_run(run)
     parser.run(self.request.id)
+    resume_failed_run(parser.parser_run, attempt)
+
+
+def resume_failed_run(run, attempt=0):
+    """
+    Queue continuation of resumable run which ended with critical error (e.g. API quota was exceeded or API was not
+    available). Run is continued from its checkpoints in PARSER_RESUME_DELAY, up to PARSER_RESUME_ATTEMPTS times
+    """
+    if run.status == 'CRITICAL_ERROR' and run.resumable and attempt < settings.PARSER_RESUME_ATTEMPTS:
+        run.status = 'QUEUE'
+        run.save(update_fields=['status'])
+        parser_continue_task.apply_async((run.id, attempt + 1), countdown=settings.PARSER_RESUME_DELAY)
+
+
+@shared_task(bind=True)
+def cloud_files_shard_task(self, shard_id, params):
+    shard = comics_models.ParserRunShard.objects.select_related('parser_run').get(id=shard_id)
+    parser = CloudFilesParser(parser_run=shard.parser_run, **params)
+    parser.run_shard(shard, self.request.id)
+
+
+@shared_task(bind=True)
+def cloud_files_finish_task(self, run_id, params):
+    run = comics_models.ParserRun.objects.get(id=run_id)
+    parser = CloudFilesParser(parser_run=run, **params)
+    parser.finish_shards()
+
+
+def run_cloud_files_shards(run_id, shard_ids, params):
+    """
+    Process shards of cloud files parser run in parallel and finish run when all shards end
+    """
+    flow = chord(
+        [cloud_files_shard_task.si(shard_id, params) for shard_id in shard_ids],
+        cloud_files_finish_task.si(run_id, params)
+    )
+    flow.delay()
+
+
+@shared_task(bind=True)
+def archive_cache_task(self, kind, object_id):
+    build_cached_archive(kind, object_id)
+
+
+@shared_task(bind=True)
+def download_manifests_cleanup_task(self):
+    logger.info("Deleted %d expired download manifests", delete_expired_download_manifests())
+
+
+@shared_task(bind=True)
+def thumbnail_variants_cleanup_task(self):
+    logger.info("Deleted %d unused thumbnail variants", ThumbnailVariant.delete_unused(default_storage))
 
 
 @shared_task(bind=True)
@@ -0,0 +1,32 @@
+from django import template
+
+from comics_db.fields import prefetch_variants
+
+register = template.Library()
+
+
+@register.simple_tag
+def thumbnail_url(image, width, image_format='WEBP'):
+    return image.variant_url(width, image_format)
+
+
+@register.simple_tag
+def thumbnail_srcset(image, image_format='WEBP'):
+    return image.srcset(image_format)
+
+
+@register.simple_tag
+def prefetch_thumbnail_variants(objects, *paths):
+    """
+    Load variant manifests of images of all objects with one query. Images are given by dotted attribute paths,
+    e.g. {% prefetch_thumbnail_variants issues "main_cover" "title.publisher.logo" %}
+    """
+    images = []
+    for obj in objects:
+        for path in paths:
+            image = obj
+            for attr in path.split('.'):
+                image = getattr(image, attr, None)
+            images.append(image)
+    prefetch_variants(images)
+    return ''
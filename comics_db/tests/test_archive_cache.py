@@ -0,0 +1,129 @@
+import datetime
+from unittest import mock
+
+import boto3
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from moto import mock_aws
+
+from comics_db.issue_archive import IssueArchive, build_cached_archive, get_cached_archive, get_title_archive_issues
+from comics_db.models import ArchiveCacheEntry, CloudFilesManifestEntry, Issue, Publisher, Title, TitleType
+
+BUCKET = 'comics'
+CACHE_BUCKET = 'archive-cache'
+CACHE_PREFIX = 'archive_cache/'
+
+
+@override_settings(DO_STORAGE_BUCKET_NAME=BUCKET, ARCHIVE_CACHE_BUCKET_NAME=CACHE_BUCKET,
+                   ARCHIVE_CACHE_PREFIX=CACHE_PREFIX, ARCHIVE_CACHE_MIN_DOWNLOADS=1)
+class ArchiveCacheTest(TransactionTestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=BUCKET)
+        self.client.create_bucket(Bucket=CACHE_BUCKET)
+        patcher = mock.patch('comics_db.issue_archive.get_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.title = Title.objects.create(name='X', path_key='X', publisher=Publisher.objects.create(name='P'),
+                                          title_type=TitleType.objects.create(name='T'))
+        for i in range(2):
+            self.add_issue(i)
+
+    def add_issue(self, number):
+        link = 'content/X/X #{0}.cbz'.format(number)
+        data = b'issue %d' % number
+        self.client.put_object(Bucket=BUCKET, Key=link, Body=data)
+        Issue.objects.create(name='X #{0}'.format(number), number=number, link=link, file_size=len(data),
+                             title=self.title, publish_date=datetime.date(2019, 1, 1))
+
+    def download(self):
+        archive = IssueArchive(get_title_archive_issues(self.title))
+        return get_cached_archive('TITLE', self.title.id, archive, 'X')
+
+    def cached_keys(self):
+        response = self.client.list_objects_v2(Bucket=CACHE_BUCKET)
+        return [x['Key'] for x in response.get('Contents', [])]
+
+    def test_build_keeps_concurrent_downloads(self):
+        self.assertEqual(self.download(), (None, True))
+        upload = self.client.upload_fileobj
+
+        def upload_fileobj(*args, **kwargs):
+            # Downloads registered while archive is uploaded
+            self.download()
+            self.download()
+            return upload(*args, **kwargs)
+
+        with mock.patch.object(self.client, 'upload_fileobj', upload_fileobj):
+            build_cached_archive('TITLE', self.title.id)
+        entry = ArchiveCacheEntry.objects.get()
+        self.assertEqual(entry.status, 'READY')
+        self.assertEqual(entry.downloads, 3)
+        self.assertEqual(self.cached_keys(), [entry.object_key])
+        url, build = self.download()
+        self.assertIn(entry.object_key, url)
+        self.assertFalse(build)
+
+    def test_invalidated_archive_is_deleted(self):
+        self.download()
+        build_cached_archive('TITLE', self.title.id)
+        self.assertEqual(len(self.cached_keys()), 1)
+
+        self.add_issue(2)
+        self.assertEqual(self.download(), (None, True))
+        entry = ArchiveCacheEntry.objects.get()
+        self.assertEqual(entry.object_key, '')
+        self.assertEqual(entry.downloads, 1)
+        self.assertEqual(self.cached_keys(), [])
+
+        build_cached_archive('TITLE', self.title.id)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, 'READY')
+        self.assertEqual(self.cached_keys(), [entry.object_key])
+
+    def test_issue_set_changed_during_build(self):
+        self.download()
+        upload = self.client.upload_fileobj
+
+        def upload_fileobj(*args, **kwargs):
+            self.add_issue(2)
+            self.download()
+            return upload(*args, **kwargs)
+
+        with mock.patch.object(self.client, 'upload_fileobj', upload_fileobj):
+            build_cached_archive('TITLE', self.title.id)
+        entry = ArchiveCacheEntry.objects.get()
+        # Archive of outdated issue set is never served
+        self.assertEqual(entry.status, 'NEW')
+        self.assertEqual(entry.object_key, '')
+        self.assertEqual(self.cached_keys(), [])
+        self.assertEqual(self.download(), (None, True))
+
+    def test_metadata_change_keeps_archive(self):
+        self.download()
+        build_cached_archive('TITLE', self.title.id)
+        issue = Issue.objects.first()
+        issue.desc = 'Changed'
+        issue.save()
+        url, build = self.download()
+        self.assertIsNotNone(url)
+        self.assertFalse(build)
+
+    def test_file_change_invalidates_archive(self):
+        issue = Issue.objects.first()
+        entry = CloudFilesManifestEntry.objects.create(key=issue.link, size=issue.file_size, etag='"a"',
+                                                       last_modified=timezone.now())
+        cache_key = IssueArchive(get_title_archive_issues(self.title)).cache_key
+        entry.etag = '"b"'
+        entry.save()
+        self.assertNotEqual(IssueArchive(get_title_archive_issues(self.title)).cache_key, cache_key)
+
+    def test_file_size_is_saved(self):
+        Issue.objects.update(file_size=None)
+        archive = IssueArchive(get_title_archive_issues(self.title))
+        self.assertEqual(list(Issue.objects.order_by('number').values_list('file_size', flat=True)),
+                         [member.size for member in archive.zip.members])
@@ -0,0 +1,210 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import threading
+import zipfile
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.parse import unquote, urlsplit
+
+import boto3
+from django.core import signing
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from moto import mock_aws
+
+from comics_db import download_service
+from comics_db.issue_archive import IssueArchive, ASYNC_DOWNLOAD_SALT, delete_expired_download_manifests
+from comics_db.models import Issue, Publisher, Title, TitleType
+
+BUCKET = 'comics'
+MANIFEST_PREFIX = 'download_manifests/'
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """
+    Serves GET requests of presigned URLs from mocked S3, so the service makes real HTTP requests. Responses can be
+    sent with chunked transfer encoding, and first ones can be cut in the middle of body
+    """
+    protocol_version = 'HTTP/1.1'
+    client = None
+    chunked = False
+    failures = 0
+
+    def do_GET(self):
+        _, bucket, key = urlsplit(self.path).path.split('/', 2)
+        params = {'Bucket': bucket, 'Key': unquote(key)}
+        if self.headers.get('Range'):
+            params['Range'] = self.headers['Range']
+        try:
+            response = self.client.get_object(**params)
+        except self.client.exceptions.NoSuchKey:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = response['Body'].read()
+        self.send_response(206 if 'Range' in params else 200)
+        if 'ContentRange' in response:
+            self.send_header('Content-Range', response['ContentRange'])
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 10000):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(body[i:i + 10000]), body[i:i + 10000]))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if type(self).failures and len(body) > 1000:
+            type(self).failures -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(DO_STORAGE_BUCKET_NAME=BUCKET, ASYNC_DOWNLOAD_MANIFEST_PREFIX=MANIFEST_PREFIX,
+                   ISSUE_ARCHIVE_CHUNK_SIZE=64 * 1024, ISSUE_ARCHIVE_PREFETCH=2, ISSUE_ARCHIVE_BUFFER_CHUNKS=4,
+                   S3_MAX_ATTEMPTS=3)
+class DownloadServiceTest(TransactionTestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=BUCKET)
+
+        self.handler = type('Handler', (_S3Handler,), {'client': self.client})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        # Client closes connections of cancelled downloads
+        server.handle_error = lambda request, client_address: None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        http_client = boto3.client('s3', region_name='us-east-1',
+                                   endpoint_url='http://127.0.0.1:{0}'.format(server.server_address[1]))
+        for patcher in (mock.patch('comics_db.download_service.get_client', return_value=http_client),
+                        mock.patch('comics_db.issue_archive.get_client', return_value=self.client)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        title = Title.objects.create(name='X', path_key='X', publisher=Publisher.objects.create(name='P'),
+                                     title_type=TitleType.objects.create(name='T'))
+        self.files = {}
+        issues = []
+        for i in range(4):
+            data = os.urandom(150 * 1024 + i)
+            link = 'content/X/X #{0}.cbz'.format(i)
+            self.client.put_object(Bucket=BUCKET, Key=link, Body=data)
+            self.files['X #{0}.cbz'.format(i)] = data
+            issue = Issue.objects.create(name='X #{0}'.format(i), link=link, file_size=len(data), title=title,
+                                         publish_date=datetime.date(2019, 1, 1))
+            issues.append(('X #{0}.cbz'.format(i), issue))
+        self.archive = IssueArchive(issues)
+        manifest_key = MANIFEST_PREFIX + 'test.json'
+        self.client.put_object(Bucket=BUCKET, Key=manifest_key,
+                               Body=json.dumps(self.archive.manifest('X')).encode('utf-8'))
+        self.token = signing.dumps(manifest_key, salt=ASYNC_DOWNLOAD_SALT)
+
+    def request(self, token, headers=()):
+        """
+        :return: (status, headers, body, True if response was completed) tuple
+        """
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            try:
+                await download_service.application(scope, receive, send)
+            finally:
+                await download_service.close_http_client()
+
+        scope = {'type': 'http', 'method': 'GET', 'query_string': 'token={0}'.format(token).encode(),
+                 'headers': [(name.encode(), value.encode()) for name, value in headers]}
+        asyncio.run(run())
+        return (messages[0]['status'], dict(messages[0]['headers']),
+                b''.join(x.get('body', b'') for x in messages[1:]), not messages[-1].get('more_body'))
+
+    def assertArchive(self, body):
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({x: archive.read(x) for x in archive.namelist()}, self.files)
+
+    def test_download(self):
+        status, headers, body, complete = self.request(self.token)
+        self.assertEqual(status, 200)
+        self.assertTrue(complete)
+        self.assertEqual(int(headers[b'content-length']), self.archive.size)
+        self.assertEqual(len(body), self.archive.size)
+        self.assertArchive(body)
+        # Computed CRC-32 are saved, so next archives do not need whole files for their ranges
+        self.assertEqual(dict(Issue.objects.values_list('link', 'file_crc32')),
+                         {'content/X/' + name: zlib.crc32(data) for name, data in self.files.items()})
+
+    def test_range(self):
+        _, headers, body, _ = self.request(self.token)
+        status, range_headers, part, complete = self.request(self.token, [('range', 'bytes=200000-400000'),
+                                                                          ('if-range', headers[b'etag'].decode())])
+        self.assertEqual(status, 206)
+        self.assertTrue(complete)
+        self.assertEqual(range_headers[b'content-range'],
+                         'bytes 200000-400000/{0}'.format(len(body)).encode())
+        self.assertEqual(part, body[200000:400001])
+
+    def test_chunked_response(self):
+        self.handler.chunked = True
+        status, _, body, complete = self.request(self.token)
+        self.assertEqual(status, 200)
+        self.assertTrue(complete)
+        self.assertArchive(body)
+
+    def test_interrupted_response(self):
+        # Interrupted transfers are resumed from the first byte not received
+        self.handler.failures = 2
+        _, _, body, complete = self.request(self.token)
+        self.assertTrue(complete)
+        self.assertEqual(self.handler.failures, 0)
+        self.assertArchive(body)
+
+    def test_network_failure(self):
+        self.handler.failures = 100
+        with self.assertLogs('comics_db.download_service', 'ERROR'):
+            status, _, body, complete = self.request(self.token)
+        self.assertEqual(status, 200)
+        self.assertFalse(complete)
+        self.assertLess(len(body), self.archive.size)
+
+    def test_changed_file(self):
+        # Larger file would shift archive layout, so response is not completed instead of corrupted zip
+        self.client.put_object(Bucket=BUCKET, Key='content/X/X #1.cbz', Body=os.urandom(200 * 1024))
+        with self.assertLogs('comics_db.download_service', 'ERROR'):
+            _, _, body, complete = self.request(self.token)
+        self.assertFalse(complete)
+        self.assertLess(len(body), self.archive.size)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.request('bad')[0], 403)
+
+    def test_missing_manifest(self):
+        token = signing.dumps(MANIFEST_PREFIX + 'deleted.json', salt=ASYNC_DOWNLOAD_SALT)
+        self.assertEqual(self.request(token)[0], 404)
+
+    def test_delete_expired_manifests(self):
+        self.assertEqual(delete_expired_download_manifests(), 0)
+        with override_settings(ASYNC_DOWNLOAD_TOKEN_MAX_AGE=-60):
+            self.assertEqual(delete_expired_download_manifests(), 1)
+        self.assertEqual(self.request(self.token)[0], 404)
+        # Issue files are kept
+        self.assertEqual(self.client.list_objects_v2(Bucket=BUCKET)['KeyCount'], len(self.files))
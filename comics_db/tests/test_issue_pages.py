@@ -0,0 +1,101 @@
+import datetime
+import io
+import zipfile
+from unittest import mock
+
+import boto3
+from PIL import Image
+from django.test import TestCase
+from moto import mock_aws
+
+from comics_db import issue_pages
+from comics_db.models import Issue, Publisher, Title, TitleType
+from comics_db.reader import ComicsReader, ZipBackend
+
+BUCKET = 'comics'
+
+
+def make_page(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ArchiveCacheTest(TestCase):
+    def archive(self, memory_size):
+        return mock.Mock(memory_size=memory_size, cached=False)
+
+    def test_memory_limit(self):
+        cache = issue_pages.ArchiveCache(maxsize=100, maxcount=10)
+        first, second, third = self.archive(60), self.archive(30), self.archive(40)
+        cache['first'], cache['second'] = first, second
+        cache['third'] = third
+        self.assertEqual(list(cache), ['second', 'third'])
+        first.close.assert_called_once_with()
+        second.close.assert_not_called()
+
+    def test_count_limit(self):
+        cache = issue_pages.ArchiveCache(maxsize=100, maxcount=2)
+        archives = [self.archive(0) for _ in range(3)]
+        for i, archive in enumerate(archives):
+            cache[i] = archive
+        self.assertEqual(list(cache), [1, 2])
+        archives[0].close.assert_called_once_with()
+
+    def test_large_archive_is_not_cached(self):
+        archive = self.archive(200)
+        archive.read_page.return_value = ('01.png', b'')
+        issue = mock.Mock(link='X.cb7', modified_dt=datetime.datetime(2019, 1, 1), page_index=None)
+        with mock.patch.object(issue_pages, '_archives', issue_pages.ArchiveCache(maxsize=100, maxcount=2)), \
+                mock.patch.object(issue_pages, 'OpenedArchive', return_value=archive), \
+                mock.patch.object(issue_pages, 'get_client'):
+            self.assertEqual(issue_pages.read_page(issue, 0), ('01.png', b''))
+            self.assertEqual(len(issue_pages._archives), 0)
+        archive.close.assert_called_once_with()
+
+
+class IssuePagesTest(TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        for patcher in (mock.patch.object(issue_pages, 'get_client', return_value=client),
+                        mock.patch.object(issue_pages.settings, 'DO_STORAGE_BUCKET_NAME', BUCKET)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('01.png', make_page(40, 60))
+            archive.writestr('02.png', make_page(80, 60), compress_type=zipfile.ZIP_DEFLATED)
+        self.data = buffer.getvalue()
+        client.put_object(Bucket=BUCKET, Key='content/X/X #1.cbz', Body=self.data)
+
+        title = Title.objects.create(name='X', path_key='X', publisher=Publisher.objects.create(name='P'),
+                                     title_type=TitleType.objects.create(name='T'))
+        self.issue = Issue.objects.create(name='X #1', link='content/X/X #1.cbz', file_size=len(self.data),
+                                          title=title, publish_date=datetime.date(2019, 1, 1))
+
+    def build_page_index(self):
+        with mock.patch.object(ZipBackend, 'open', side_effect=AssertionError("Page is read")):
+            with ComicsReader(io.BytesIO(self.data)) as reader:
+                return reader.build_page_index()
+
+    def test_page_index_reads_directory_only(self):
+        page_index = self.build_page_index()
+        self.assertEqual([x['name'] for x in page_index], ['01.png', '02.png'])
+        self.assertEqual([(x['width'], x['height']) for x in page_index], [(None, None), (None, None)])
+
+    def test_page_size_is_saved_on_first_read(self):
+        self.issue.page_index = self.build_page_index()
+        self.issue.save()
+        name, content = issue_pages.read_page(self.issue, 1)
+        self.assertEqual((name, Image.open(io.BytesIO(content)).size), ('02.png', (80, 60)))
+
+        self.issue.refresh_from_db()
+        self.assertEqual([(x['width'], x['height']) for x in self.issue.page_index], [(None, None), (80, 60)])
+        issue_pages.read_page(self.issue, 0)
+        self.issue.refresh_from_db()
+        self.assertEqual([(x['width'], x['height']) for x in self.issue.page_index], [(40, 60), (80, 60)])
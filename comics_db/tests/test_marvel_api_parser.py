@@ -0,0 +1,121 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from comics_db import parsers, tasks
+from comics_db.models import ParserRun
+from comics_db.parsers import MarvelAPIParser, RuntimeParserError
+from marvel_api_wrapper.endpoints import BaseEndpoint, APIRateLimitError
+
+
+class MarvelAPIParserResumeTest(TestCase):
+    TOTALS = {'creators': 150, 'characters': 50, 'events': 0, 'series': 120, 'comics': 730}
+
+    def setUp(self):
+        self.calls = []
+        self.processed = []
+        self.fail_at = ('comics', 400)
+        test = self
+
+        def get_page(endpoint, offset, **filters):
+            test.calls.append((endpoint.ENTITY_CODE, offset))
+            if (endpoint.ENTITY_CODE, offset) == test.fail_at:
+                raise APIRateLimitError
+            total = test.TOTALS[endpoint.ENTITY_CODE]
+            count = max(0, min(endpoint.PAGE_SIZE, total - offset))
+            return {'offset': offset, 'limit': endpoint.PAGE_SIZE, 'total': total, 'count': count,
+                    'results': [(endpoint.ENTITY_CODE, x) for x in range(offset, offset + count)]}
+
+        for patcher in (mock.patch.object(BaseEndpoint, 'get_page', get_page),
+                        mock.patch.object(MarvelAPIParser, '_process_item',
+                                          lambda parser, entity_type, item: self.processed.append(item) or True),
+                        mock.patch.object(MarvelAPIParser, '_postprocessing', lambda parser: None),
+                        mock.patch.object(tasks.parser_continue_task, 'apply_async')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_resume_interrupted_dump(self):
+        tasks.parser_run_task('MARVEL_API', (False,))
+        run = ParserRun.objects.get(parser='MARVEL_API')
+        # Failed run is queued for continuation
+        self.assertEqual(run.status, 'QUEUE')
+        self.assertEqual(run.checkpoints['COMICS']['offset'], 400)
+        self.assertFalse(run.checkpoints['COMICS']['complete'])
+        tasks.parser_continue_task.apply_async.assert_called_once()
+        self.assertEqual(tasks.parser_continue_task.apply_async.call_args[0][0], (run.id, 1))
+        # Responses cached by interrupted attempt are reused
+        self.assertEqual(MarvelAPIParser.from_run(run)._resume_since(), run.start.timestamp())
+
+        self.calls.clear()
+        self.fail_at = None
+        tasks.parser_continue_task(run.id, 1)
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'SUCCESS')
+        self.assertEqual(run.items_count, sum(self.TOTALS.values()))
+        # Only pages after the last checkpoint are requested
+        self.assertEqual(sorted(self.calls), [('comics', x) for x in range(400, 730, 100)])
+        self.assertEqual(len(self.processed), sum(self.TOTALS.values()))
+        self.assertEqual(len(set(self.processed)), sum(self.TOTALS.values()))
+
+    def test_resume_attempts_limit(self):
+        tasks.parser_run_task('MARVEL_API', (False,))
+        run = ParserRun.objects.get(parser='MARVEL_API')
+        tasks.parser_continue_task.apply_async.reset_mock()
+        with mock.patch.object(tasks.settings, 'PARSER_RESUME_ATTEMPTS', 1):
+            tasks.parser_continue_task(run.id, 1)
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'CRITICAL_ERROR')
+        tasks.parser_continue_task.apply_async.assert_not_called()
+
+    def test_resumable(self):
+        run = ParserRun.objects.create(parser='MARVEL_API', status='CRITICAL_ERROR')
+        self.assertTrue(run.resumable)
+        run.status = 'SUCCESS'
+        self.assertFalse(run.resumable)
+        self.assertFalse(ParserRun(parser='CLOUD_FILES', status='CRITICAL_ERROR').resumable)
+
+
+class MarvelAPIParserErrorTest(TestCase):
+    def setUp(self):
+        self.parser = MarvelAPIParser()
+        self.endpoint = self.parser._comics_endpoint
+        patcher = mock.patch.object(self.endpoint, 'session')
+        self.session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_error_is_not_retried(self):
+        self.session.get.return_value = mock.Mock(status_code=403)
+        with self.assertRaises(RuntimeParserError):
+            self.parser._get_page(self.endpoint, 0)
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_server_error_is_retried_by_endpoint_only(self):
+        self.session.get.return_value = mock.Mock(status_code=503)
+        with mock.patch.object(self.endpoint.scheduler, 'backoff'):
+            with self.assertRaises(RuntimeParserError):
+                self.parser._get_page(self.endpoint, 0)
+        self.assertEqual(self.session.get.call_count, self.endpoint.scheduler.max_retries + 1)
+
+
+class MarvelAPIParserEndpointsTest(TestCase):
+    COMIC = {'id': 1, 'resourceURI': 'http://gateway.marvel.com/v1/public/comics/1',
+             'series': {'name': 'X', 'resourceURI': 'http://gateway.marvel.com/v1/public/series/2'},
+             'events': {'available': 1, 'collectionURI': 'http://gateway.marvel.com/v1/public/comics/1/events',
+                        'items': [{'name': 'E', 'resourceURI': 'http://gateway.marvel.com/v1/public/events/3'}]}}
+
+    def test_endpoints_use_run_config(self):
+        first = MarvelAPIParser()
+        with mock.patch.object(parsers.settings, 'MARVEL_API_CONCURRENCY', 7):
+            second = MarvelAPIParser()
+        self.assertEqual(first._comics_endpoint.concurrency, parsers.settings.MARVEL_API_CONCURRENCY)
+        self.assertEqual(second._comics_endpoint.concurrency, 7)
+        self.assertIs(first._comics_endpoint.scheduler, first._scheduler)
+        self.assertIs(second._comics_endpoint.scheduler, second._scheduler)
+        self.assertIsInstance(second._scheduler.store, parsers.DatabaseRateLimitStore)
+
+        # Endpoints of nested entities are built with configuration of endpoint which returned them
+        comic = second._comics_endpoint.convert_result({'data': {'results': [dict(self.COMIC)]}})['results'][0]
+        for endpoint in (comic.series._entity_endpoint, comic.events._entities_endpoint,
+                         comic.events.items[0]._entity_endpoint):
+            self.assertIs(endpoint.scheduler, second._scheduler)
+            self.assertEqual(endpoint.concurrency, 7)
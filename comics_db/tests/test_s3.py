@@ -0,0 +1,48 @@
+import io
+import os
+import zipfile
+
+import boto3
+from django.test import SimpleTestCase
+from moto import mock_aws
+
+from comics_db.reader import ComicsReader
+from comics_db.s3 import S3RangeFile
+
+
+class S3RangeFileTest(SimpleTestCase):
+    BUCKET = 'comics'
+    KEY = 'content/Marvel/Earth-616/2019/Ongoing/X/X #1.cbz'
+
+    def setUp(self):
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=self.BUCKET)
+
+        # 3 MB archive of incompressible pages, cover is the first member
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for i in range(30):
+                archive.writestr('page%03d.jpg' % i, os.urandom(100 * 1024))
+        self.data = buffer.getvalue()
+        self.client.put_object(Bucket=self.BUCKET, Key=self.KEY, Body=self.data)
+
+    def test_read(self):
+        with S3RangeFile(self.client, self.BUCKET, self.KEY) as f:
+            self.assertEqual(f.size, len(self.data))
+            f.seek(1000)
+            self.assertEqual(f.read(5000), self.data[1000:6000])
+            f.seek(-100, io.SEEK_END)
+            self.assertEqual(f.read(), self.data[-100:])
+
+    def test_cover_read_is_ranged(self):
+        with S3RangeFile(self.client, self.BUCKET, self.KEY, len(self.data)) as f:
+            reader = ComicsReader(f)
+            self.assertEqual(reader.get_file_list()[0], 'page000.jpg')
+            with reader.get_page_file(0) as cover:
+                self.assertEqual(len(cover.read()), 100 * 1024)
+            # Central directory and cover only, not whole archive
+            self.assertLessEqual(f.requests_count, 3)
+            self.assertLess(f.bytes_fetched, 256 * 1024)
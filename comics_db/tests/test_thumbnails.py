@@ -0,0 +1,51 @@
+import shutil
+import tempfile
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from comics_db.fields import check_variant_signature
+from comics_db.models import Publisher, ThumbnailVariant
+
+
+class ThumbnailVariantTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.storage = FileSystemStorage(location=self.media_root)
+        self.publisher = Publisher.objects.create(name='P')
+        self.logo = self.save_image('logo.png')
+        self.publisher.logo = self.logo
+        self.publisher.save()
+
+    def save_image(self, name):
+        buffer = BytesIO()
+        Image.new('RGB', (400, 200)).save(buffer, 'PNG')
+        return self.storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_lazy_variant_url_is_signed(self):
+        url = urlsplit(self.publisher.logo.variant_url(100, 'WEBP'))
+        signature = parse_qs(url.query)['signature'][0]
+        self.assertTrue(check_variant_signature(self.logo, 100, 'WEBP', signature))
+        self.assertFalse(check_variant_signature(self.logo, 200, 'WEBP', signature))
+        self.assertFalse(check_variant_signature('other.png', 100, 'WEBP', signature))
+
+    def test_undeclared_variant_url(self):
+        self.assertEqual(self.publisher.logo.variant_url(150, 'WEBP'), self.publisher.logo.url)
+
+    def test_delete_unused(self):
+        used = ThumbnailVariant.get_or_create_variant(self.storage, self.logo, 100, 'WEBP')
+        undeclared = ThumbnailVariant.get_or_create_variant(self.storage, self.logo, 150, 'WEBP')
+        replaced = self.save_image('replaced.png')
+        orphan = ThumbnailVariant.get_or_create_variant(self.storage, replaced, 100, 'WEBP')
+
+        self.assertEqual(ThumbnailVariant.delete_unused(self.storage, chunk_size=1), 2)
+        self.assertEqual(list(ThumbnailVariant.objects.values_list('name', flat=True)), [used])
+        self.assertTrue(self.storage.exists(used))
+        self.assertFalse(self.storage.exists(undeclared))
+        self.assertFalse(self.storage.exists(orphan))
+
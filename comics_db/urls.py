@@ -105,6 +105,7 @@ urlpatterns = [
     path('issue/<str:slug>/mark-read', views.IssueMarkRead.as_view(), name="site-issue-mark-read"),
     path('issue/<str:slug>/delete', views.IssueDelete.as_view(), name="site-issue-delete"),
     path('issue/<str:slug>/add-to-list', views.IssueAddToReadingList.as_view(), name="site-issue-add-to-list"),
+    path('issue/<str:slug>/page/<int:number>', views.IssuePage.as_view(), name="site-issue-page"),
 
     # Reading lists
     path('reading-lists', views.ReadingListListView.as_view(), name="site-user-reading-lists"),
@@ -117,9 +118,14 @@ urlpatterns = [
     path('reading-list/<str:list_slug>/issue/<str:slug>', views.ReadingListIssueDetailView.as_view(),
          name="site-reading-list-issue"),
 
+    # Thumbnails
+    path('thumbnail/<int:width>/<str:image_format>/<path:name>', views.ThumbnailVariantView.as_view(),
+         name="thumbnail-variant"),
+
     # Parser log
     path('parser_log', views.ParserLogView.as_view(), name="site-parser-log"),
     path('parser_log/<int:pk>', views.ParserRunDetail.as_view(), name="parser-log-detail"),
+    path('parser_log/<int:pk>/resume', views.ParserRunResume.as_view(), name="parser-run-resume"),
     path('run_parser', views.ParserRun.as_view(), name="run-parser"),
 
     # Parser schedule
@@ -1,18 +1,21 @@
 import datetime
 import inspect
 import json
-import math
-import os
+import mimetypes
 
+from PIL import Image
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.exceptions import ValidationError, PermissionDenied
+from django.core.files.storage import default_storage
 from django.db import IntegrityError
 from django.db.models import Count, Q, Max, Case, When, F
 from django.forms import ModelForm
-from django.http import Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse, reverse_lazy
 from django.utils import formats
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.views.generic import DetailView, ListView
 from django.views.generic.base import View, TemplateView
 from django_celery_beat.models import PeriodicTask, IntervalSchedule, CrontabSchedule
@@ -31,9 +34,11 @@ from rest_framework.viewsets import GenericViewSet
 from knox.settings import CONSTANTS, knox_settings
 from el_pagination.views import AjaxListView
 
-from comics_db import models, serializers, filtersets, tasks, forms
+from comics_db import models, serializers, filtersets, tasks, forms, issue_pages
 # from comics_db.models import ReadingListIssue
-from comics_db.issue_archive import S3FileWrapper, construct_archive
+from comics_db.fields import check_variant_signature
+from comics_db.issue_archive import construct_archive, get_cached_archive, get_title_archive_issues, \
+    get_reading_list_archive_issues, get_async_download_url, parse_range
 from comicsdb import settings
 
 
@@ -110,6 +115,49 @@ class SearchMixin:
         return queryset
 
 
+class ArchiveDownloadMixin:
+    """
+    Mixin for views downloading zip of issues. Single byte range requests are supported, so interrupted download can be
+    resumed (see IssueArchive). Range is ignored if If-Range does not match archive ETag.
+
+    If archive cache is enabled, frequently downloaded archives are pre-built by background task and downloads are
+    redirected to them. Other downloads are redirected to async download service if it is enabled, so gunicorn worker
+    only builds archive manifest
+    """
+
+    def archive_response(self, issues, filename, cache_kind, cache_object_id):
+        archive = construct_archive(issues)
+        url, build = get_cached_archive(cache_kind, cache_object_id, archive, filename)
+        if build:
+            tasks.archive_cache_task.delay(cache_kind, cache_object_id)
+        if url:
+            return HttpResponseRedirect(url)
+        if settings.ASYNC_DOWNLOAD_URL:
+            return HttpResponseRedirect(get_async_download_url(archive, filename))
+
+        etag = archive.etag
+        byte_range = None
+        if self.request.META.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = parse_range(self.request.META.get('HTTP_RANGE'), archive.size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = "bytes */{0}".format(archive.size)
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(archive.iter_range(start, end), status=206,
+                                             content_type="application/zip")
+            response['Content-Range'] = "bytes {0}-{1}/{2}".format(start, end - 1, archive.size)
+            response['Content-Length'] = end - start
+        else:
+            response = StreamingHttpResponse(archive, content_type="application/zip")
+            response['Content-Length'] = archive.size
+        response['Content-Disposition'] = "attachment; filename=\"{0}.zip\"".format(filename)
+        response['Accept-Ranges'] = "bytes"
+        response['ETag'] = etag
+        return response
+
+
 class SublistMixin:
     parent_model = None
     parent_model_key = "slug"
@@ -386,6 +434,28 @@ class IssueDelete(View, UserPassesTestMixin):
         return HttpResponseRedirect(redirect_url)
 
 
+class IssuePage(View):
+    """
+    Serve one page of issue archive. Pages are numbered from 1
+    """
+
+    def get(self, request, slug, number):
+        issue = get_object_or_404(models.Issue, slug=slug)
+        etag = '"{0}-{1}-{2}"'.format(issue.id, int(issue.modified_dt.timestamp()), number)
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=int(issue.modified_dt.timestamp()))
+        if response is None:
+            try:
+                name, content = issue_pages.read_page(issue, number - 1)
+            except IndexError:
+                raise Http404("Issue has no page %s" % number)
+            response = HttpResponse(content, content_type=mimetypes.guess_type(name)[0] or "application/octet-stream")
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(issue.modified_dt.timestamp())
+        patch_cache_control(response, public=True, max_age=settings.ISSUE_PAGE_MAX_AGE)
+        return response
+
+
 class IssueMarkRead(View, LoginRequiredMixin):
     def post(self, request, slug):
         try:
@@ -570,7 +640,9 @@ class ParserRun(UserPassesTestMixin, View):
                 full = bool(request.POST['cloud-full'])
                 load_covers = bool(request.POST['cloud-load-cover'])
                 marvel_api_merge = bool(request.POST['cloud-marvel-api-merge'])
-                args = (path_root, full, load_covers, marvel_api_merge)
+                sharded = bool(request.POST['cloud-sharded'])
+                download_archives = bool(request.POST['cloud-download-archives'])
+                args = (path_root, full, load_covers, marvel_api_merge, sharded, download_archives)
             elif parser == 'MARVEL_API':
                 incremental = request.POST['marvel-api-incremental']
                 args = (incremental,)
@@ -582,6 +654,24 @@ class ParserRun(UserPassesTestMixin, View):
             return JsonResponse({'status': 'error', 'message': err.args[0]})
 
 
+class ParserRunResume(UserPassesTestMixin, View):
+    """
+    Continue failed run of resumable parser from its checkpoints
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def post(self, request, pk):
+        parser_run = get_object_or_404(models.ParserRun, pk=pk)
+        # Only one request queues continuation
+        if not parser_run.resumable or not models.ParserRun.objects.filter(
+                id=parser_run.id, status=parser_run.status).update(status='QUEUE'):
+            return JsonResponse({'status': 'error', 'message': 'Run can not be resumed'})
+        tasks.parser_continue_task.delay(parser_run.id)
+        return JsonResponse({'status': 'success', 'message': '%s resumed' % parser_run.parser_name})
+
+
 ########################################################################################################################
 # Parser Schedule
 ########################################################################################################################
@@ -905,48 +995,35 @@ class ReadingListIssueDetailView(BreadcrumbMixin, FormUpdateMixin, DetailView):
         return HttpResponseRedirect(reverse('site-reading-list-issue', args=(kwargs['list_slug'], kwargs['slug'])))
 
 
-class ReadingListDownload(View):
+class ReadingListDownload(ArchiveDownloadMixin, View):
     def get(self, request, slug):
         rl = get_object_or_404(models.ReadingList, slug=slug)
 
-        queryset = models.ReadingListIssue.objects.filter(reading_list=rl).select_related('issue', 'issue__title')
+        return self.archive_response(get_reading_list_archive_issues(rl), rl, 'READING_LIST', rl.id)
 
-        if rl.sorting == 'MANUAL':
-            queryset = queryset.order_by('order')
-            num_length = math.ceil(math.log10(queryset.count()))
-
-            issues = [
-                (
-                    "{list_name}/{num} - [{issue.title.name}]{issue.name}.{issue_ext}".format(
-                        list_name=rl,
-                        num=str(num).rjust(num_length, '0'),
-                        issue=rl_issue.issue,
-                        issue_ext=os.path.splitext(rl_issue.issue.link)[1]
-                    ),
-                    rl_issue.issue.link
-                )
-                for num, rl_issue in enumerate(queryset, 1)
-            ]
 
-        else:
-            issues = [
-                (
-                    "{list_name}/{title}/[{title.name}]{issue_name}.{issue_ext}".format(
-                        list_name=rl,
-                        title=rl_issue.issue.title,
-                        issue_name=rl_issue.issue.name,
-                        issue_ext=os.path.splitext(rl_issue.issue.link)[1]
-                    ),
-                    rl_issue.issue.link
-                )
-                for num, rl_issue in enumerate(queryset)
-            ]
+########################################################################################################################
+# Thumbnails
+########################################################################################################################
 
-        z = construct_archive(issues)
 
-        response = StreamingHttpResponse(z, content_type="application/zip")
-        response['Content-Disposition'] = "attachment; filename=\"{0}.zip\"".format(rl)
-        return response
+class ThumbnailVariantView(View):
+    """
+    Generate ThumbnailImageField variant on first request and redirect to it. Only URLs signed by
+    ThumbnailImageFieldFile.variant_url are served, so only declared variants of images stored in ThumbnailImageField
+    fields are generated
+    """
+
+    def get(self, request, width, image_format, name):
+        if not check_variant_signature(name, width, image_format, request.GET.get('signature', '')) or \
+                not default_storage.exists(name):
+            raise Http404()
+        try:
+            variant = models.ThumbnailVariant.get_or_create_variant(default_storage, name, width, image_format)
+        except (OSError, Image.DecompressionBombError):
+            # Stored file is not a valid image
+            raise Http404()
+        return HttpResponseRedirect(default_storage.url(variant))
 
 
 ########################################################################################################################
@@ -1093,20 +1170,11 @@ class TitleAddToReadingList(View, LoginRequiredMixin):
                                                                'Error message: %s' % err.args[0]})
 
 
-class TitleDownload(View):
+class TitleDownload(ArchiveDownloadMixin, View):
     def get(self, request, slug):
         title = get_object_or_404(models.Title, slug=slug)
 
-        issues = list(
-            map(lambda x: ("{0}/[{0.name}] {1}.{2}".format(title, x.name, os.path.splitext(x.link)[1]), x.link),
-                title.issues.all()))
-
-        z = construct_archive(issues)
-
-        response = StreamingHttpResponse(z, content_type="application/zip")
-        response['Content-Disposition'] = "attachment; filename=\"{0}.zip\"".format(title)
-
-        return response
+        return self.archive_response(get_title_archive_issues(title), title, 'TITLE', title.id)
 
 
 ########################################################################################################################
@@ -1768,6 +1836,7 @@ class IssueViewSet(ComicsDBBaseViewSet):
         'list': serializers.IssueListSerializer,
         'retrieve': serializers.IssueDetailSerializer,
         'set_api_series': serializers.IssueDetailSerializer,
+        'pages': serializers.IssuePageSerializer,
     }
     queryset = models.Issue.objects.all()
     filterset_classes = {
@@ -1782,6 +1851,19 @@ class IssueViewSet(ComicsDBBaseViewSet):
         'list': ("title__publisher__name", "title__universe__name", "title__name", "publish_date", "number")
     }
 
+    @action(detail=True, name="Issue's pages")
+    def pages(self, request, pk):
+        """
+        Issue pages
+
+        Return pages of issue with specified `id` in reading order. First page is cover. Scanner credits and
+        duplicate images are not listed. Empty list is returned if issue archive was not read yet
+        """
+        issue = get_object_or_404(models.Issue, pk=pk)
+        pages = [dict(page, number=number) for number, page in enumerate(issue.page_index or [], 1)]
+        serializer = self.get_serializer(pages, many=True)
+        return Response(serializer.data)
+
     @action(detail=True, name="Set api comic", methods=['post'])
     def set_api_comic(self, request, pk):
         db_issue = get_object_or_404(models.Issue, pk=pk)
@@ -2062,7 +2144,9 @@ class ParserScheduleViewSet(mixins.ListModelMixin, mixins.CreateModelMixin, mixi
                 full = bool(request.POST['cloud-full'])
                 load_covers = bool(request.POST['cloud-load-cover'])
                 marvel_api_merge = bool(request.POST['cloud-marvel-api-merge'])
-                init_args = (path_root, full, load_covers)
+                sharded = bool(request.POST['cloud-sharded'])
+                download_archives = bool(request.POST['cloud-download-archives'])
+                init_args = (path_root, full, load_covers, marvel_api_merge, sharded, download_archives)
                 task = 'comics_db.tasks.parser_run_task'
                 task_args = json.dumps((parser, init_args))
             elif parser == 'MARVEL_API':
@@ -0,0 +1,15 @@
+"""
+ASGI config of async download service (see comics_db.download_service).
+
+It exposes the ASGI callable as a module-level variable named ``application``. Run it with any ASGI server, e.g.
+``uvicorn comicsdb.asgi:application``
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'comicsdb.settings')
+django.setup()
+
+from comics_db.download_service import application  # noqa: E402
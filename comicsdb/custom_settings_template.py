@@ -32,6 +32,9 @@ DO_OBJECT_PARAMETERS = {
     'CacheControl': 'max-age=86400',
 }
 DO_PUBLIC_URL = "https://comicsdb.ams3.cdn.digitaloceanspaces.com"
+DO_ARCHIVE_CACHE_BUCKET_NAME = None  # Bucket for pre-built title and reading list archives, None disables cache
+ASYNC_DOWNLOAD_URL = None  # URL of async download service (comicsdb.asgi), None serves downloads from Django views
+MARVEL_API_CACHE_DIR = None  # Directory for Marvel API response cache, None disables cache
 
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
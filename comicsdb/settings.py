@@ -228,9 +228,71 @@ CELERY_RESULT_BACKEND = \
         DATABASES['default']['PORT'],
     )
 
+# Thumbnail variants generated on first request for ThumbnailImageField without own variants: (width, format)
+THUMBNAIL_VARIANTS = ((100, 'WEBP'), (200, 'WEBP'), (380, 'WEBP'), (100, 'JPEG'), (200, 'JPEG'), (380, 'JPEG'))
+THUMBNAIL_VARIANTS_CLEANUP_INTERVAL = 24 * 60 * 60  # Seconds between deletions of unused variants
+
+# Online reader settings
+ISSUE_PAGE_CACHE_SIZE = 16  # Opened issue archives kept by one worker process
+ISSUE_PAGE_CACHE_MEMORY = 256 * 1024 * 1024  # Bytes kept in memory by opened issue archives of one worker process
+ISSUE_PAGE_MAX_AGE = 7 * 24 * 60 * 60  # Browser cache lifetime of issue pages, seconds
+
+# Shared S3 client settings (see comics_db.s3.get_client)
+S3_MAX_POOL_CONNECTIONS = 32  # Kept-alive connections, should cover ISSUE_ARCHIVE_PREFETCH and parser workers
+S3_CONNECT_TIMEOUT = 5  # Seconds
+S3_READ_TIMEOUT = 60  # Seconds
+S3_MAX_ATTEMPTS = 5  # Retries of throttled and failed requests
+
+# Multiple issues download settings
+ISSUE_ARCHIVE_PREFETCH = 4  # Issue files downloaded concurrently while zip is streamed
+ISSUE_ARCHIVE_CHUNK_SIZE = 1024 * 1024  # Bytes read from S3 object body at once
+ISSUE_ARCHIVE_BUFFER_CHUNKS = 8  # Chunks buffered for one prefetched file
+
+# Pre-built archive cache settings
+ARCHIVE_CACHE_BUCKET_NAME = getattr(custom_settings, 'DO_ARCHIVE_CACHE_BUCKET_NAME', None)  # None disables cache
+ARCHIVE_CACHE_PREFIX = 'archive_cache/'
+ARCHIVE_CACHE_MIN_DOWNLOADS = 3  # Downloads of the same issue set before archive is pre-built
+ARCHIVE_CACHE_URL_EXPIRES = 60 * 60  # Lifetime of redirect URL to cached archive, seconds
+
+# Async download service settings (see comics_db.download_service)
+ASYNC_DOWNLOAD_URL = getattr(custom_settings, 'ASYNC_DOWNLOAD_URL', None)  # None serves downloads from Django views
+ASYNC_DOWNLOAD_MANIFEST_PREFIX = 'download_manifests/'
+ASYNC_DOWNLOAD_TOKEN_MAX_AGE = 60 * 60  # Lifetime of download URL, seconds
+
+# Periodic tasks installed to django_celery_beat schedule
+CELERY_BEAT_SCHEDULE = {
+    'download-manifests-cleanup': {
+        'task': 'comics_db.tasks.download_manifests_cleanup_task',
+        'schedule': ASYNC_DOWNLOAD_TOKEN_MAX_AGE,  # Manifests are deleted not later than in two URL lifetimes
+    },
+    'thumbnail-variants-cleanup': {
+        'task': 'comics_db.tasks.thumbnail_variants_cleanup_task',
+        'schedule': THUMBNAIL_VARIANTS_CLEANUP_INTERVAL,
+    },
+}
+
+# Failed runs of resumable parsers (see ParserRun.RESUMABLE_PARSERS) are continued automatically
+PARSER_RESUME_ATTEMPTS = 3
+PARSER_RESUME_DELAY = 6 * 60 * 60  # Seconds, lets API quota recover
+
+# Cloud files parser settings
+CLOUD_FILES_PARSER_COVER_WORKERS = 8  # Threads reading issue archives (covers and page indexes)
+CLOUD_FILES_PARSER_COVER_RETRIES = 2  # Retries for one archive after first failed attempt
+
 # Marvel API settings
 MARVEL_PUBLIC_KEY = custom_settings.MARVEL_PUBLIC_KEY
 MARVEL_PRIVATE_KEY = custom_settings.MARVEL_PRIVATE_KEY
+MARVEL_API_CONCURRENCY = 4  # Pages of one list requested at once
+MARVEL_API_DAILY_QUOTA = 3000  # API calls per day, shared by all workers
+MARVEL_API_MAX_RETRIES = 9  # Retries for one call after connection or server error
+MARVEL_API_RATE_LIMIT_RETRIES = 48  # Retries for one call after quota exceeded response
+MARVEL_API_BACKOFF_MAX = 30 * 60  # Maximal delay between retries, seconds
+MARVEL_API_CONNECT_TIMEOUT = 5  # Seconds
+MARVEL_API_READ_TIMEOUT = 60  # Seconds, stuck requests fail and are retried instead of hanging worker
+MARVEL_API_CACHE_DIR = getattr(custom_settings, 'MARVEL_API_CACHE_DIR', None)  # None disables response cache
+MARVEL_API_CACHE_TTL = 60 * 60  # Cached responses younger than this are used without revalidation, seconds
+MARVEL_API_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # Responses not refreshed for longer are pruned after run, seconds
+MARVEL_API_CACHE_MAX_SIZE = 2 * 1024 ** 3  # Oldest responses are pruned after run above this cache size, bytes
 
 # Endless Pagination Settings
 EL_PAGINATION_PER_PAGE = 20
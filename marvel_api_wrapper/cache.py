@@ -0,0 +1,103 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses.
+
+    Responses are stored as gzipped JSON in files named by hash of endpoint URL and request filters (auth parameters
+    are not included), so the same request made by another run or process hits the same entry.
+
+    Entry is used without request when it is younger than ttl or was stored after resume_since (resume mode, used to
+    re-run failed dump without spending quota on pages loaded by failed run). Other entries are revalidated with
+    If-None-Match request by stored ETag, 304 response refreshes entry.
+
+    Entries are not evicted on write, cache owner should call prune periodically.
+    """
+
+    def __init__(self, directory, ttl=0, resume_since=None):
+        """
+        :param directory: cache directory, created if not exists
+        :param ttl: entry lifetime without revalidation, seconds
+        :param resume_since: timestamp, entries stored after it are used without revalidation
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.resume_since = resume_since
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url, filters):
+        key = hashlib.sha256(json.dumps([url, sorted(filters.items())], default=str).encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, url, filters):
+        """
+        :return: entry {'etag': ETag or None, 'stored': timestamp, 'response': response JSON} or None
+        """
+        try:
+            with gzip.open(self._path(url, filters), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry):
+        """
+        Can entry be used without revalidation
+        """
+        if self.resume_since is not None and entry['stored'] >= self.resume_since:
+            return True
+        return time.time() - entry['stored'] < self.ttl
+
+    def set(self, url, filters, response, etag=None):
+        path = self._path(url, filters)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'etag': etag, 'stored': time.time(), 'response': response}
+        # Written to temporary file and renamed, so concurrent readers never see partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def prune(self, max_age=None, max_size=None):
+        """
+        Delete entries stored more than max_age seconds ago, then the oldest entries until cache takes no more than
+        max_size bytes. Entries are rewritten on revalidation, so entries of requests which are still made are kept
+
+        :param max_age: entry lifetime since it was stored or refreshed, seconds. None disables age limit
+        :param max_size: cache size limit, bytes. None disables size limit
+        :return: number of deleted entries
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Deleted by concurrent process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        now = time.time()
+        total_size = sum(size for _, size, _ in entries)
+        deleted = 0
+        for stored, size, path in entries:
+            if (max_age is None or now - stored <= max_age) and (max_size is None or total_size <= max_size):
+                break
+            try:
+                os.unlink(path)
+                deleted += 1
+            except OSError:
+                pass
+            total_size -= size
+        return deleted
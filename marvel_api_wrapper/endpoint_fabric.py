@@ -1,27 +1,62 @@
+import contextlib
+import contextvars
+
+from marvel_api_wrapper.session import create_session
+
+# Fabric of endpoint converting API response, used by entities to build endpoints of their summaries and resource lists
+_current = contextvars.ContextVar('endpoint_fabric', default=None)
 
 
 class EndpointFabric:
-    __instance = None
+    """
+    Builds endpoints sharing one API configuration: keys, concurrency, rate scheduler, HTTP session, timeouts and
+    response cache. Every API client (e.g. parser run) creates own fabric, so configurations never leak between clients.
+    Entities returned by endpoint build their nested endpoints with fabric of that endpoint
+    """
+
+    def __init__(self, public_key=None, private_key=None, concurrency=None, scheduler=None, timeout=None, cache=None,
+                 session=None):
+        self.public_key = public_key
+        self.private_key = private_key
+        self.concurrency = concurrency
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.cache = cache
+        # Shared by all endpoints, so connections are reused between pages, lists and entity collections
+        self.session = session or create_session(pool_size=max(concurrency or 1, 10))
 
     @staticmethod
-    def get_instance(public_key=None, private_key=None):
-        if not EndpointFabric.__instance:
-            EndpointFabric.__instance = EndpointFabric(public_key, private_key)
-        return EndpointFabric.__instance
-
-    def __init__(self, public_key=None, private_key=None):
-        if EndpointFabric.__instance:
-            raise Exception("This class is a singleton!")
-        else:
-            self.public_key = public_key
-            self.private_key = private_key
-            EndpointFabric.__instance = self
+    def current():
+        """
+        Fabric of endpoint which is converting API response to entities
+        """
+        fabric = _current.get()
+        if fabric is None:
+            raise RuntimeError("Entities should be created by endpoint")
+        return fabric
+
+    @contextlib.contextmanager
+    def bind(self):
+        """
+        Make fabric current while entities are created
+        """
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
 
     def get_endpoint(self, klass, endpoint_url=None, entity_id=None):
         kwargs = {
             'public_key': self.public_key,
             'private_key': self.private_key,
             'endpoint_url': endpoint_url,
-            'id': entity_id
+            'id': entity_id,
+            'concurrency': self.concurrency,
+            'scheduler': self.scheduler,
+            'session': self.session,
+            'timeout': self.timeout,
+            'cache': self.cache,
+            'fabric': self
         }
         return klass(**kwargs)
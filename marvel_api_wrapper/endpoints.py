@@ -1,12 +1,17 @@
 import datetime
 import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 from typing import Optional
 
-import requests
 from requests import RequestException
 
 import marvel_api_wrapper.entities # import BaseEntity, Creator, Comic, Character, Event, Series
+from marvel_api_wrapper.endpoint_fabric import EndpointFabric
+from marvel_api_wrapper.rate_limit import RateScheduler
+from marvel_api_wrapper.session import create_session
 
 
 class APIError(Exception):
@@ -17,15 +22,31 @@ class APIRateLimitError(Exception):
     pass
 
 
+# Used by endpoints created without scheduler or session, shared by threads of one process
+DEFAULT_SCHEDULER = RateScheduler()
+DEFAULT_SESSION = create_session()
+DEFAULT_TIMEOUT = (5, 60)  # Connect and read timeouts, seconds
+
+
 class BaseEndpoint:
-    __slots__ = ['_public_key', '_private_key', 'endpoint_url']
+    __slots__ = ['_public_key', '_private_key', 'endpoint_url', 'concurrency', 'scheduler', 'session', 'timeout',
+                 'cache', 'fabric']
     BASE_URL = "https://gateway.marvel.com/v1/public/"
     ENTITY_CODE = None
     ENTITY_CLASS = marvel_api_wrapper.entities.BaseEntity
+    PAGE_SIZE = 100
 
     def __init__(self, **kwargs):
         self._public_key = kwargs.get('public_key')
         self._private_key = kwargs.get('private_key')
+        self.concurrency = kwargs.get('concurrency') or 1
+        self.scheduler = kwargs.get('scheduler') or DEFAULT_SCHEDULER
+        self.session = kwargs.get('session') or DEFAULT_SESSION
+        self.timeout = kwargs.get('timeout') or DEFAULT_TIMEOUT
+        self.cache = kwargs.get('cache')
+        # Endpoints of entities returned by this endpoint are built with the same configuration
+        self.fabric = kwargs.get('fabric') or EndpointFabric(self._public_key, self._private_key, self.concurrency,
+                                                             self.scheduler, self.timeout, self.cache, self.session)
         self.endpoint_url = self._construct_endpoint_url(**kwargs)
 
     def _construct_endpoint_url(self, **kwargs) -> Optional[str]:
@@ -38,54 +59,102 @@ class BaseEndpoint:
         params = {'apikey': self._public_key, 'ts': ts, 'hash': m.hexdigest()}
         return params
 
-    def get(self, retries=9, **filters) -> dict:
-        params = filters
-        params.update(self._get_auth_params())
-        print(filters)
-        try:
-            r = requests.get(self.endpoint_url, params=params, timeout=None)
-            data = r.json()
-            if r.status_code == 200:
-                return self.convert_result(data)
-            elif r.status_code == 401:
-                raise APIError('Invalid credentials: %s' % data['message'])
-            elif r.status_code == 409:
-                raise APIError('Parameter error: %s' % data['status'])
-            elif r.status_code == 429:
-                raise APIRateLimitError
-            else:
-                if retries:
-                    return self.get(retries - 1, **filters)
-                else:
-                    r.raise_for_status()
-        except (RequestException, ConnectionError):
-            if retries:
-                print("retry")
-                return self.get(retries - 1, **filters)
-            else:
+    def get(self, **filters) -> dict:
+        """
+        Request endpoint. Every request takes token from rate scheduler; connection errors, 5xx and 429 responses are
+        retried with backoff. If endpoint has response cache, fresh cached response is returned without request and
+        stale one is revalidated by ETag
+        """
+        entry = self.cache.get(self.endpoint_url, filters) if self.cache else None
+        if entry and self.cache.is_fresh(entry):
+            return self.convert_result(entry['response'])
+        headers = {'If-None-Match': entry['etag']} if entry and entry['etag'] else None
+
+        errors = 0
+        rate_limit_errors = 0
+        while True:
+            self.scheduler.acquire()
+            params = dict(filters, **self._get_auth_params())
+            try:
+                r = self.session.get(self.endpoint_url, params=params, headers=headers, timeout=self.timeout)
+                if r.status_code == 200:
+                    data = r.json()
+                    if self.cache:
+                        self.cache.set(self.endpoint_url, filters, data, data.get('etag') or r.headers.get('ETag'))
+                    return self.convert_result(data)
+                elif r.status_code == 304:
+                    self.cache.set(self.endpoint_url, filters, entry['response'], entry['etag'])
+                    return self.convert_result(entry['response'])
+                elif r.status_code == 401:
+                    raise APIError('Invalid credentials: %s' % r.json()['message'])
+                elif r.status_code == 409:
+                    raise APIError('Parameter error: %s' % r.json()['status'])
+                elif r.status_code == 429:
+                    # Quota is exceeded for all processes using the same bucket
+                    self.scheduler.drain()
+                    if rate_limit_errors >= self.scheduler.rate_limit_retries:
+                        raise APIRateLimitError
+                    self.scheduler.backoff(rate_limit_errors)
+                    rate_limit_errors += 1
+                    continue
+                elif r.status_code < 500:
+                    raise APIError('Unexpected response from %s: HTTP %s' % (self.endpoint_url, r.status_code))
+            except (RequestException, ConnectionError):
+                pass
+            except JSONDecodeError:
+                raise APIError('Could not parse API response from %s' % self.endpoint_url)
+
+            if errors >= self.scheduler.max_retries:
                 raise APIError('Could not establish connection to %s' % self.endpoint_url)
-        except JSONDecodeError:
-            raise APIError('Could not parse API response from %s' % self.endpoint_url)
+            self.scheduler.backoff(errors)
+            errors += 1
+
+    def get_page(self, offset, **filters) -> dict:
+        return self.get(offset=offset, limit=self.PAGE_SIZE, **filters)
+
+    def iter_pages(self, get_page=None, start=0, **filters):
+        """
+        Yield pages of results in offset order.
+
+        First page (at start offset) is requested alone to get total count, then remaining pages are requested
+        concurrently by `concurrency` threads. No more than `concurrency` pages are requested ahead of consumer, so
+        API calls in flight match configured concurrency and pages are not accumulated in memory when consumer is
+        slower than API
+
+        :param get_page: function(offset, **filters) requesting one page, get_page method by default
+        :param start: offset of first page, e.g. to resume interrupted iteration
+        """
+        get_page = get_page or self.get_page
+        data = get_page(start, **filters)
+        yield data
+        if not data['count']:
+            return
+
+        offsets = iter(range(start + self.PAGE_SIZE, data['total'], self.PAGE_SIZE))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = deque(executor.submit(get_page, offset, **filters)
+                            for offset in itertools.islice(offsets, self.concurrency))
+            try:
+                while pending:
+                    data = pending.popleft().result()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pending.append(executor.submit(get_page, offset, **filters))
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def get_all(self, **filters):
         results = []
-        offset = 0
-        total = None
-
-        while total is None or offset < total:
-            filters['offset'] = offset
-            filters['limit'] = 100
-            data = self.get(**filters)
+        for data in self.iter_pages(**filters):
             results += data['results']
-            total = data['total']
-            offset += data['count']
-            print(total, offset)
-
         return results
 
     def convert_result(self, data):
         data = data['data']
-        objects = [self.ENTITY_CLASS.create_from_dict(x) for x in data['results']]
+        with self.fabric.bind():
+            objects = [self.ENTITY_CLASS.create_from_dict(x) for x in data['results']]
         data['results'] = objects
         return data
 
@@ -111,7 +180,8 @@ class SingleEndpoint(BaseEndpoint):
 
     def convert_result(self, data):
         data = data['data']
-        obj = self.ENTITY_CLASS.create_from_dict(data['results'][0])
+        with self.fabric.bind():
+            obj = self.ENTITY_CLASS.create_from_dict(data['results'][0])
         return obj
 
 
@@ -186,7 +186,7 @@ class BaseSummary(MarvelAPIData):
         self._role = role
         self._id = int(re.search(r"\d+$", resourceURI)[0])
         self._entity = None
-        f = EndpointFabric.get_instance()
+        f = EndpointFabric.current()
         self._entity_endpoint = f.get_endpoint(self.get_endpoint_class(), endpoint_url=self._resource_uri)
 
     def to_dict(self):
@@ -272,7 +272,7 @@ class ResourceList(MarvelAPIData):
     def __init__(self, endpoint_class, available, collectionURI, items, **kwargs):
         self._collection_uri = collectionURI
         self._available = available
-        f = EndpointFabric.get_instance()
+        f = EndpointFabric.current()
         self._entities_endpoint = f.get_endpoint(endpoint_class, endpoint_url=self._collection_uri)
         if available == 0:
             self._entities = []
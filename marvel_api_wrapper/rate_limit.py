@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+
+
+class MemoryStore:
+    """
+    Token bucket state store shared by threads of one process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def update(self, name, func):
+        """
+        Atomically replace bucket state with func(state) and return new state. State is None for new bucket
+
+        :param name: bucket name
+        :param func: function(state) -> state, where state is {'tokens': float, 'updated': timestamp, 'calls': int}
+        """
+        with self._lock:
+            state = func(self._states.get(name))
+            self._states[name] = state
+            return state
+
+
+class RateScheduler:
+    """
+    Scheduler of API calls with token bucket for daily call quota and exponential backoff with jitter on failures.
+
+    Bucket holds up to daily_quota tokens and is refilled evenly during the day, every call takes one token. When bucket
+    is empty, acquire waits for next token, so long dumps slow down near the limit instead of being throttled by API.
+    Bucket state is kept in store, which can be shared by several processes (e.g. database store of Celery workers).
+    On 429 response bucket is drained for all its users.
+    """
+
+    DAY = 24 * 60 * 60
+    MIN_WAIT = 0.01  # Seconds, keeps waiting loop from spinning on float rounding of refilled tokens
+
+    def __init__(self, daily_quota=3000, store=None, name='marvel_api', max_retries=9, rate_limit_retries=48,
+                 backoff_base=1, backoff_max=30 * 60):
+        """
+        :param daily_quota: API calls per day
+        :param store: bucket state store with update method (see MemoryStore), MemoryStore by default
+        :param name: bucket name in store
+        :param max_retries: retries of one call after connection and server errors
+        :param rate_limit_retries: retries of one call after 429 responses
+        :param backoff_base: delay before first retry, seconds
+        :param backoff_max: maximal delay between retries, seconds
+        """
+        self.daily_quota = daily_quota
+        self.store = store or MemoryStore()
+        self.name = name
+        self.max_retries = max_retries
+        self.rate_limit_retries = rate_limit_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    @property
+    def _rate(self):
+        return self.daily_quota / self.DAY
+
+    def _refill(self, state, now):
+        if state is None:
+            return {'tokens': float(self.daily_quota), 'updated': now, 'calls': 0}
+        tokens = min(float(self.daily_quota), state['tokens'] + max(now - state['updated'], 0) * self._rate)
+        return {'tokens': tokens, 'updated': now, 'calls': state['calls']}
+
+    def acquire(self):
+        """
+        Take token for one API call, waiting until it is available
+        """
+        while True:
+            now = time.time()
+
+            def take(state):
+                state = self._refill(state, now)
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    state['calls'] += 1
+                    state['taken'] = True
+                return state
+
+            state = self.store.update(self.name, take)
+            if state.pop('taken', False):
+                return
+            time.sleep(max((1 - state['tokens']) / self._rate, self.MIN_WAIT))
+
+    def drain(self):
+        """
+        Empty bucket after API reported that quota is exceeded
+        """
+        now = time.time()
+
+        def empty(state):
+            state = self._refill(state, now)
+            state['tokens'] = 0.0
+            return state
+
+        self.store.update(self.name, empty)
+
+    def backoff(self, attempt):
+        """
+        Sleep before retry with "full jitter" exponential backoff
+
+        :param attempt: number of failed attempts before this one, starting from 0
+        """
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def status(self):
+        """
+        :return: {'quota': daily quota, 'remaining': calls available now, 'calls': calls made through bucket,
+                  'wait': seconds until next call is available}
+        """
+        now = time.time()
+        state = self.store.update(self.name, lambda x: self._refill(x, now))
+        return {
+            'quota': self.daily_quota,
+            'remaining': int(state['tokens']),
+            'calls': state['calls'],
+            'wait': 0 if state['tokens'] >= 1 else (1 - state['tokens']) / self._rate
+        }
@@ -0,0 +1,23 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session(pool_size=10, connect_retries=3):
+    """
+    Create HTTP session for endpoints. Connections are kept alive in pool and reused by all endpoints and threads using
+    the session, so requests do not pay for TCP and TLS handshakes.
+
+    Adapter retries only failed connection attempts, which do not reach API and do not take quota; responses are
+    retried by rate scheduler
+
+    :param pool_size: kept-alive connections, should not be less than pages requested at once
+    :param connect_retries: retries of failed connection attempt
+    """
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    retry = Retry(total=connect_retries, connect=connect_retries, read=0, backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session